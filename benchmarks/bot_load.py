@@ -0,0 +1,213 @@
+"""Load harness of the bot: replays recorded updates for many users and measures the bot.
+
+Starts the fake Telegram of `fake_telegram.py`, then every simulated user replays the
+updates of `--updates` (a JSON line per update, as received from Telegram) with its
+own chat. In polling mode the updates are served by the fake getUpdates, in webhook
+mode they are posted to the bot: with several `--webhook` urls, one per replica, a
+chat always reaches the same replica, like behind a load balancer routing by chat.
+
+A user sends its next update once the bot has not called Telegram on its chat for
+`--quiet` seconds. The latency of an update is measured until the first and the last
+call of the bot on its chat. `benchmarks/updates.jsonl` shares a location and asks
+the next day, `benchmarks/updates_browse.jsonl` searches a city by name, moves
+between the days and asks the places around it.
+
+With `--data-layer` the fake data layer of `fake_data_layer.py` is started too, so
+that the whole stack runs locally and its calls are counted. The results, with the
+peak memory of the `--pid` processes, are appended to `--results` to compare the
+runs across commits. Start the bot with TELEGRAM_API_URL pointing to the fake, for
+instance:
+
+    python3 benchmarks/bot_load.py --mode polling --port 8081 --users 50
+    TELEGRAM_TOKEN=123:fake TELEGRAM_API_URL=http://localhost:8081/bot python3 process-centric/main.py
+
+    WEBHOOK_PATH=$(python3 -c "import secrets; print(secrets.token_hex(32))")
+    python3 benchmarks/bot_load.py --mode webhook --webhook http://localhost:8443/$WEBHOOK_PATH
+    TELEGRAM_TOKEN=123:fake TELEGRAM_API_URL=http://localhost:8081/bot BOT_MODE=webhook \\
+        WEBHOOK_URL=http://localhost:8443 WEBHOOK_PATH=$WEBHOOK_PATH python3 process-centric/main.py
+
+and, with `--data-layer`, the business layer as shown in `business_load.py`, then the bot
+with BUSINESS_LAYER_HOST=localhost:8084.
+"""
+import argparse
+import copy
+import json
+import os
+import sys
+import threading
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from itertools import count
+
+import requests
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import fake_data_layer  # noqa: E402
+import report  # noqa: E402
+from fake_telegram import FakeTelegram, serve  # noqa: E402
+
+DEFAULT_UPDATES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "updates.jsonl")
+
+
+class Chat:
+    """Calls of the bot on a simulated chat"""
+
+    def __init__(self) -> None:
+        self.calls = []
+        self.condition = threading.Condition()
+
+    def record(self, at) -> None:
+        with self.condition:
+            self.calls.append(at)
+            self.condition.notify_all()
+
+    def wait_replies(self, since, quiet, timeout):
+        """Waits until the bot is quiet on the chat, returns the time of its first and last call after `since`"""
+        deadline = since + timeout
+
+        with self.condition:
+            while True:
+                replies = [at for at in self.calls if at >= since]
+                now = time.monotonic()
+
+                if replies and now - replies[-1] >= quiet:
+                    return replies[0], replies[-1]
+                if now >= deadline:
+                    return (replies[0], replies[-1]) if replies else (None, None)
+
+                wait = quiet - (now - replies[-1]) if replies else deadline - now
+                self.condition.wait(min(wait, deadline - now))
+
+
+def personalize(update, user_id, update_id):
+    """Returns a copy of the recorded update sent by the given user in its private chat"""
+    update = copy.deepcopy(update)
+    update["update_id"] = update_id
+
+    for key in ("message", "edited_message", "callback_query"):
+        if key not in update:
+            continue
+
+        item = update[key]
+        if "from" in item:
+            item["from"]["id"] = user_id
+
+        message = item.get("message", item)
+        message["chat"]["id"] = user_id
+        message["date"] = int(time.time())
+
+    return update
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--mode", choices=("polling", "webhook"), default="polling")
+    parser.add_argument("--webhook", action="append", help="webhook url of a bot replica, repeat for more replicas")
+    parser.add_argument("--port", type=int, default=8081, help="port of the fake Telegram")
+    parser.add_argument("--updates", default=DEFAULT_UPDATES, help="recorded updates, a JSON object per line")
+    parser.add_argument("--users", type=int, default=20)
+    parser.add_argument("--quiet", type=float, default=0.5, help="seconds without calls ending the replies")
+    parser.add_argument("--timeout", type=float, default=30, help="seconds to wait for the replies of an update")
+    parser.add_argument("--startup", type=float, default=3, help="seconds to wait for the bot before starting")
+    parser.add_argument("--pid", type=int, action="append", help="process of the stack, for its peak memory")
+    parser.add_argument("--results", default=report.DEFAULT_RESULTS, help="file the results are appended to")
+    parser.add_argument("--label", help="label of the run in the results")
+    parser.add_argument("--data-layer", action="store_true", help="start the fake data layer too")
+    fake_data_layer.add_arguments(parser)
+    args = parser.parse_args()
+
+    if args.mode == "webhook" and not args.webhook:
+        parser.error("--webhook is required in webhook mode")
+
+    with open(args.updates) as f:
+        recorded = [json.loads(line) for line in f if line.strip()]
+
+    telegram = FakeTelegram()
+    chats = {1000 + user: Chat() for user in range(args.users)}
+    telegram.listeners.append(lambda method, chat_id, at: chats[chat_id].record(at) if chat_id in chats else None)
+    serve(telegram, port=args.port)
+    data_layer = fake_data_layer.start(args) if args.data_layer else None
+
+    if data_layer is not None:
+        print(f"fake data layer listening on http://127.0.0.1:{args.data_layer_port}/api")
+    print(f"fake Telegram listening on http://127.0.0.1:{args.port}/bot, waiting {args.startup}s for the bot")
+    time.sleep(args.startup)
+
+    update_ids = count(1)
+    first_latencies, last_latencies = [], []
+    lost = 0
+    lock = threading.Lock()
+    session = requests.Session()
+
+    def run_user(user_id):
+        nonlocal lost
+
+        for update in recorded:
+            update = personalize(update, user_id, next(update_ids))
+            sent = time.monotonic()
+
+            if args.mode == "polling":
+                telegram.push(update)
+            else:
+                # a replica per chat, like a load balancer hashing the chat
+                webhook = args.webhook[zlib.crc32(str(user_id).encode()) % len(args.webhook)]
+                session.post(webhook, json=update, timeout=args.timeout)
+
+            first, last = chats[user_id].wait_replies(sent, args.quiet, args.timeout)
+
+            with lock:
+                if first is None:
+                    lost += 1
+                else:
+                    first_latencies.append(first - sent)
+                    last_latencies.append(last - sent)
+
+    started = time.monotonic()
+    with ThreadPoolExecutor(max_workers=args.users) as pool:
+        list(pool.map(run_user, chats))
+    elapsed = time.monotonic() - started
+
+    # the quiet period closing the replies of each update is not part of the bot time
+    busy = elapsed - len(recorded) * args.quiet
+    total = args.users * len(recorded)
+
+    results = {
+        "elapsed": elapsed,
+        "busy": busy,
+        "updates_per_second": total / busy,
+        "lost": lost,
+        "first_reply": report.percentiles(first_latencies),
+        "last_reply": report.percentiles(last_latencies),
+        "telegram": telegram.stats(),
+        "upstream_calls": data_layer.stats()["calls"] if data_layer is not None else None,
+        "peak_rss": {pid: report.peak_rss(pid) for pid in args.pid or []},
+    }
+
+    print(f"\nmode {args.mode}, {args.users} users, {total} updates, {lost} without replies")
+    print(f"throughput: {total / busy:.1f} updates/s over {busy:.1f}s of bot time ({elapsed:.1f}s total)")
+    print(f"latency to the first reply: {report.format_percentiles(results['first_reply'])}")
+    print(f"latency to the last reply:  {report.format_percentiles(results['last_reply'])}")
+    print(f"Telegram calls: {json.dumps(results['telegram'])}")
+    if data_layer is not None:
+        print(f"data layer calls: {json.dumps(results['upstream_calls'])}")
+    for pid, rss in results["peak_rss"].items():
+        print(f"peak RSS of {pid}: {rss / 2 ** 20:.1f} MiB" if rss else f"peak RSS of {pid}: n/a")
+
+    parameters = {
+        "mode": args.mode,
+        "replicas": len(args.webhook or []) or 1,
+        "updates": os.path.basename(args.updates),
+        "users": args.users,
+        "quiet": args.quiet,
+    }
+    if data_layer is not None:
+        parameters.update(latency=args.latency, route_latency=args.route_latency, jitter=args.jitter)
+
+    report.save(args.results, "bot_load", parameters, results, args.label)
+    print(f"results appended to {args.results}")
+
+
+if __name__ == "__main__":
+    main()
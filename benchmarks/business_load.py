@@ -0,0 +1,260 @@
+"""End-to-end load test of the business layer against the fake data layer.
+
+Starts the fake data layer of `fake_data_layer.py`, then every simulated user browses
+the business layer for `--duration` seconds, like a user of the bot: it picks its next
+action from the weighted traffic mix of `--mix`,
+
+* search: the weather of a city searched by name, then its report and map
+* position: the same for a position near a city, like a shared location
+* navigate: the report and map of the previous or next day, like the ◀/▶ buttons
+* places: the places of a category around the last location
+
+The cities are the ones of the geocoding fixtures, picked with a Zipf distribution so
+that a few of them are searched most of the time. Start the business layer on the fake
+once it is listening, for instance:
+
+    python3 benchmarks/business_load.py --icons /tmp/icons --users 20 --duration 30 --pid <pid>
+    cd business-layer && DATA_LAYER_URL=http://localhost:8083/api ICON_WARM_DIR=/tmp/icons \\
+        GEOCODING_CACHE_FILE=:memory: SERVER_PORT=8084 python3 main.py
+
+It reports the throughput, the latency percentiles by action and by endpoint, the calls
+received by the data layer and, with `--pid`, the peak memory of the business layer
+processes, then appends them to `--results` to compare the runs across commits.
+"""
+import argparse
+import bisect
+import itertools
+import json
+import os
+import random
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date
+
+import requests
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import fake_data_layer  # noqa: E402
+import report  # noqa: E402
+
+DEFAULT_MIX = "search=3,position=2,navigate=4,places=2"
+
+CATEGORIES = ("restaurants", "parks", "museums", "sights")
+
+# Days reachable with the day navigation, from today
+MAX_DELTA = 3
+
+
+def parse_mix(value) -> dict:
+    mix = {}
+
+    for item in value.split(","):
+        action, _, weight = item.partition("=")
+        if action not in Browser.ACTIONS:
+            raise argparse.ArgumentTypeError(f"unknown action '{action}', use: {', '.join(Browser.ACTIONS)}")
+        mix[action] = float(weight or 1)
+
+    return mix
+
+
+class Recorder:
+    """Latencies and errors of the requests and of the actions"""
+
+    def __init__(self) -> None:
+        self.actions = {}
+        self.endpoints = {}
+        self.errors = {}
+        self.lock = threading.Lock()
+
+    def request(self, endpoint, seconds, status) -> None:
+        with self.lock:
+            self.endpoints.setdefault(endpoint, []).append(seconds)
+            if status != 200:
+                key = f"{endpoint} {status}"
+                self.errors[key] = self.errors.get(key, 0) + 1
+
+    def action(self, action, seconds) -> None:
+        with self.lock:
+            self.actions.setdefault(action, []).append(seconds)
+
+
+class Browser:
+    """A simulated user of the bot, calling the business layer like the bot does for it"""
+
+    ACTIONS = ("search", "position", "navigate", "places")
+
+    def __init__(self, url, cities, weights, recorder, rng) -> None:
+        self.url = url
+        self.cities = cities
+        self.cumulative = list(itertools.accumulate(weights))
+        self.recorder = recorder
+        self.rng = rng
+        self.session = requests.Session()
+
+        self.location = None
+        self.delta = 0
+
+    def city(self):
+        return self.cities[bisect.bisect(self.cumulative, self.rng.random() * self.cumulative[-1])]
+
+    def get(self, endpoint, path, params=None):
+        started = time.perf_counter()
+
+        try:
+            res = self.session.get(f"{self.url}{path}", params=params, timeout=60)
+            status = res.status_code
+        except requests.RequestException as e:
+            res, status = None, type(e).__name__
+
+        self.recorder.request(endpoint, time.perf_counter() - started, status)
+        return res if status == 200 else None
+
+    def run(self, action) -> None:
+        started = time.perf_counter()
+
+        # every user starts from a search, the other actions need a location
+        if self.location is None and action in ("navigate", "places"):
+            action = "search"
+
+        getattr(self, action)()
+        self.recorder.action(action, time.perf_counter() - started)
+
+    def search(self) -> None:
+        self.show({"location": self.city()["name"]})
+
+    def position(self) -> None:
+        # somewhere in the city, a few kilometers around its center
+        city = self.city()
+        self.show({
+            "lat": round(float(city["lat"]) + self.rng.uniform(-0.03, 0.03), 6),
+            "lon": round(float(city["lon"]) + self.rng.uniform(-0.03, 0.03), 6),
+        })
+
+    def show(self, location) -> None:
+        """The weather of a new location, checked before showing its report"""
+        if self.get("weather", "/weather", location) is None:
+            return
+
+        self.location = location
+        self.delta = 0
+        self.report()
+
+    def navigate(self) -> None:
+        if self.delta == 0:
+            self.delta = 1
+        elif self.delta == MAX_DELTA:
+            self.delta -= 1
+        else:
+            self.delta += self.rng.choice((-1, 1))
+
+        self.report()
+
+    def report(self) -> None:
+        params = {**self.location, "today": date.today().strftime("%Y-%m-%d"), "delta": self.delta}
+        res = self.get("report", "/report", params)
+
+        if res is not None:
+            # the map path includes the /api/v1 prefix
+            self.get("map", res.json()["map"][len("/api/v1"):])
+
+    def places(self) -> None:
+        self.get("places", "/places", {**self.location, "category": self.rng.choice(CATEGORIES)})
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", default="http://localhost:8084/api/v1", help="url of the business layer API")
+    parser.add_argument("--users", type=int, default=20)
+    parser.add_argument("--duration", type=float, default=30, help="seconds of load")
+    parser.add_argument("--think", type=float, default=0, help="seconds a user waits between its actions")
+    parser.add_argument("--mix", type=parse_mix, default=DEFAULT_MIX, help=f"weights of the actions ({DEFAULT_MIX})")
+    parser.add_argument("--zipf", type=float, default=1.1, help="exponent of the popularity of the cities")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--startup", type=float, default=0, help="seconds to wait for the business layer")
+    parser.add_argument("--pid", type=int, action="append", help="business layer process, for its peak memory")
+    parser.add_argument("--results", default=report.DEFAULT_RESULTS, help="file the results are appended to")
+    parser.add_argument("--label", help="label of the run in the results")
+    fake_data_layer.add_arguments(parser)
+    args = parser.parse_args()
+
+    fake = fake_data_layer.start(args)
+    cities = [{"name": name.title(), **location} for name, location in fake.fixtures["geocoding"].items()]
+    popularity = [1 / rank ** args.zipf for rank in range(1, len(cities) + 1)]
+
+    print(f"fake data layer listening on http://127.0.0.1:{args.data_layer_port}/api")
+    if args.startup:
+        print(f"waiting {args.startup}s for the business layer")
+        time.sleep(args.startup)
+
+    recorder = Recorder()
+    actions, weights = zip(*args.mix.items())
+    deadline = time.monotonic() + args.duration
+
+    def run_user(user):
+        rng = random.Random(args.seed * 100003 + user)
+        browser = Browser(args.url, cities, popularity, recorder, rng)
+
+        while time.monotonic() < deadline:
+            browser.run(rng.choices(actions, weights)[0])
+            if args.think:
+                time.sleep(args.think)
+
+    started = time.monotonic()
+    with ThreadPoolExecutor(max_workers=args.users) as pool:
+        list(pool.map(run_user, range(args.users)))
+    elapsed = time.monotonic() - started
+
+    requests_count = sum(len(latencies) for latencies in recorder.endpoints.values())
+    actions_count = sum(len(latencies) for latencies in recorder.actions.values())
+    upstream = fake.stats()["calls"]
+
+    results = {
+        "elapsed": elapsed,
+        "actions_per_second": actions_count / elapsed,
+        "requests_per_second": requests_count / elapsed,
+        "actions": {action: {"count": len(values), **report.percentiles(values)}
+                    for action, values in sorted(recorder.actions.items())},
+        "endpoints": {endpoint: {"count": len(values), **report.percentiles(values)}
+                      for endpoint, values in sorted(recorder.endpoints.items())},
+        "errors": recorder.errors,
+        "upstream_calls": upstream,
+        "upstream_throttled": fake.stats()["throttled"],
+        "upstream_calls_per_action": sum(upstream.values()) / max(actions_count, 1),
+        "peak_rss": {pid: report.peak_rss(pid) for pid in args.pid or []},
+    }
+
+    print(f"\n{args.users} users, {actions_count} actions, {requests_count} requests in {elapsed:.1f}s")
+    print(f"throughput: {results['actions_per_second']:.1f} actions/s, {results['requests_per_second']:.1f} requests/s")
+    for action, values in sorted(recorder.actions.items()):
+        print(f"  {action:<10} {len(values):>6}  {report.format_percentiles(report.percentiles(values))}")
+    print("requests:")
+    for endpoint, values in sorted(recorder.endpoints.items()):
+        print(f"  {endpoint:<10} {len(values):>6}  {report.format_percentiles(report.percentiles(values))}")
+    print(f"errors: {json.dumps(recorder.errors)}")
+    print(f"data layer calls: {json.dumps(upstream)}, {results['upstream_calls_per_action']:.2f} per action")
+    if results["upstream_throttled"]:
+        print(f"data layer answers 429: {json.dumps(results['upstream_throttled'])}")
+    for pid, rss in results["peak_rss"].items():
+        print(f"peak RSS of {pid}: {rss / 2 ** 20:.1f} MiB" if rss else f"peak RSS of {pid}: n/a")
+
+    parameters = {
+        "users": args.users,
+        "duration": args.duration,
+        "think": args.think,
+        "mix": args.mix,
+        "zipf": args.zipf,
+        "seed": args.seed,
+        "latency": args.latency,
+        "route_latency": args.route_latency,
+        "jitter": args.jitter,
+        "quota": args.quota,
+    }
+    report.save(args.results, "business_load", parameters, results, args.label)
+    print(f"results appended to {args.results}")
+
+
+if __name__ == "__main__":
+    main()
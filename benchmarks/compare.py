@@ -0,0 +1,105 @@
+"""Compares the runs of the load harnesses stored in the results file, one line per run.
+
+    python3 benchmarks/compare.py [--benchmark business_load] [--last 10] [--results benchmarks/results.jsonl]
+
+Runs with different parameters are not comparable: they are listed with the
+parameters that differ from the ones of the latest run.
+"""
+import argparse
+import json
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import report  # noqa: E402
+
+# Columns of every benchmark: header and function reading the value from the results
+COLUMNS = {
+    "business_load": [
+        ("actions/s", lambda results: results["actions_per_second"]),
+        ("req/s", lambda results: results["requests_per_second"]),
+        ("report p50", lambda results: results["endpoints"].get("report", {}).get("p50")),
+        ("report p95", lambda results: results["endpoints"].get("report", {}).get("p95")),
+        ("report p99", lambda results: results["endpoints"].get("report", {}).get("p99")),
+        ("places p95", lambda results: results["endpoints"].get("places", {}).get("p95")),
+        ("upstream/action", lambda results: results["upstream_calls_per_action"]),
+        ("errors", lambda results: sum(results["errors"].values())),
+    ],
+    "bot_load": [
+        ("updates/s", lambda results: results["updates_per_second"]),
+        ("first p50", lambda results: results["first_reply"].get("p50")),
+        ("first p95", lambda results: results["first_reply"].get("p95")),
+        ("last p95", lambda results: results["last_reply"].get("p95")),
+        ("last p99", lambda results: results["last_reply"].get("p99")),
+        ("upstream", lambda results: sum((results["upstream_calls"] or {}).values()) or None),
+        ("lost", lambda results: results["lost"]),
+    ],
+    "digest_load": [
+        ("users/min", lambda results: results["users_per_minute"]),
+        ("locations", lambda results: results["locations"]),
+        ("sent", lambda results: results["sent"]),
+        ("failed", lambda results: results["failed"]),
+        ("peak msg/s", lambda results: results["peak_messages_per_second"]),
+        ("upstream", lambda results: sum(results["upstream_calls"].values())),
+    ],
+}
+
+
+def format_value(value) -> str:
+    if value is None:
+        return "-"
+    if isinstance(value, float):
+        return f"{value:.1f}"
+    return str(value)
+
+
+def peak_rss(results) -> str:
+    peaks = [peak for peak in results.get("peak_rss", {}).values() if peak]
+    return f"{sum(peaks) / 2 ** 20:.0f}" if peaks else "-"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--results", default=report.DEFAULT_RESULTS)
+    parser.add_argument("--benchmark", choices=sorted(COLUMNS), default="business_load")
+    parser.add_argument("--last", type=int, default=10, help="number of the latest runs compared")
+    args = parser.parse_args()
+
+    with open(args.results) as f:
+        runs = [json.loads(line) for line in f if line.strip()]
+
+    runs = [run for run in runs if run["benchmark"] == args.benchmark][-args.last:]
+    if not runs:
+        print(f"no {args.benchmark} runs in {args.results}")
+        return
+
+    columns = COLUMNS[args.benchmark]
+    headers = ["commit", "label", "time"] + [header for header, _ in columns] + ["RSS MiB"]
+    rows = []
+
+    for run in runs:
+        commit = (run["commit"] or "?") + ("+" if run["dirty"] else "")
+        rows.append(
+            [commit, run["label"] or "", run["time"][:16]]
+            + [format_value(value(run["results"])) for _, value in columns]
+            + [peak_rss(run["results"])]
+        )
+
+    widths = [max(len(row[i]) for row in rows + [headers]) for i in range(len(headers))]
+    for row in [headers] + rows:
+        # the commit, the label and the time are aligned to the left, the values to the right
+        cells = [cell.ljust(width) if i < 3 else cell.rjust(width) for i, (cell, width) in enumerate(zip(row, widths))]
+        print("  ".join(cells))
+
+    latest = runs[-1]["parameters"]
+    for run in runs[:-1]:
+        different = {name: value for name, value in run["parameters"].items() if latest.get(name) != value}
+        if different:
+            print(f"{run['commit']} {run['time'][:16]} ran with {json.dumps(different)}")
+
+    print("\na + after the commit marks runs of a working tree with uncommitted changes, latencies are in ms")
+
+
+if __name__ == "__main__":
+    main()
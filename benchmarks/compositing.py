@@ -0,0 +1,137 @@
+"""Micro-benchmark of the map compositing of the business layer.
+
+Compares the PIL path, pasting tile by tile, with the NumPy engine of
+`business-layer/compositing.py` on synthetic 256x256 tiles, and the encoding
+time and size of the supported output formats.
+
+    python3 benchmarks/compositing.py [--iterations 50]
+"""
+import argparse
+import os
+import sys
+import timeit
+from io import BytesIO
+
+import numpy as np
+from PIL import Image
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "business-layer"))
+
+import compositing  # noqa: E402
+
+TILE_SIZE = 256
+ICON_SIZE = 80
+OFFSET = (300, 180)
+
+
+def encode_png(image):
+    output = BytesIO()
+    image.save(output, "PNG")
+    return output.getvalue()
+
+
+def synthetic_tiles(rng, rain=0.3):
+    """Returns map tiles with smooth colors and precipitation overlays translucent on `rain` of their area"""
+    y, x = np.mgrid[0:TILE_SIZE, 0:TILE_SIZE]
+    tiles, overlays = {}, {}
+
+    for i in range(2):
+        for j in range(2):
+            base = np.empty((TILE_SIZE, TILE_SIZE, 3), dtype=np.uint8)
+            base[..., 0] = (x + 64 * i) % 256
+            base[..., 1] = (y + 64 * j) % 256
+            base[..., 2] = rng.integers(180, 200, (TILE_SIZE, TILE_SIZE))
+            tiles[(i, j)] = encode_png(Image.fromarray(base, "RGB"))
+
+            overlay = np.zeros((TILE_SIZE, TILE_SIZE, 4), dtype=np.uint8)
+            overlay[..., 2] = 255
+            overlay[..., 3] = np.where(rng.random((TILE_SIZE, TILE_SIZE)) < rain, 120, 0)
+            overlays[(i, j)] = encode_png(Image.fromarray(overlay, "RGBA"))
+
+    icon = np.zeros((64, 64, 4), dtype=np.uint8)
+    icon[16:48, 16:48] = (255, 200, 0, 255)
+    return tiles, overlays, encode_png(Image.fromarray(icon, "RGBA"))
+
+
+def pil_path(tiles, overlays, icon):
+    """The original MapOverlay rendering: a paste per tile, per overlay and for the icon"""
+    return encode_png(pil_compose(tiles, overlays, icon))
+
+
+def pil_compose(tiles, overlays, icon):
+    canvas = Image.new("RGBA", (TILE_SIZE * 2, TILE_SIZE * 2), (0, 0, 0, 0))
+
+    for (i, j), content in tiles.items():
+        map_image = Image.open(BytesIO(content))
+        overlay = Image.open(BytesIO(overlays[(i, j)]))
+        map_image.paste(overlay, (0, 0), overlay)
+        canvas.paste(map_image, (i * TILE_SIZE, j * TILE_SIZE))
+
+    weather_icon = Image.open(BytesIO(icon)).resize((ICON_SIZE, ICON_SIZE))
+    canvas.paste(weather_icon, OFFSET, weather_icon)
+
+    return canvas
+
+
+def numpy_path(tiles, overlays, icon, image_format="png", png_compress_level=6):
+    """The compositing engine: one decode per tile into the canvas and one vectorized blend"""
+    return compositing.encode(numpy_compose(tiles, overlays, icon), image_format, png_compress_level)
+
+
+def numpy_compose(tiles, overlays, icon):
+    canvas = compositing.compose(tiles, overlays, TILE_SIZE)
+
+    weather_icon = Image.open(BytesIO(icon)).convert("RGBA").resize((ICON_SIZE, ICON_SIZE))
+    compositing.paste(canvas, np.asarray(weather_icon), OFFSET)
+
+    return canvas
+
+
+def measure(name, function, iterations):
+    seconds = min(timeit.repeat(function, number=iterations, repeat=3)) / iterations
+    size = len(function())
+    print(f"{name:<32} {seconds * 1000:8.2f} ms {size / 1024:8.1f} KiB")
+    return seconds
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--iterations", type=int, default=50)
+    args = parser.parse_args()
+
+    tiles, overlays, icon = synthetic_tiles(np.random.default_rng(0))
+    _, dry_overlays, _ = synthetic_tiles(np.random.default_rng(0), rain=0)
+
+    difference = np.abs(
+        np.asarray(pil_compose(tiles, overlays, icon), dtype=np.int16) - numpy_compose(tiles, overlays, icon)
+    )
+    # the alpha differs on purpose: the engine keeps the map opaque under the translucent borders of the icon
+    print(f"largest color difference from the PIL path: {difference[..., :3].max()}\n")
+
+    print(f"{'path':<32} {'time':>11} {'size':>12}")
+    baseline = measure("PIL paste + PNG", lambda: pil_path(tiles, overlays, icon), args.iterations)
+    engine = measure("NumPy blend + PNG", lambda: numpy_path(tiles, overlays, icon), args.iterations)
+
+    for level in (1, 3):
+        measure(f"NumPy blend + PNG level {level}",
+                lambda: numpy_path(tiles, overlays, icon, png_compress_level=level), args.iterations)
+
+    for image_format in ("webp", "jpeg"):
+        measure(f"NumPy blend + {image_format.upper()}",
+                lambda: numpy_path(tiles, overlays, icon, image_format), args.iterations)
+
+    # compositing only, without the encoding that dominates both paths
+    pil_only = measure("PIL compose only", lambda: pil_compose(tiles, overlays, icon).tobytes(), args.iterations)
+    numpy_only = measure("NumPy compose only", lambda: numpy_compose(tiles, overlays, icon).tobytes(), args.iterations)
+    pil_dry = measure("PIL compose only, no rain", lambda: pil_compose(tiles, dry_overlays, icon).tobytes(),
+                      args.iterations)
+    numpy_dry = measure("NumPy compose only, no rain", lambda: numpy_compose(tiles, dry_overlays, icon).tobytes(),
+                        args.iterations)
+
+    print(f"\nspeedup of the engine with the same PNG settings: {baseline / engine:.2f}x")
+    print(f"speedup of the compositing alone: {pil_only / numpy_only:.2f}x, without rain: {pil_dry / numpy_dry:.2f}x")
+    print(f"share of the encoding in the engine path: {1 - numpy_only / engine:.0%}")
+
+
+if __name__ == "__main__":
+    main()
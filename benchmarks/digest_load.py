@@ -0,0 +1,174 @@
+"""Load harness of the daily digest: sends it to many users against the fake data layer and Telegram.
+
+Starts the fake data layer of `fake_data_layer.py` with `--users` users, whose favourite
+locations are in the cities of the geocoding fixtures, picked with a Zipf distribution:
+a `--searched` fraction of them saved a city searched by name, at its coordinates,
+the other ones a shared position around it. Then it starts the fake Telegram of
+`fake_telegram.py` and runs the digest job of the bot in this process, against the
+business layer of `--url` started on the fake data layer as shown in `business_load.py`:
+
+    python3 benchmarks/digest_load.py --icons /tmp/icons --users 2000 --startup 5
+
+It reports the users served per minute, the locations rendered and the calls received
+by Telegram and by the data layer, and checks that the digest kept within its rate
+limits. With `--state` the progress is kept in that file, so that an interrupted run
+resumes when the harness starts again. The results are appended to `--results`.
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+from datetime import date
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(1, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "process-centric"))
+
+import fake_data_layer  # noqa: E402
+import report  # noqa: E402
+from fake_telegram import FakeTelegram, serve  # noqa: E402
+
+from digest import DigestJob, DigestState, RateLimitedSender  # noqa: E402
+from telegram import Bot  # noqa: E402
+from telegram.utils.request import Request  # noqa: E402
+
+
+class Deliveries:
+    """Times of the photos received by Telegram, overall and by chat"""
+
+    def __init__(self) -> None:
+        self.times = []
+        self.chats = {}
+        self.lock = threading.Lock()
+
+    def record(self, method, chat_id, at) -> None:
+        if method != "sendPhoto":
+            return
+
+        with self.lock:
+            self.times.append(at)
+            self.chats.setdefault(chat_id, []).append(at)
+
+    def peak_rate(self) -> int:
+        """Returns the most photos received within a second"""
+        times = sorted(self.times)
+        start, peak = 0, 0
+
+        for end, at in enumerate(times):
+            while at - times[start] >= 1:
+                start += 1
+            peak = max(peak, end - start + 1)
+
+        return peak
+
+    def min_chat_interval(self):
+        intervals = [b - a for times in self.chats.values() for a, b in zip(times, times[1:])]
+        return min(intervals) if intervals else None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", default="http://localhost:8084/api/v1", help="url of the business layer API")
+    parser.add_argument("--telegram-port", type=int, default=8081)
+    parser.add_argument("--users", type=int, default=1000, help="users with a favourite location")
+    parser.add_argument("--searched", type=float, default=0.7, help="fraction of the users who saved a searched city")
+    parser.add_argument("--spread", type=float, default=0.05, help="degrees of the positions around the cities")
+    parser.add_argument("--zipf", type=float, default=1.1, help="exponent of the popularity of the cities")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--processes", type=int, default=2)
+    parser.add_argument("--page-size", type=int, default=500)
+    parser.add_argument("--bucket-zoom", type=int, default=15)
+    parser.add_argument("--rate", type=float, default=25, help="messages per second of the digest")
+    parser.add_argument("--chat-interval", type=float, default=1)
+    parser.add_argument("--send-workers", type=int, default=8)
+    parser.add_argument("--state", help="state file of the digest, a temporary one by default")
+    parser.add_argument("--startup", type=float, default=0, help="seconds to wait for the business layer")
+    parser.add_argument("--results", default=report.DEFAULT_RESULTS, help="file the results are appended to")
+    parser.add_argument("--label", help="label of the run in the results")
+    fake_data_layer.add_arguments(parser)
+    args = parser.parse_args()
+
+    fake = fake_data_layer.start(args)
+    rng = random.Random(args.seed)
+    cities = list(fake.fixtures["geocoding"].values())
+    popularity = [1 / rank ** args.zipf for rank in range(1, len(cities) + 1)]
+
+    for user_id in range(1, args.users + 1):
+        city = rng.choices(cities, popularity)[0]
+        spread = 0 if rng.random() < args.searched else args.spread
+        fake.users[user_id] = {
+            "id": user_id,
+            "lat": round(float(city["lat"]) + rng.uniform(-spread, spread), 6),
+            "lon": round(float(city["lon"]) + rng.uniform(-spread, spread), 6),
+        }
+
+    telegram = FakeTelegram()
+    deliveries = Deliveries()
+    telegram.listeners.append(deliveries.record)
+    serve(telegram, port=args.telegram_port)
+
+    print(f"fake data layer listening on http://127.0.0.1:{args.data_layer_port}/api")
+    if args.startup:
+        print(f"waiting {args.startup}s for the business layer")
+        time.sleep(args.startup)
+
+    bot = Bot("123:fake", base_url=f"http://127.0.0.1:{args.telegram_port}/bot",
+              request=Request(con_pool_size=args.send_workers + 2))
+    state_file = args.state or os.path.join(tempfile.mkdtemp(), "digest.sqlite3")
+    job = DigestJob(
+        bot,
+        args.url,
+        DigestState(state_file),
+        RateLimitedSender(args.rate, args.chat_interval, args.send_workers),
+        processes=args.processes,
+        page_size=args.page_size,
+        bucket_zoom=args.bucket_zoom,
+    )
+
+    run = job.run(date.today().strftime("%Y-%m-%d"))
+    if run is None:
+        print(f"the digest of today was sent already, according to {state_file}")
+        return
+
+    upstream = fake.stats()["calls"]
+    results = {
+        **{key: value for key, value in run.items() if key != "day"},
+        "telegram_calls": telegram.stats()["calls"],
+        "uploaded_bytes": telegram.stats()["uploaded_bytes"],
+        "peak_messages_per_second": deliveries.peak_rate(),
+        "min_chat_interval": deliveries.min_chat_interval(),
+        "upstream_calls": upstream,
+    }
+
+    print(f"\n{run['users']} users, {run['locations']} locations in {run['elapsed']}s")
+    print(f"throughput: {run['users_per_minute']} users/min, sent {run['sent']}, failed {run['failed']}, "
+          f"skipped {run['skipped']}")
+    print(f"telegram: {results['telegram_calls']}, {results['uploaded_bytes'] / 2 ** 20:.1f} MiB uploaded, "
+          f"peak {results['peak_messages_per_second']} messages/s")
+    print(f"data layer calls: {upstream}")
+
+    parameters = {
+        "users": args.users,
+        "searched": args.searched,
+        "spread": args.spread,
+        "zipf": args.zipf,
+        "seed": args.seed,
+        "processes": args.processes,
+        "page_size": args.page_size,
+        "bucket_zoom": args.bucket_zoom,
+        "rate": args.rate,
+        "chat_interval": args.chat_interval,
+        "send_workers": args.send_workers,
+        "latency": args.latency,
+        "route_latency": args.route_latency,
+        "jitter": args.jitter,
+        "quota": args.quota,
+    }
+    report.save(args.results, "digest_load", parameters, results, args.label)
+    print(f"results appended to {args.results}")
+
+
+if __name__ == "__main__":
+    main()
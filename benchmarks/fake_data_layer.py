@@ -0,0 +1,439 @@
+"""Local stand-in of the data layer API, to run and load test the business layer without the upstream providers.
+
+Answers the adapter routes used by the business layer with the responses recorded
+in `benchmarks/fixtures`: the forecasts are moved to the current days, the places
+around the requested location and the geocoding answers the recorded cities only.
+The map and precipitation tiles are synthesized once per tile, so that they have
+the size of real ones, and the users are kept in memory.
+
+Every answer is delayed by the configured latency, to reproduce the time spent by
+the providers, and counted by route: the counts are served on /stats. With `--quota`
+a provider answers 429 to the requests beyond its rate, within every second.
+
+    python3 benchmarks/fake_data_layer.py [--port 8083] [--latency 50] [--route-latency map=150] \\
+        [--quota openweathermap=1] [--icons /tmp/icons]
+
+then start the business layer with DATA_LAYER_URL=http://localhost:8083/api, and with
+ICON_WARM_DIR=/tmp/icons so that it does not download the weather icons.
+"""
+import argparse
+import json
+import math
+import os
+import random
+import re
+import threading
+import time
+import zlib
+from datetime import date, datetime, timedelta
+from functools import partial
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import BytesIO
+from urllib.parse import parse_qs, urlsplit
+
+import numpy as np
+from PIL import Image
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures")
+
+TILE_SIZE = 256
+
+ADAPTER_PATH = re.compile(r"^/api/adapters/v1/([\w/]+?)/?$")
+# Adapter routes answered, each by the method named after it
+ADAPTER_ENDPOINTS = {
+    "map",
+    "map/precipitations",
+    "weather/current",
+    "weather/forecast",
+    "air_pollution",
+    "air_pollution/forecast",
+    "geocoding/search",
+    "places",
+}
+
+# Upstream provider of every adapter endpoint, whose quota is shared by its endpoints
+PROVIDERS = {
+    "map": "geoapify",
+    "places": "geoapify",
+    "map/precipitations": "openweathermap",
+    "air_pollution": "openweathermap",
+    "air_pollution/forecast": "openweathermap",
+    "weather/current": "weatherapi",
+    "weather/forecast": "weatherapi",
+    "geocoding/search": "nominatim",
+}
+
+USER_PATH = re.compile(r"^/api/db/v1/user(?:/(\d+))?/?$")
+
+
+def load_fixture(name):
+    with open(os.path.join(FIXTURES, name), encoding="utf-8") as f:
+        return json.load(f)
+
+
+def encode_png(array, mode):
+    output = BytesIO()
+    Image.fromarray(array, mode).save(output, "PNG")
+    return output.getvalue()
+
+
+def distance(lat1, lon1, lat2, lon2):
+    """Returns the distance in meters between two points, on a sphere"""
+    lat1, lon1, lat2, lon2 = map(math.radians, (lat1, lon1, lat2, lon2))
+    a = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2
+    return 2 * 6371000 * math.asin(math.sqrt(a))
+
+
+class FakeDataLayer:
+    """Answers of the data layer routes, delayed by a latency by route.
+
+    The latency of a route is `latency` seconds unless overridden in `route_latency`,
+    every delay is varied uniformly by up to `jitter` times the latency. The providers
+    in `quotas` answer at most that many requests per second, like a rate limit.
+    """
+
+    def __init__(self, latency=0.0, route_latency=None, jitter=0.0, seed=0, quotas=None) -> None:
+        self.latency = latency
+        self.route_latency = route_latency or {}
+        self.jitter = jitter
+        self.random = random.Random(seed)
+        self.quotas = quotas or {}
+        self.windows = {}
+        self.throttled = {}
+
+        self.fixtures = {name: load_fixture(f"{name}.json") for name in ("geocoding", "weather", "air_pollution", "places")}
+
+        self.tiles = {}
+        self.users = {}
+        self.calls = {}
+        self.lock = threading.Lock()
+
+    def delay(self, route) -> float:
+        latency = self.route_latency.get(route, self.latency)
+        with self.lock:
+            return max(0.0, latency * (1 + self.random.uniform(-self.jitter, self.jitter)))
+
+    def icons(self):
+        """Yields the urls of the weather condition icons of the fixtures"""
+        yield self.fixtures["weather"]["current"]["current"]["condition"]["icon"]
+        for day in self.fixtures["weather"]["forecast"]["days"]:
+            yield day["condition"]["icon"]
+
+    def write_icons(self, directory) -> int:
+        """Writes a synthetic icon for every icon of the fixtures, in the layout loaded by ICON_WARM_DIR"""
+        written = 0
+
+        for url in set(self.icons()):
+            path = os.path.join(directory, *url.split("/")[-2:])
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+
+            icon = np.zeros((64, 64, 4), dtype=np.uint8)
+            icon[16:48, 16:48] = (255, 200 - zlib.crc32(url.encode()) % 120, 0, 255)
+            with open(path, "wb") as f:
+                f.write(encode_png(icon, "RGBA"))
+            written += 1
+
+        return written
+
+    def answer(self, method, path, query, form):
+        """Returns the status, the content type and the body of the answer to a request"""
+        match = ADAPTER_PATH.match(path)
+        if match and method == "GET":
+            endpoint = match.group(1)
+            handler = getattr(self, endpoint.replace("/", "_")) if endpoint in ADAPTER_ENDPOINTS else None
+            route = endpoint.split("/")[0]
+        elif USER_PATH.match(path):
+            user_id = USER_PATH.match(path).group(1)
+            endpoint = f"user/{method}" if user_id else "user"
+            handler = partial(self.user, method, user_id, form)
+            route = "user"
+        else:
+            return 404, "application/json", json.dumps({"error": "Not found"}).encode()
+
+        with self.lock:
+            self.calls[endpoint] = self.calls.get(endpoint, 0) + 1
+
+        if not self.allow(PROVIDERS.get(endpoint)):
+            return 429, "application/json", json.dumps({"error": "The quota of the provider is exhausted"}).encode()
+
+        time.sleep(self.delay(route))
+
+        if handler is None:
+            return 404, "application/json", json.dumps({"error": "Not found"}).encode()
+
+        try:
+            status, body = handler(query)
+        except (KeyError, ValueError) as e:
+            status, body = 400, {"error": f"Invalid parameters: {e}"}
+
+        if isinstance(body, bytes):
+            return status, "image/png", body
+
+        return status, "application/json", json.dumps(body).encode()
+
+    def allow(self, provider) -> bool:
+        """Counts a request in the current second of the provider, False beyond its quota"""
+        if provider not in self.quotas:
+            return True
+
+        second = int(time.time())
+        with self.lock:
+            start, count = self.windows.get(provider, (second, 0))
+            count = count + 1 if start == second else 1
+            self.windows[provider] = (second, count)
+
+            if count > self.quotas[provider]:
+                self.throttled[provider] = self.throttled.get(provider, 0) + 1
+                return False
+
+        return True
+
+    # Map tiles
+
+    def tile(self, layer, zoom, x, y) -> bytes:
+        key = (layer, zoom, x, y)
+        content = self.tiles.get(key)
+
+        if content is None:
+            rng = np.random.default_rng(zlib.crc32(repr(key).encode()))
+
+            if layer == "map":
+                # smooth colors with some noise, compressing like the street map tiles
+                j, i = np.mgrid[0:TILE_SIZE, 0:TILE_SIZE]
+                base = np.empty((TILE_SIZE, TILE_SIZE, 3), dtype=np.uint8)
+                base[..., 0] = (i + 16 * x) % 256
+                base[..., 1] = (j + 16 * y) % 256
+                base[..., 2] = rng.integers(200, 216, (TILE_SIZE, TILE_SIZE))
+                content = encode_png(base, "RGB")
+            else:
+                # translucent rain on a part of the tile, transparent elsewhere
+                overlay = np.zeros((TILE_SIZE, TILE_SIZE, 4), dtype=np.uint8)
+                overlay[..., 2] = 255
+                overlay[..., 3] = np.where(rng.random((TILE_SIZE, TILE_SIZE)) < rng.uniform(0, 0.4), 120, 0)
+                content = encode_png(overlay, "RGBA")
+
+            with self.lock:
+                self.tiles[key] = content
+
+        return content
+
+    def map(self, query):
+        return 200, self.tile("map", int(query["zoom"]), int(query["x"]), int(query["y"]))
+
+    def map_precipitations(self, query):
+        return 200, self.tile("precipitations", int(query["zoom"]), int(query["x"]), int(query["y"]))
+
+    # Weather and air pollution, the recorded days are moved to the current ones
+
+    def weather_current(self, query):
+        return 200, self.fixtures["weather"]["current"]
+
+    def weather_forecast(self, query):
+        days = self.fixtures["weather"]["forecast"]["days"]
+
+        if "days" in query:
+            forecast = {
+                (date.today() + timedelta(days=i)).strftime("%Y-%m-%d"): days[i % len(days)]
+                for i in range(int(query["days"]))
+            }
+        else:
+            day = datetime.strptime(query["day"], "%Y-%m-%d").date()
+            forecast = {day.strftime("%Y-%m-%d"): days[(day - date.today()).days % len(days)]}
+
+        return 200, {**forecast, "alerts": self.fixtures["weather"]["forecast"]["alerts"]}
+
+    def air_pollution(self, query):
+        return 200, {**self.fixtures["air_pollution"]["current"], "dt": int(time.time()) // 3600 * 3600}
+
+    def air_pollution_forecast(self, query):
+        # hourly forecasts of the next 4 days from the current hour, like the upstream provider
+        hours = self.fixtures["air_pollution"]["hours"]
+        now = int(time.time()) // 3600 * 3600
+        forecast = [{**hours[(now // 3600 + i) % len(hours)], "dt": now + i * 3600} for i in range(96)]
+
+        if "day" in query:
+            day = datetime.strptime(query["day"], "%Y-%m-%d").date()
+            forecast = [hour for hour in forecast if date.fromtimestamp(hour["dt"]) == day]
+
+        return 200, forecast
+
+    # Geocoding and places
+
+    def geocoding_search(self, query):
+        address = " ".join(query.get("address", "").casefold().split())
+
+        if not address:
+            return 400, {"error": "Address is a required parameter"}
+
+        result = self.fixtures["geocoding"].get(address) or self.fixtures["geocoding"].get(address.split(",")[0].strip())
+        if result is None:
+            return 404, {"error": "Address not found"}
+
+        return 200, result
+
+    def places(self, query):
+        """Returns the recorded places of the categories moved around the location, nearest first"""
+        lat, lon = float(query["lat"]), float(query["lon"])
+        radius = float(query.get("radius", 5000))
+        limit = int(query.get("limit", 20))
+        origin = self.fixtures["places"]["origin"]
+
+        features = []
+        for category in query["categories"].split(","):
+            for feature in self.fixtures["places"]["categories"].get(category, []):
+                properties = feature["properties"]
+                place_lat = round(properties["lat"] - origin["lat"] + lat, 7)
+                place_lon = round(properties["lon"] - origin["lon"] + lon, 7)
+                meters = distance(lat, lon, place_lat, place_lon)
+
+                if meters <= radius:
+                    features.append({
+                        **feature,
+                        "properties": {**properties, "lat": place_lat, "lon": place_lon, "distance": round(meters)},
+                        "geometry": {"type": "Point", "coordinates": [place_lon, place_lat]},
+                    })
+
+        features.sort(key=lambda feature: feature["properties"]["distance"])
+        return 200, features[:limit]
+
+    # Users
+
+    def user(self, method, user_id, form, query):
+        if user_id is None and "after" in query:
+            # a page of the users with a location, like the digest reads them
+            after, limit = int(query["after"]), int(query.get("limit", 100))
+            with self.lock:
+                users = sorted((user for user in self.users.values() if user["id"] > after and user["lat"] is not None),
+                               key=lambda user: user["id"])
+            return 200, users[:limit]
+
+        if user_id is None:
+            ids = [int(user_id) for user_id in query.get("ids", "").split(",") if user_id.strip()]
+            with self.lock:
+                return 200, [self.users[user_id] for user_id in ids if user_id in self.users]
+
+        user_id = int(user_id)
+
+        with self.lock:
+            if method == "GET":
+                if user_id not in self.users:
+                    return 404, {"error": "User not found"}
+                return 200, self.users[user_id]
+
+            if method == "POST":
+                return 200, self.users.setdefault(user_id, {"id": user_id, "lat": None, "lon": None})
+
+            if method == "PATCH":
+                self.users[user_id] = {"id": user_id, "lat": float(form["lat"]), "lon": float(form["lon"])}
+                return 200, self.users[user_id]
+
+        return 404, {"error": "Not found"}
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {"calls": dict(self.calls), "throttled": dict(self.throttled), "tiles": len(self.tiles),
+                    "users": len(self.users)}
+
+
+class Server(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 128
+
+
+def serve(fake, host="127.0.0.1", port=8083) -> ThreadingHTTPServer:
+    """Starts serving the fake data layer in a background thread"""
+
+    class Handler(BaseHTTPRequestHandler):
+        # keep-alive connections, like the data layer
+        protocol_version = "HTTP/1.1"
+
+        def handle_request(self):
+            url = urlsplit(self.path)
+
+            if url.path == "/stats":
+                self.reply(200, "application/json", json.dumps(fake.stats()).encode())
+                return
+
+            query = {name: values[0] for name, values in parse_qs(url.query).items()}
+            body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            if self.headers.get("Content-Type", "").startswith("application/json"):
+                form = json.loads(body or b"{}")
+            else:
+                form = {name: values[0] for name, values in parse_qs(body.decode()).items()}
+
+            self.reply(*fake.answer(self.command, url.path, query, form))
+
+        do_GET = do_POST = do_PATCH = handle_request
+
+        def reply(self, status, content_type, body):
+            self.send_response(status)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+            if self.headers.get("X-Request-ID"):
+                self.send_header("X-Request-ID", self.headers["X-Request-ID"])
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = Server((host, port), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def parse_route_latency(values) -> dict:
+    """Parses route=milliseconds pairs into seconds by route"""
+    route_latency = {}
+
+    for value in values or []:
+        route, _, milliseconds = value.partition("=")
+        route_latency[route] = float(milliseconds) / 1000
+
+    return route_latency
+
+
+def add_arguments(parser, port_option="--data-layer-port") -> None:
+    """Adds the options of the fake data layer to the parser of a harness"""
+    parser.add_argument(port_option, dest="data_layer_port", type=int, default=8083, help="port of the fake data layer")
+    parser.add_argument("--latency", type=float, default=50, help="milliseconds of latency of every data layer route")
+    parser.add_argument("--route-latency", action="append", metavar="ROUTE=MS",
+                        help="latency of a route (map, weather, air_pollution, geocoding, places, user), repeatable")
+    parser.add_argument("--jitter", type=float, default=0.2, help="variation of the latency, as a fraction of it")
+    parser.add_argument("--quota", action="append", metavar="PROVIDER=RPS",
+                        help=f"requests per second of a provider ({', '.join(sorted(set(PROVIDERS.values())))}), "
+                             "answering 429 beyond them, repeatable")
+    parser.add_argument("--icons", help="directory where to write the weather icons, for ICON_WARM_DIR")
+
+
+def start(args, host="127.0.0.1") -> FakeDataLayer:
+    """Starts the fake data layer configured by the options of `add_arguments`"""
+    quotas = {provider: int(rate) for provider, _, rate in (item.partition("=") for item in args.quota or [])}
+    fake = FakeDataLayer(args.latency / 1000, parse_route_latency(args.route_latency), args.jitter, quotas=quotas)
+
+    if args.icons:
+        fake.write_icons(args.icons)
+
+    serve(fake, host, args.data_layer_port)
+    return fake
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    add_arguments(parser, "--port")
+    args = parser.parse_args()
+
+    fake = start(args, args.host)
+    print(f"fake data layer listening on http://{args.host}:{args.data_layer_port}/api")
+
+    try:
+        while True:
+            time.sleep(10)
+            print(json.dumps(fake.stats()))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
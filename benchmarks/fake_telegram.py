@@ -0,0 +1,215 @@
+"""Local stand-in of the Telegram Bot API, to run and load test the bot without Telegram.
+
+Answers the methods used by the bot on /bot<token>/<method>. The updates queued
+with `push` are delivered by getUpdates, for the polling mode, while every call of
+the bot is counted and notified to the listeners with its chat, so that the replies
+to an update can be timed.
+
+    python3 benchmarks/fake_telegram.py [--port 8081]
+
+then start the bot with TELEGRAM_API_URL=http://localhost:8081/bot.
+"""
+import argparse
+import email
+import json
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+METHOD_PATH = re.compile(r"^/bot[^/]+/(\w+)$")
+
+# Methods that edit or send a message, answered with the message
+MESSAGE_METHODS = {
+    "sendMessage",
+    "sendPhoto",
+    "editMessageText",
+    "editMessageCaption",
+    "editMessageReplyMarkup",
+    "editMessageMedia",
+}
+
+
+def parse_parameters(content_type, body):
+    """Returns the parameters of a JSON, form or multipart request, files as their size in bytes"""
+    if not body:
+        return {}
+
+    if content_type.startswith("application/json"):
+        return json.loads(body)
+
+    if content_type.startswith("multipart/form-data"):
+        message = email.message_from_bytes(f"Content-Type: {content_type}\r\n\r\n".encode() + body)
+        parameters = {}
+
+        for part in message.get_payload():
+            name = part.get_param("name", header="content-disposition")
+            payload = part.get_payload(decode=True)
+
+            if part.get_filename():
+                parameters[name] = len(payload)
+            else:
+                parameters[name] = payload.decode()
+
+        return parameters
+
+    return {key: value for key, value in (item.split("=", 1) for item in body.decode().split("&") if "=" in item)}
+
+
+class FakeTelegram:
+    """State of the fake Bot API: queued updates, sent messages and counters of the calls"""
+
+    def __init__(self) -> None:
+        self.updates = []
+        self.condition = threading.Condition()
+        self.lock = threading.Lock()
+        self.listeners = []
+
+        self.next_message_id = 1
+        self.next_file_id = 1
+        self.calls = {}
+        self.uploaded_bytes = 0
+        self.webhook_url = None
+
+    def push(self, update) -> None:
+        """Queues an update for getUpdates"""
+        with self.condition:
+            self.updates.append(update)
+            self.condition.notify_all()
+
+    def get_updates(self, offset=None, timeout=0, limit=100) -> list:
+        """Long polls the queued updates, confirming the ones before `offset`"""
+        deadline = time.monotonic() + float(timeout or 0)
+
+        with self.condition:
+            if offset is not None:
+                self.updates = [update for update in self.updates if update["update_id"] >= int(offset)]
+
+            while not self.updates and time.monotonic() < deadline:
+                self.condition.wait(deadline - time.monotonic())
+
+            return self.updates[:int(limit or 100)]
+
+    def message(self, method, parameters) -> dict:
+        with self.lock:
+            message_id = parameters.get("message_id") or self.next_message_id
+            self.next_message_id += 1
+
+            message = {
+                "message_id": int(message_id),
+                "date": int(time.time()),
+                "chat": {"id": int(parameters["chat_id"]), "type": "private"},
+                "from": {"id": 1, "is_bot": True, "first_name": "Bot"},
+            }
+
+            if "text" in parameters:
+                message["text"] = parameters["text"]
+
+            if method == "editMessageMedia":
+                # the new photo is an attached file, referenced by the name of its part, or a file_id
+                media = parameters.get("media")
+                media = json.loads(media) if isinstance(media, str) else media
+                photo = media["media"]
+                if photo.startswith("attach://"):
+                    photo = parameters.get(photo[len("attach://"):], 0)
+                parameters = {**parameters, "photo": photo, "caption": media.get("caption")}
+
+            if method in ("sendPhoto", "editMessageMedia"):
+                photo = parameters.get("photo")
+
+                # a new upload gets a new file_id, an existing file_id is sent again as is
+                if isinstance(photo, int):
+                    self.uploaded_bytes += photo
+                    photo = f"photo-{self.next_file_id}"
+                    self.next_file_id += 1
+
+                message["photo"] = [{"file_id": photo, "file_unique_id": photo, "width": 512, "height": 512}]
+                if parameters.get("caption") is not None:
+                    message["caption"] = parameters["caption"]
+
+        return message
+
+    def call(self, method, parameters):
+        """Answers a Bot API method"""
+        with self.lock:
+            self.calls[method] = self.calls.get(method, 0) + 1
+
+        if method == "getUpdates":
+            return self.get_updates(parameters.get("offset"), parameters.get("timeout"), parameters.get("limit"))
+
+        if method == "getMe":
+            return {"id": 1, "is_bot": True, "first_name": "Bot", "username": "fake_bot"}
+
+        if method == "setWebhook":
+            self.webhook_url = parameters.get("url")
+            return True
+
+        if method == "deleteWebhook":
+            self.webhook_url = None
+            return True
+
+        result = self.message(method, parameters) if method in MESSAGE_METHODS else True
+
+        if "chat_id" in parameters:
+            for listener in self.listeners:
+                listener(method, int(parameters["chat_id"]), time.monotonic())
+
+        return result
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {"calls": dict(self.calls), "uploaded_bytes": self.uploaded_bytes}
+
+
+def serve(telegram, host="127.0.0.1", port=8081) -> ThreadingHTTPServer:
+    """Starts serving the fake Bot API in a background thread"""
+
+    class Handler(BaseHTTPRequestHandler):
+
+        def do_POST(self):
+            match = METHOD_PATH.match(self.path.split("?")[0])
+            if not match:
+                self.send_error(404)
+                return
+
+            body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            parameters = parse_parameters(self.headers.get("Content-Type", ""), body)
+            response = json.dumps({"ok": True, "result": telegram.call(match.group(1), parameters)}).encode()
+
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(response)))
+            self.end_headers()
+            self.wfile.write(response)
+
+        do_GET = do_POST
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8081)
+    args = parser.parse_args()
+
+    telegram = FakeTelegram()
+    serve(telegram, args.host, args.port)
+    print(f"fake Telegram listening on http://{args.host}:{args.port}/bot")
+
+    try:
+        while True:
+            time.sleep(10)
+            print(json.dumps(telegram.stats()))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
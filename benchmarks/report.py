@@ -0,0 +1,91 @@
+"""Measures shared by the load harnesses: latency percentiles, peak memory and the stored results.
+
+Every run of a harness appends a JSON line to a results file (`benchmarks/results.jsonl`
+by default) with the commit it measured, so that runs can be compared across commits
+with `benchmarks/compare.py`.
+"""
+import json
+import os
+import statistics
+import subprocess
+import time
+
+DEFAULT_RESULTS = os.path.join(os.path.dirname(os.path.abspath(__file__)), "results.jsonl")
+
+
+def percentiles(values) -> dict:
+    """Returns the p50, p95, p99 and max of the values in milliseconds, an empty dict without values"""
+    if not values:
+        return {}
+    if len(values) == 1:
+        return {"p50": values[0] * 1000, "p95": values[0] * 1000, "p99": values[0] * 1000, "max": values[0] * 1000}
+
+    quantiles = statistics.quantiles(values, n=100, method="inclusive")
+    return {
+        "p50": quantiles[49] * 1000,
+        "p95": quantiles[94] * 1000,
+        "p99": quantiles[98] * 1000,
+        "max": max(values) * 1000,
+    }
+
+
+def format_percentiles(latencies) -> str:
+    if not latencies:
+        return "n/a"
+
+    return ", ".join(f"{name} {value:.0f} ms" for name, value in latencies.items())
+
+
+def peak_rss(pid) -> int:
+    """Returns the peak resident memory in bytes of the process and of its children, like the server workers.
+
+    The peaks of the processes are summed, although they may not be simultaneous.
+    Returns None if the process does not exist (the memory is read from /proc, on Linux only).
+    """
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            peak = next(int(line.split()[1]) * 1024 for line in f if line.startswith("VmHWM:"))
+    except (OSError, StopIteration):
+        return None
+
+    children = []
+    try:
+        for task in os.listdir(f"/proc/{pid}/task"):
+            with open(f"/proc/{pid}/task/{task}/children") as f:
+                children.extend(int(child) for child in f.read().split())
+    except OSError:
+        pass
+
+    return peak + sum(peak_rss(child) or 0 for child in children)
+
+
+def git_commit() -> dict:
+    """Returns the commit of the working tree and whether it has uncommitted changes"""
+    directory = os.path.dirname(os.path.abspath(__file__))
+
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=directory,
+                                capture_output=True, text=True, check=True).stdout.strip()
+        status = subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"], cwd=directory,
+                                capture_output=True, text=True, check=True).stdout
+    except (OSError, subprocess.CalledProcessError):
+        return {"commit": None, "dirty": None}
+
+    return {"commit": commit, "dirty": bool(status.strip())}
+
+
+def save(path, benchmark, parameters, results, label=None) -> dict:
+    """Appends the results of a run, with its commit and parameters, to the results file"""
+    run = {
+        "benchmark": benchmark,
+        **git_commit(),
+        "label": label,
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "parameters": parameters,
+        "results": results,
+    }
+
+    with open(path, "a") as f:
+        f.write(json.dumps(run) + "\n")
+
+    return run
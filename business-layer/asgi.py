@@ -0,0 +1,226 @@
+"""Production serving mode of the business layer.
+
+The map, weather, report, places and user resources are served by Starlette
+handlers on several server processes. The upstream calls are still blocking
+`requests` calls run on the fetch pool of `main.py`, so a process sends at most
+FETCH_WORKERS of them at once like the Flask application, while the PIL
+compositing runs on a separate worker pool. The blocking code of the handlers,
+which may wait for jobs of the fetch pool, runs on a pool of its own. Every other route, like the
+documentation and the statistics, is served by the Flask application, so the API
+contract is the same as `main.py`.
+
+Run with `python3 asgi.py`, the number of server processes is set by SERVER_WORKERS.
+"""
+import asyncio
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial, wraps
+
+import requests as r
+import uvicorn
+from a2wsgi import WSGIMiddleware
+from starlette.applications import Starlette
+from starlette.responses import JSONResponse, Response
+from starlette.routing import Mount, Route
+from werkzeug.exceptions import HTTPException
+
+import compositing
+import main
+import metrics
+import quota
+from main import (
+    FETCH_TIMEOUT,
+    FETCH_WORKERS,
+    SERVER_PORT,
+    abort,
+    fetch_pool,
+    get_air_pollution,
+    get_day,
+    get_image_format,
+    get_weather,
+    image_etag,
+    map_stages,
+    request_latency,
+    request_priority,
+    response_bytes,
+    run_before,
+    verify_location,
+)
+
+# Number of server processes, of threads composing the maps and of threads running the blocking code of the handlers
+# of each process
+SERVER_WORKERS = int(os.getenv('SERVER_WORKERS', os.cpu_count()))
+RENDER_WORKERS = int(os.getenv('RENDER_WORKERS', os.cpu_count()))
+HANDLER_WORKERS = int(os.getenv('HANDLER_WORKERS', 4 * FETCH_WORKERS))
+
+render_pool = ThreadPoolExecutor(max_workers=RENDER_WORKERS)
+# the handlers wait for their fetch jobs, they cannot take the threads of the fetch pool
+handler_pool = ThreadPoolExecutor(max_workers=HANDLER_WORKERS)
+
+map_overlay = main.MapOverlay()
+weather_info = main.WeatherInfo()
+report = main.Report()
+recommended_places = main.RecommendedPlaces()
+user = main.User()
+
+async def run_in(pool, function, *args, **kwargs):
+    """Runs the blocking function on the given pool without blocking the event loop, in the current context"""
+    job = metrics.in_context(partial(function, *args, **kwargs))
+    return await asyncio.get_running_loop().run_in_executor(pool, job)
+
+def instrumented(handler_name):
+    """Records the latency and the size of the responses of the handler, like the Flask application does"""
+
+    def decorator(handler):
+        @wraps(handler)
+        async def endpoint(request):
+            started = time.perf_counter()
+            metrics.trace.set(request.headers.get(metrics.TRACE_HEADER) or metrics.new_trace_id())
+            quota.priority.set(request_priority(request.headers))
+            status = 500
+
+            try:
+                response = await handler(request)
+                status = response.status_code
+                response.headers[metrics.TRACE_HEADER] = metrics.trace.get()
+                response_bytes.inc(len(response.body), handler=handler_name)
+                return response
+            except HTTPException as e:
+                status = e.code
+                raise
+            finally:
+                request_latency.observe(time.perf_counter() - started, handler=handler_name, method=request.method,
+                                        status=status)
+
+        return endpoint
+
+    return decorator
+
+async def fetch_all(jobs, timeout=FETCH_TIMEOUT):
+    """Awaits the given fetch jobs together, the asynchronous counterpart of `main.fetch_all`"""
+    deadline = time.monotonic() + timeout
+    tasks = [run_in(fetch_pool, run_before, deadline, job) for job in jobs.values()]
+
+    try:
+        results = await asyncio.wait_for(asyncio.gather(*tasks), timeout)
+    except asyncio.TimeoutError:
+        abort(504, "The data layer did not answer in time")
+    except quota.QuotaExceededError as e:
+        abort(503, f"The quota of the data providers is exhausted, retry later: {e}")
+    except r.RequestException as e:
+        abort(502, f"The data layer returned an error: {e}")
+
+    return dict(zip(jobs.keys(), results))
+
+async def render(coordinates, day, jobs, image_format="png"):
+    """Asynchronous counterpart of `MapOverlay.render`"""
+    layout = map_overlay.layout(coordinates, day)
+
+    with map_stages.time(stage="fetch"):
+        contents = await fetch_all({**jobs, **layout["jobs"]})
+    icon_url = map_overlay.icon_url(contents["weather"])
+    image = await run_in(render_pool, map_overlay.finish, layout, icon_url, contents, image_format)
+
+    return image, contents
+
+def serve_image(request, content, mimetype='image/png', negotiated=False):
+    """Converts the encoded image to a response, answering 304 if the client has it already.
+
+    A `negotiated` format was chosen from the Accept header, which the caches must then take into account.
+    """
+    etag = f'"{image_etag(content)}"'
+    headers = {"ETag": etag}
+    if negotiated:
+        headers["Vary"] = "Accept"
+
+    if etag in request.headers.get("if-none-match", "").split(", "):
+        return Response(status_code=304, headers=headers)
+
+    return Response(content, media_type=mimetype, headers=headers)
+
+@instrumented("mapoverlay")
+async def get_map(request):
+    args = request.query_params
+
+    coordinates = await run_in(handler_pool, verify_location, args)
+    day = get_day(args)
+    image_format = get_image_format(args.get("format"), request.headers.get("accept"))
+
+    jobs = {
+        "weather": partial(get_weather, coordinates, day),
+    }
+
+    image, _ = await render(coordinates, day, jobs, image_format)
+
+    return serve_image(request, image, compositing.FORMATS[image_format][1], negotiated=not args.get("format"))
+
+@instrumented("weatherinfo")
+async def get_weather_info(request):
+    args = request.query_params
+
+    coordinates = await run_in(handler_pool, verify_location, args)
+    day = get_day(args)
+
+    contents = await fetch_all({
+        "weather": partial(get_weather, coordinates, day),
+        "air_pollution": partial(get_air_pollution, coordinates, day),
+    })
+
+    return JSONResponse(weather_info.report(contents["weather"], contents["air_pollution"], day))
+
+@instrumented("report")
+async def get_report(request):
+    args = request.query_params
+
+    coordinates = await run_in(handler_pool, verify_location, args)
+    day = get_day(args)
+
+    contents = await fetch_all({
+        "weather": partial(get_weather, coordinates, day),
+        "air_pollution": partial(get_air_pollution, coordinates, day),
+    })
+
+    return JSONResponse(report.report(coordinates, day, contents))
+
+@instrumented("recommendedplaces")
+async def get_places(request):
+    return JSONResponse(await run_in(handler_pool, recommended_places.places, request.query_params))
+
+@instrumented("user")
+async def user_location(request):
+    user_id = request.path_params["user_id"]
+
+    if request.method == "PATCH":
+        args = await request.json()
+        return JSONResponse(await run_in(handler_pool, user.update, user_id, args))
+
+    return JSONResponse(await run_in(handler_pool, user.get, user_id))
+
+async def http_error(request, exc):
+    """Formats the errors like Flask-RESTful does"""
+    return JSONResponse({"message": exc.description}, status_code=exc.code,
+                        headers={metrics.TRACE_HEADER: metrics.trace.get() or ""})
+
+app = Starlette(
+    routes=[
+        Route("/api/v1/map", get_map),
+        Route("/api/v1/weather", get_weather_info),
+        Route("/api/v1/report", get_report),
+        Route("/api/v1/places", get_places),
+        Route("/api/v1/user/{user_id}", user_location, methods=["GET", "PATCH"]),
+        Mount("/", WSGIMiddleware(main.app)),
+    ],
+    exception_handlers={
+        HTTPException: http_error,
+    },
+)
+
+
+if __name__ == '__main__':
+    # a map referenced by a report is requested next from any of the processes
+    if SERVER_WORKERS > 1 and not main.SHARED_CACHE_DIR:
+        raise SystemExit("Set SHARED_CACHE_DIR to serve with several processes (SERVER_WORKERS), so that they share "
+                         "the rendered maps")
+
+    uvicorn.run("asgi:app", host='0.0.0.0', port=SERVER_PORT, workers=SERVER_WORKERS)
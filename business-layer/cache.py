@@ -0,0 +1,476 @@
+import hashlib
+import json
+import mmap
+import os
+import sqlite3
+import threading
+import time
+import zlib
+from collections import OrderedDict
+
+
+class LRUCache:
+    """In-memory least recently used cache bounded by the total size of its values.
+
+    With `max_ttl`, no value is kept longer than `max_ttl` seconds, whatever its own
+    lifetime: in front of a shared tier, a value changed by another process is read
+    again from there once the copy of the process expires.
+    """
+
+    def __init__(self, max_bytes, sizeof=len, max_ttl=None) -> None:
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof
+        self.max_ttl = max_ttl
+        self.size = 0
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        """Returns the cached value or None if missing or expired"""
+        return self.lookup(key)[0]
+
+    def lookup(self, key, stale=0):
+        """Returns the cached value and its expiration time, also if it expired less than `stale` seconds ago.
+
+        Returns (None, None) if the value is missing or expired for longer.
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+
+            if entry is None:
+                self.misses += 1
+                return None, None
+
+            value, size, expires = entry
+            if expires is not None and expires <= time.time():
+                if expires + stale <= time.time():
+                    self._remove(key)
+                    self.misses += 1
+                    return None, None
+
+                self.stale_hits += 1
+            else:
+                self.hits += 1
+
+            self.entries.move_to_end(key)
+            return value, expires
+
+    def set(self, key, value, ttl=None) -> None:
+        """Stores the value, evicting the least recently used entries if needed"""
+        size = self.sizeof(value)
+        if size > self.max_bytes:
+            return
+
+        if self.max_ttl is not None:
+            ttl = self.max_ttl if ttl is None else min(ttl, self.max_ttl)
+        expires = time.time() + ttl if ttl is not None else None
+
+        with self.lock:
+            if key in self.entries:
+                self._remove(key)
+
+            self.entries[key] = (value, size, expires)
+            self.size += size
+
+            while self.size > self.max_bytes:
+                oldest = next(iter(self.entries))
+                self._remove(oldest)
+                self.evictions += 1
+
+    def delete(self, key) -> None:
+        with self.lock:
+            if key in self.entries:
+                self._remove(key)
+
+    def _remove(self, key) -> None:
+        _, size, _ = self.entries.pop(key)
+        self.size -= size
+
+    def stats(self) -> dict:
+        return {
+            "entries": len(self.entries),
+            "bytes": self.size,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "stale_hits": self.stale_hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+
+class DiskCache:
+    """File system cache of byte values, files are named after the digest of their key.
+
+    The expiration time of an entry is stored as the modification time of its file.
+    """
+
+    NEVER = 2 ** 31 - 1
+    name = "disk"
+
+    def __init__(self, directory) -> None:
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def path(self, key) -> str:
+        digest = hashlib.sha1(repr(key).encode()).hexdigest()
+        return os.path.join(self.directory, digest[:2], digest)
+
+    def get(self, key):
+        return self.lookup(key)[0]
+
+    def lookup(self, key, stale=0):
+        """Returns the cached value and its expiration time, (None, None) if missing or expired for `stale` seconds"""
+        path = self.path(key)
+
+        try:
+            expires = os.stat(path).st_mtime
+            if expires + stale <= time.time():
+                os.remove(path)
+                self.evictions += 1
+                self.misses += 1
+                return None, None
+
+            with open(path, 'rb') as f:
+                value = f.read()
+        except FileNotFoundError:
+            self.misses += 1
+            return None, None
+
+        self.hits += 1
+        return value, expires
+
+    def set(self, key, value, ttl=None) -> None:
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        # write to a temporary file first so that readers never see partial content
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(value)
+
+        expires = time.time() + ttl if ttl is not None else self.NEVER
+        os.utime(tmp_path, (expires, expires))
+        os.replace(tmp_path, path)
+
+    def delete(self, key) -> None:
+        try:
+            os.remove(self.path(key))
+        except FileNotFoundError:
+            pass
+
+    def stats(self) -> dict:
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+
+class TieredCache:
+    """Memory cache backed by optional lower tiers, like a disk cache or a cache shared by the processes.
+
+    A value found in a lower tier is copied to the memory tier, also when the memory
+    tier has an expired copy only, so that a value refreshed by another process is
+    used rather than fetched again. The values are set in all the tiers.
+    """
+
+    def __init__(self, memory, *tiers) -> None:
+        self.memory = memory
+        self.tiers = [tier for tier in tiers if tier is not None]
+
+    def get(self, key):
+        return self.lookup(key)[0]
+
+    def lookup(self, key, stale=0):
+        """Returns the cached value and whether it expired, the values are kept `stale` seconds longer"""
+        value, expires = self.memory.lookup(key, stale)
+        now = time.time()
+
+        if value is None or (expires is not None and expires <= now):
+            for tier in self.tiers:
+                lower, lower_expires = tier.lookup(key, stale)
+
+                if lower is not None and (value is None or lower_expires is None or lower_expires > expires):
+                    value, expires = lower, lower_expires
+                    self.memory.set(key, value, expires - now if expires is not None else None)
+                    break
+
+        return value, expires is not None and expires <= now
+
+    def set(self, key, value, ttl=None) -> None:
+        self.memory.set(key, value, ttl)
+
+        for tier in self.tiers:
+            tier.set(key, value, ttl)
+
+    def get_or_load(self, key, loader, ttl=None):
+        """Returns the cached value, calling `loader` to fill the cache on miss"""
+        value = self.get(key)
+
+        if value is None:
+            value = loader()
+            self.set(key, value, ttl)
+
+        return value
+
+    def stats(self) -> dict:
+        stats = {"memory": self.memory.stats()}
+
+        for tier in self.tiers:
+            stats[tier.name] = tier.stats()
+
+        return stats
+
+
+class SharedStore:
+    """Byte values shared by the processes of a host, in a memory-mapped file of `max_bytes` indexed by SQLite.
+
+    The file is split in slabs of `slab_size` bytes written as a ring: a value takes
+    the next slabs, evicting the oldest values when the ring wraps around onto them.
+    The index, a SQLite database in WAL mode next to the file, maps every key to its
+    slabs, its expiration and the checksum of its value. The writes of all the
+    processes are serialized by the write lock of the database, the reads copy the
+    value out of the file without locks and discard it if a write replaced it meanwhile.
+    """
+
+    def __init__(self, directory, max_bytes, slab_size=4096) -> None:
+        os.makedirs(directory, exist_ok=True)
+
+        self.slab_size = slab_size
+        self.slabs = max_bytes // slab_size
+        self.max_bytes = self.slabs * slab_size
+        # a value takes at most a quarter of the ring
+        self.max_slabs = max(self.slabs // 4, 1)
+
+        fd = os.open(os.path.join(directory, "slabs"), os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            if os.fstat(fd).st_size < self.max_bytes:
+                os.ftruncate(fd, self.max_bytes)
+            self.map = mmap.mmap(fd, self.max_bytes)
+        finally:
+            os.close(fd)
+
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(os.path.join(directory, "index.sqlite3"), timeout=30, check_same_thread=False,
+                                  isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        # the index describes a cache, it does not need to survive a crash of the host
+        self.db.execute("PRAGMA synchronous=OFF")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY, slab INTEGER NOT NULL, slabs INTEGER NOT NULL, "
+            "length INTEGER NOT NULL, expires REAL, checksum INTEGER NOT NULL)"
+        )
+        self.db.execute("CREATE INDEX IF NOT EXISTS entries_slab ON entries (slab)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS ring (id INTEGER PRIMARY KEY CHECK (id = 0), head INTEGER NOT NULL)")
+        self.db.execute("INSERT OR IGNORE INTO ring (id, head) VALUES (0, 0)")
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.overwritten = 0
+
+    def lookup(self, key, stale=0):
+        """Returns the value and its expiration time, (None, None) if missing or expired for `stale` seconds"""
+        with self.lock:
+            row = self.db.execute(
+                "SELECT slab, length, expires, checksum FROM entries WHERE key = ?", (key,)
+            ).fetchone()
+
+        if row is None:
+            self.misses += 1
+            return None, None
+
+        slab, length, expires, checksum = row
+        start = slab * self.slab_size
+
+        if (expires is not None and expires + stale <= time.time()) or start + length > self.max_bytes:
+            self.misses += 1
+            return None, None
+
+        value = self.map[start:start + length]
+
+        if zlib.crc32(value) != checksum:
+            self.overwritten += 1
+            self.misses += 1
+            return None, None
+
+        self.hits += 1
+        return value, expires
+
+    def set(self, key, value, ttl=None) -> None:
+        """Stores the value in the next slabs of the ring, evicting the values stored there"""
+        slabs = max(-(-len(value) // self.slab_size), 1)
+        if slabs > self.max_slabs:
+            return
+
+        expires = time.time() + ttl if ttl is not None else None
+        checksum = zlib.crc32(value)
+
+        with self.lock:
+            self.db.execute("BEGIN IMMEDIATE")
+
+            try:
+                head = self.db.execute("SELECT head FROM ring").fetchone()[0]
+                if head + slabs > self.slabs:
+                    head = 0
+
+                evicted = self.db.execute(
+                    "DELETE FROM entries WHERE slab > ? AND slab < ? AND slab + slabs > ?",
+                    (head - self.max_slabs, head + slabs, head),
+                ).rowcount
+
+                start = head * self.slab_size
+                self.map[start:start + len(value)] = value
+
+                self.db.execute(
+                    "INSERT OR REPLACE INTO entries (key, slab, slabs, length, expires, checksum) "
+                    "VALUES (?, ?, ?, ?, ?, ?)",
+                    (key, head, slabs, len(value), expires, checksum),
+                )
+                self.db.execute("UPDATE ring SET head = ?", (head + slabs,))
+                self.db.execute("COMMIT")
+            except BaseException:
+                self.db.execute("ROLLBACK")
+                raise
+
+            self.evictions += evicted
+
+    def delete(self, key) -> None:
+        with self.lock:
+            self.db.execute("DELETE FROM entries WHERE key = ?", (key,))
+
+    def stats(self) -> dict:
+        with self.lock:
+            entries, size = self.db.execute("SELECT COUNT(*), COALESCE(SUM(length), 0) FROM entries").fetchone()
+
+        return {
+            "mmap": {
+                "entries": entries,
+                "bytes": size,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "overwritten": self.overwritten,
+            },
+        }
+
+
+class SharedCache:
+    """Tier of a TieredCache kept in a SharedStore, in its own namespace.
+
+    `dumps` and `loads` convert the values to and from bytes, by default the values
+    are bytes already.
+    """
+
+    name = "shared"
+
+    def __init__(self, store, namespace, dumps=None, loads=None) -> None:
+        self.store = store
+        self.namespace = namespace
+        self.dumps = dumps
+        self.loads = loads
+
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, key) -> str:
+        return f"{self.namespace}:{key!r}"
+
+    def get(self, key):
+        return self.lookup(key)[0]
+
+    def lookup(self, key, stale=0):
+        value, expires = self.store.lookup(self.key(key), stale)
+
+        if value is None:
+            self.misses += 1
+            return None, None
+
+        self.hits += 1
+        return (self.loads(value) if self.loads else value), expires
+
+    def set(self, key, value, ttl=None) -> None:
+        self.store.set(self.key(key), self.dumps(value) if self.dumps else value, ttl)
+
+    def delete(self, key) -> None:
+        self.store.delete(self.key(key))
+
+    def stats(self) -> dict:
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+
+class SQLiteCache:
+    """Persistent cache of JSON serializable values stored in a SQLite database"""
+
+    def __init__(self, path, table='cache') -> None:
+        self.table = table
+        self.lock = threading.Lock()
+
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute(f"CREATE TABLE IF NOT EXISTS {table} (key TEXT PRIMARY KEY, value TEXT, expires REAL)")
+        self.db.commit()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        with self.lock:
+            row = self.db.execute(f"SELECT value, expires FROM {self.table} WHERE key = ?", (key,)).fetchone()
+
+            if row is None:
+                self.misses += 1
+                return None
+
+            value, expires = row
+            if expires is not None and expires <= time.time():
+                self.db.execute(f"DELETE FROM {self.table} WHERE key = ?", (key,))
+                self.db.commit()
+                self.evictions += 1
+                self.misses += 1
+                return None
+
+            self.hits += 1
+            return json.loads(value)
+
+    def set(self, key, value, ttl=None) -> None:
+        expires = time.time() + ttl if ttl is not None else None
+
+        with self.lock:
+            self.db.execute(
+                f"INSERT OR REPLACE INTO {self.table} (key, value, expires) VALUES (?, ?, ?)",
+                (key, json.dumps(value), expires),
+            )
+            self.db.commit()
+
+    def delete(self, key) -> None:
+        with self.lock:
+            self.db.execute(f"DELETE FROM {self.table} WHERE key = ?", (key,))
+            self.db.commit()
+
+    def stats(self) -> dict:
+        with self.lock:
+            entries = self.db.execute(f"SELECT COUNT(*) FROM {self.table}").fetchone()[0]
+
+        return {
+            "sqlite": {
+                "entries": entries,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            },
+        }
@@ -0,0 +1,248 @@
+import os
+import threading
+from io import BytesIO
+from urllib.parse import urlsplit
+
+import numpy as np
+from PIL import Image
+
+# Output formats of the maps: PIL format name and mimetype
+FORMATS = {
+    "png": ("PNG", "image/png"),
+    "webp": ("WEBP", "image/webp"),
+    "jpeg": ("JPEG", "image/jpeg"),
+}
+
+
+def decode(content, out=None) -> np.ndarray:
+    """Decodes an encoded image into an RGBA array, or into the `out` array if given"""
+    image = Image.open(BytesIO(content))
+
+    if image.mode != "RGBA":
+        image = image.convert("RGBA")
+
+    if out is None:
+        return np.asarray(image)
+
+    out[...] = image
+    return out
+
+
+def blend(destination, source) -> None:
+    """Alpha blends the RGBA source over the destination array, in place.
+
+    The colors are rounded like PIL `Image.paste` with the source as mask, while the
+    alpha is composited "over" the destination, so an opaque map stays opaque.
+    """
+    alpha = source[..., 3:4].astype(np.uint16)
+
+    # blending 255 in the alpha channel gives alpha + destination alpha * (1 - alpha)
+    source = source.astype(np.uint16)
+    source[..., 3] = 255
+
+    blended = destination.astype(np.uint16) * (255 - alpha)
+    blended += source * alpha
+    blended += 128
+    blended += blended >> 8
+    blended >>= 8
+
+    destination[...] = blended
+
+
+def compose(tiles, overlays=None, tile_size=256) -> np.ndarray:
+    """Decodes a grid of tiles, and of their overlays, straight into a new RGBA canvas.
+
+    `tiles` and `overlays` map the (column, row) of every tile to its encoded content.
+    The overlays are composited over the whole canvas in a single operation, which
+    is skipped when they are fully transparent, like the precipitations of a dry day.
+    """
+    columns = max(i for i, _ in tiles) + 1
+    rows = max(j for _, j in tiles) + 1
+
+    canvas = np.empty((rows * tile_size, columns * tile_size, 4), dtype=np.uint8)
+    for (i, j), content in tiles.items():
+        decode(content, canvas[j * tile_size:(j + 1) * tile_size, i * tile_size:(i + 1) * tile_size])
+
+    if overlays:
+        # the tiles without an overlay stay transparent
+        overlay = np.empty_like(canvas) if len(overlays) == len(tiles) else np.zeros_like(canvas)
+        for (i, j), content in overlays.items():
+            decode(content, overlay[j * tile_size:(j + 1) * tile_size, i * tile_size:(i + 1) * tile_size])
+
+        if overlay[..., 3].any():
+            # on the whole canvas the C implementation of PIL is faster than NumPy arithmetic
+            canvas = np.array(Image.alpha_composite(Image.fromarray(canvas, "RGBA"), Image.fromarray(overlay, "RGBA")))
+
+    return canvas
+
+
+def paste(canvas, image, offset) -> None:
+    """Alpha blends the RGBA image on the canvas at the given (x, y) offset, clipping at the borders"""
+    x, y = offset
+    height, width = image.shape[:2]
+
+    left, top = max(x, 0), max(y, 0)
+    right, bottom = min(x + width, canvas.shape[1]), min(y + height, canvas.shape[0])
+
+    if left >= right or top >= bottom:
+        return
+
+    blend(
+        canvas[top:bottom, left:right],
+        image[top - y:bottom - y, left - x:right - x],
+    )
+
+
+def encode(canvas, image_format="png", png_compress_level=6, quality=80) -> bytes:
+    """Encodes the RGBA canvas in the given format"""
+    pil_format, _ = FORMATS[image_format]
+    image = Image.fromarray(canvas, "RGBA")
+    output = BytesIO()
+
+    if image_format == "png":
+        image.save(output, pil_format, compress_level=png_compress_level)
+    elif image_format == "jpeg":
+        image.convert("RGB").save(output, pil_format, quality=quality)
+    else:
+        image.save(output, pil_format, quality=quality)
+
+    return output.getvalue()
+
+
+def choose_format(requested=None, accept=None) -> str:
+    """Returns the requested output format, or the first supported one of the Accept header.
+
+    PNG is returned when neither asks for a supported format.
+    """
+    if requested:
+        requested = requested.lower()
+        return "jpeg" if requested == "jpg" else requested
+
+    if accept:
+        ranges = []
+        for media_range in accept.split(","):
+            mimetype, *params = [part.strip() for part in media_range.split(";")]
+            quality = 1.0
+            for param in params:
+                if param.startswith("q="):
+                    try:
+                        quality = float(param[2:])
+                    except ValueError:
+                        quality = 0.0
+            ranges.append((quality, mimetype))
+
+        # stable sort: ranges with the same quality keep the order of the header
+        for quality, mimetype in sorted(ranges, key=lambda media_range: -media_range[0]):
+            if quality <= 0 or mimetype in ("*/*", "image/*"):
+                break
+            for image_format, (_, format_mimetype) in FORMATS.items():
+                if mimetype == format_mimetype:
+                    return image_format
+
+    return "png"
+
+
+class IconStore:
+    """Icons decoded and resized once, kept in memory and optionally persisted on disk.
+
+    Icons are identified by the last two segments of their url, like "day/113.png"
+    for the weather condition icons, so that a directory with the same layout can
+    be used to load them in advance. With a `shared` cache tier, the resized pixels
+    are also shared with the other processes, which then skip the download.
+    """
+
+    def __init__(self, size, loader, directory=None, shared=None) -> None:
+        self.size = size
+        self.loader = loader
+        self.directory = directory
+        self.shared = shared
+        self.icons = {}
+        self.lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, url) -> str:
+        segments = [segment for segment in urlsplit(url).path.split("/") if segment not in ("", ".", "..")]
+        return "/".join(segments[-2:])
+
+    def get(self, url, timeout=None) -> np.ndarray:
+        """Returns the resized RGBA icon of the url, downloading it only the first time"""
+        key = self.key(url)
+        icon = self.icons.get(key)
+
+        if icon is not None:
+            self.hits += 1
+            return icon
+
+        self.misses += 1
+
+        if self.shared is not None:
+            pixels = self.shared.get((self.size, key))
+            if pixels is not None:
+                icon = np.frombuffer(pixels, dtype=np.uint8).reshape(self.size, self.size, 4)
+                with self.lock:
+                    self.icons[key] = icon
+                return icon
+
+        path = os.path.join(self.directory, key) if self.directory else None
+
+        if path and os.path.isfile(path):
+            with open(path, 'rb') as f:
+                icon = self.add(key, f.read())
+        else:
+            icon = self.add(key, self.loader(url, timeout=timeout))
+
+        if self.shared is not None:
+            self.shared.set((self.size, key), icon.tobytes())
+
+        if path and not os.path.isfile(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            Image.fromarray(icon, "RGBA").save(path, "PNG")
+
+        return icon
+
+    def add(self, key, content) -> np.ndarray:
+        """Decodes and resizes the icon, then keeps it in memory"""
+        image = Image.open(BytesIO(content)).convert("RGBA")
+
+        if image.size != (self.size, self.size):
+            image = image.resize((self.size, self.size))
+
+        icon = np.asarray(image)
+
+        with self.lock:
+            self.icons[key] = icon
+
+        return icon
+
+    def warm(self, directory) -> int:
+        """Loads all the PNG icons of the directory, returns how many were loaded"""
+        loaded = 0
+
+        for root, _, files in os.walk(directory):
+            for name in files:
+                if not name.endswith(".png"):
+                    continue
+
+                path = os.path.join(root, name)
+                key = self.key(os.path.relpath(path, directory).replace(os.sep, "/"))
+                with open(path, 'rb') as f:
+                    self.add(key, f.read())
+                loaded += 1
+
+        return loaded
+
+    def stats(self) -> dict:
+        stats = {
+            "memory": {
+                "entries": len(self.icons),
+                "hits": self.hits,
+                "misses": self.misses,
+            },
+        }
+
+        if self.shared is not None:
+            stats[self.shared.name] = self.shared.stats()
+
+        return stats
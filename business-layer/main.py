@@ -1,43 +1,462 @@
-from flask import Flask, send_file, request, abort
+from flask import Flask, request, abort, g
 from flask_restful import Resource, Api
 from flask_swagger_ui import get_swaggerui_blueprint
 from datetime import datetime, date, timedelta
+from concurrent.futures import ThreadPoolExecutor, wait
+from functools import partial
 import requests as r
+import hashlib
+import json
 import math
-from PIL import Image
-from io import BytesIO
+import os
+import random
+import threading
+import time
+import unicodedata
+
+import compositing
+import metrics
+import popularity
+import quota
+import spatial
+from cache import LRUCache, DiskCache, TieredCache, SQLiteCache, SharedStore, SharedCache
+from client import Client, SingleFlight
 
 # Configuration and constants
-DATA_LAYER_URL = 'http://data-layers/api'
+DATA_LAYER_URL = os.getenv('DATA_LAYER_URL', 'http://data-layers/api')
 LAYER_ADAPTER_URL = f'{DATA_LAYER_URL}/adapters/v1'
 LAYER_DATABASE_URL = f'{DATA_LAYER_URL}/db/v1'
 
+# Port of the HTTP server
+SERVER_PORT = int(os.getenv('SERVER_PORT', 80))
+
+# Concurrent upstream fetches: size of the shared pool and time budget (seconds) of a request
+FETCH_WORKERS = int(os.getenv('FETCH_WORKERS', 32))
+FETCH_TIMEOUT = float(os.getenv('FETCH_TIMEOUT', 10))
+
+# HTTP client: connections kept alive, timeouts (seconds), retries of failed requests and
+# consecutive failures opening the circuit of a route for BREAKER_RESET seconds
+POOL_SIZE = int(os.getenv('POOL_SIZE', FETCH_WORKERS))
+CONNECT_TIMEOUT = float(os.getenv('CONNECT_TIMEOUT', 3.05))
+READ_TIMEOUT = float(os.getenv('READ_TIMEOUT', FETCH_TIMEOUT))
+RETRIES = int(os.getenv('RETRIES', 2))
+RETRY_BACKOFF = float(os.getenv('RETRY_BACKOFF', 0.1))
+BREAKER_THRESHOLD = int(os.getenv('BREAKER_THRESHOLD', 5))
+BREAKER_RESET = float(os.getenv('BREAKER_RESET', 30))
+
+# Quotas of the upstream providers: requests per second and burst of each, 0 disables the quota of a provider,
+# and paths of the data layer adapters calling them. Requests wait up to QUOTA_WAIT seconds for their turn,
+# the interactive ones before the prefetches and refreshes, while the precipitation overlays are dropped first.
+UPSTREAM_QUOTAS = {
+    "weatherapi": (float(os.getenv('WEATHERAPI_RATE', 10)), int(os.getenv('WEATHERAPI_BURST', 20))),
+    "openweathermap": (float(os.getenv('OPENWEATHERMAP_RATE', 1)), int(os.getenv('OPENWEATHERMAP_BURST', 60))),
+    "geoapify": (float(os.getenv('GEOAPIFY_RATE', 5)), int(os.getenv('GEOAPIFY_BURST', 10))),
+    "nominatim": (float(os.getenv('NOMINATIM_RATE', 1)), int(os.getenv('NOMINATIM_BURST', 1))),
+}
+UPSTREAM_PROVIDERS = {
+    "weather": "weatherapi",
+    "air_pollution": "openweathermap",
+    "map/precipitations": "openweathermap",
+    "map": "geoapify",
+    "places": "geoapify",
+    "geocoding": "nominatim",
+}
+DROPPABLE_PATHS = {"map/precipitations"}
+QUOTA_WAIT = float(os.getenv('QUOTA_WAIT', 5))
+# Header of the callers asking for the background priority
+PRIORITY_HEADER = 'X-Priority'
+
+# Tile cache: memory budget (bytes), optional disk directory and time to live (seconds) per layer.
+# Precipitation tiles expire together with the radar refresh interval, the lifetime of the other tiles is shortened by
+# a random fraction up to TILE_TTL_JITTER, so that the tiles cached together are not fetched again together.
+TILE_CACHE_BYTES = int(os.getenv('TILE_CACHE_BYTES', 64 * 1024 * 1024))
+TILE_CACHE_DIR = os.getenv('TILE_CACHE_DIR')
+TILE_TTL = {
+    "map": int(os.getenv('MAP_TILE_TTL', 7 * 24 * 60 * 60)),
+    "precipitations": int(os.getenv('PRECIPITATION_TILE_TTL', 10 * 60)),
+}
+TILE_PATH = {
+    "map": "map",
+    "precipitations": "map/precipitations",
+}
+TILE_TTL_JITTER = float(os.getenv('TILE_TTL_JITTER', 0.1))
+
+# Cache shared by the server processes of the host (SERVER_WORKERS): directory of its memory-mapped file and of its
+# index, preferably in shared memory like /dev/shm (disabled if not set), and size (bytes) of the file. The tiles,
+# icons, maps and upstream data fetched by a process are then found there by the other ones.
+SHARED_CACHE_DIR = os.getenv('SHARED_CACHE_DIR')
+SHARED_CACHE_BYTES = int(os.getenv('SHARED_CACHE_BYTES', 256 * 1024 * 1024))
+
+# Rendered maps cache: memory budget (bytes) of the composed canvases and of the encoded images
+CANVAS_CACHE_BYTES = int(os.getenv('CANVAS_CACHE_BYTES', 64 * 1024 * 1024))
+RESPONSE_CACHE_BYTES = int(os.getenv('RESPONSE_CACHE_BYTES', 32 * 1024 * 1024))
+
+# Maps referenced by the reports, rendered in background while the report is answered: memory budget (bytes) of the
+# rendered ones, time (seconds) they can be fetched for, references kept in memory and maps rendered at once
+RENDERED_MAP_CACHE_BYTES = int(os.getenv('RENDERED_MAP_CACHE_BYTES', 16 * 1024 * 1024))
+RENDERED_MAP_TTL = int(os.getenv('RENDERED_MAP_TTL', 10 * 60))
+RENDERED_MAP_REFERENCES = int(os.getenv('RENDERED_MAP_REFERENCES', 100000))
+RENDERED_MAP_WORKERS = int(os.getenv('RENDERED_MAP_WORKERS', 4))
+
+# Geocoding cache: database file and time to live (seconds) of found and not found locations
+GEOCODING_CACHE_FILE = os.getenv('GEOCODING_CACHE_FILE', 'geocoding.sqlite3')
+GEOCODING_TTL = int(os.getenv('GEOCODING_TTL', 30 * 24 * 60 * 60))
+GEOCODING_NOT_FOUND_TTL = int(os.getenv('GEOCODING_NOT_FOUND_TTL', 60 * 60))
+
+# Encoding of the maps: zlib level of PNG images (0-9, lower is faster) and quality of WebP and JPEG ones
+PNG_COMPRESS_LEVEL = int(os.getenv('PNG_COMPRESS_LEVEL', 6))
+IMAGE_QUALITY = int(os.getenv('IMAGE_QUALITY', 80))
+
+# Weather icons: size (pixels) on the map, directory where the resized icons are kept, and optional directory with the
+# icons to load at startup, with the same "day/113.png" layout as the weatherapi.com icon set
+ICON_SIZE = 80
+ICON_CACHE_DIR = os.getenv('ICON_CACHE_DIR')
+ICON_WARM_DIR = os.getenv('ICON_WARM_DIR')
+
+# Spatial buckets: zoom of the tile grid whose cells share the weather, air pollution and places
+# (a cell is about 1.2 km wide at zoom 15 on the equator, less towards the poles)
+BUCKET_ZOOM = int(os.getenv('BUCKET_ZOOM', 15))
+
+# Current conditions: lifetime (seconds) of the current weather and air pollution of a cell and cells kept in memory
+CURRENT_TTL = int(os.getenv('CURRENT_TTL', 10 * 60))
+CURRENT_CACHE_ENTRIES = int(os.getenv('CURRENT_CACHE_ENTRIES', 10000))
+CURRENT_PATHS = {
+    "weather": "weather/current",
+    "air_pollution": "air_pollution",
+}
+
+# Forecasts of the day navigation: days fetched at once (today and the 3 following ones) and cells
+# kept in memory. They expire every hour.
+FORECAST_DAYS = 4
+FORECAST_TTL = 60 * 60
+FORECAST_CACHE_ENTRIES = int(os.getenv('FORECAST_CACHE_ENTRIES', 10000))
+
+# Stale data: time (seconds) after their expiration the current conditions, the forecasts and the precipitation maps
+# are still served, while they are refreshed in background
+CURRENT_STALE = int(os.getenv('CURRENT_STALE', 5 * 60))
+FORECAST_STALE = int(os.getenv('FORECAST_STALE', 30 * 60))
+PRECIPITATION_STALE = int(os.getenv('PRECIPITATION_STALE', TILE_TTL["precipitations"]))
+
+# Hot locations: cells and maps tracked by request frequency, the HOT_LOCATIONS most requested ones of each are
+# refreshed REFRESH_AHEAD seconds before their data expires (0 disables the refresh)
+HOT_LOCATIONS = int(os.getenv('HOT_LOCATIONS', 100))
+REFRESH_AHEAD = float(os.getenv('REFRESH_AHEAD', 30))
+
+# Recommended places: radius (meters) and number of the places returned, radius and number of the places
+# fetched for every category around a location, lifetime (seconds) and number of the fetched areas kept in memory
+PLACES_RADIUS = 5000
+PLACES_LIMIT = 5
+PLACES_FETCH_RADIUS = int(os.getenv('PLACES_FETCH_RADIUS', 10000))
+PLACES_FETCH_LIMIT = int(os.getenv('PLACES_FETCH_LIMIT', 50))
+PLACES_TTL = int(os.getenv('PLACES_TTL', 24 * 60 * 60))
+PLACES_INDEX_AREAS = int(os.getenv('PLACES_INDEX_AREAS', 10000))
+PLACE_CATEGORIES = {
+    "restaurants": "catering.restaurant",
+    "parks": "leisure.park",
+    "museums": "entertainment.museum",
+    "sights": "tourism.sights",
+}
+
+# User profiles: lifetime (seconds) and number of the favourite locations kept in memory, and users per batch lookup
+USER_TTL = int(os.getenv('USER_TTL', 10 * 60))
+USER_CACHE_ENTRIES = int(os.getenv('USER_CACHE_ENTRIES', 100000))
+# With several processes, seconds the memory of a process keeps a location read from the shared cache
+USER_MEMORY_TTL = int(os.getenv('USER_MEMORY_TTL', 5))
+USER_BATCH_SIZE = 500
+
+# Sampling profiler: when enabled, /debug/profile?seconds=N samples the stacks of all the threads for N seconds
+PROFILER_ENABLED = os.getenv('PROFILER_ENABLED', 'false').lower() == 'true'
+
 SWAGGER_URL = '/api/docs'
 OPENAPI_FILE = '/static/openapi.yaml'
 SWAGGER_CONFIG ={  
         'app_name': "Business Layer APIs"
     }
 
-def serve_pil_image(pil_img):
-    """Converts the PIL image to a Flask response"""
-    img_io = BytesIO()
-    pil_img.save(img_io, 'PNG')
-    img_io.seek(0)
-    return send_file(img_io, mimetype='image/png')
+def image_etag(content):
+    """Returns the identifier of the encoded image"""
+    return hashlib.sha1(content).hexdigest()
 
-def get_coordinates(location):
-    """Get coordinates from location using the geocoding service"""
+def serve_image(content, mimetype='image/png', negotiated=False):
+    """Converts the encoded image to a Flask response, answering 304 if the client has it already.
+
+    A `negotiated` format was chosen from the Accept header, which the caches must then take into account.
+    """
+    response = app.response_class(content, mimetype=mimetype)
+    response.set_etag(image_etag(content))
+    if negotiated:
+        response.vary.add("Accept")
+    return response.make_conditional(request)
+
+fetch_pool = ThreadPoolExecutor(max_workers=FETCH_WORKERS)
+# the renders wait for their fetch jobs, they cannot take the threads of the fetch pool
+rendered_map_pool = ThreadPoolExecutor(max_workers=RENDERED_MAP_WORKERS)
+
+# Metrics exposed on /metrics: latency of the handlers and of the map rendering stages, the upstream requests
+# are recorded by the client and the caches and pools are read on every scrape
+registry = metrics.Registry()
+request_latency = registry.histogram("http_request_duration_seconds", "Latency of the requests by handler")
+response_bytes = registry.counter("http_response_bytes_total", "Bytes sent in the responses by handler")
+map_stages = registry.histogram("map_render_stage_seconds", "Time spent in every stage of the map rendering")
+profiler = metrics.SamplingProfiler()
+
+upstream_quotas = quota.QuotaScheduler(
+    {provider: limits for provider, limits in UPSTREAM_QUOTAS.items() if limits[0] > 0},
+    UPSTREAM_PROVIDERS,
+    DROPPABLE_PATHS,
+    QUOTA_WAIT,
+    registry=registry,
+)
+
+data_layer = Client(
+    pool_size=POOL_SIZE,
+    connect_timeout=CONNECT_TIMEOUT,
+    read_timeout=READ_TIMEOUT,
+    retries=RETRIES,
+    backoff=RETRY_BACKOFF,
+    breaker_threshold=BREAKER_THRESHOLD,
+    breaker_reset=BREAKER_RESET,
+    limiter=upstream_quotas,
+    registry=registry,
+)
+
+def get_content(url, params=None, timeout=FETCH_TIMEOUT):
+    """Downloads the raw content of the given url"""
+    res = data_layer.get(url, params=params, timeout=timeout)
+    res.raise_for_status()
+    return res.content
+
+def get_json(url, params=None, timeout=FETCH_TIMEOUT):
+    """Returns the decoded JSON answer of the given url"""
+    res = data_layer.get(url, params=params, timeout=timeout)
+    res.raise_for_status()
+    return res.json()
+
+shared_store = SharedStore(SHARED_CACHE_DIR, SHARED_CACHE_BYTES) if SHARED_CACHE_DIR else None
+
+def shared_tier(namespace, dumps=None, loads=None):
+    """Returns the tier of the namespace in the cache shared by the processes, None if it is disabled"""
+    return SharedCache(shared_store, namespace, dumps, loads) if shared_store else None
+
+def json_dumps(value):
+    return json.dumps(value).encode()
+
+tile_cache = TieredCache(
+    LRUCache(TILE_CACHE_BYTES),
+    shared_tier("tiles"),
+    DiskCache(TILE_CACHE_DIR) if TILE_CACHE_DIR else None,
+)
+
+# Rendered maps: canvases of the 2x2 tiles without the icon and the final PNG images
+canvas_cache = TieredCache(LRUCache(CANVAS_CACHE_BYTES, sizeof=lambda canvas: canvas.nbytes))
+response_cache = TieredCache(LRUCache(RESPONSE_CACHE_BYTES), shared_tier("responses"))
+geocoding_cache = SQLiteCache(GEOCODING_CACHE_FILE, table='geocoding')
+
+# Maps referenced by the report resource, by map id: with several processes a map may be requested from another one
+# than the process that answered the report
+rendered_maps = TieredCache(LRUCache(RENDERED_MAP_CACHE_BYTES), shared_tier("rendered_maps"))
+# Location, day and weather icon of the maps referenced by the reports, by map id
+map_references = TieredCache(
+    LRUCache(RENDERED_MAP_REFERENCES, sizeof=lambda reference: 1),
+    shared_tier("map_references", json_dumps, json.loads),
+)
+
+icon_store = compositing.IconStore(ICON_SIZE, get_content, ICON_CACHE_DIR, shared_tier("icons"))
+
+for directory in (ICON_CACHE_DIR, ICON_WARM_DIR):
+    if directory and os.path.isdir(directory):
+        icon_store.warm(directory)
+
+# Upstream data by cell of the spatial grid: current conditions and forecasts of the next days by hour
+current_cache = TieredCache(
+    LRUCache(CURRENT_CACHE_ENTRIES, sizeof=lambda conditions: 1),
+    shared_tier("current", json_dumps, json.loads),
+)
+forecast_cache = TieredCache(
+    LRUCache(FORECAST_CACHE_ENTRIES, sizeof=lambda forecast: 1),
+    shared_tier("forecasts", json_dumps, json.loads),
+)
+
+# Places fetched around the requested locations, answering the requests of the same and of nearby locations
+place_index = spatial.PlaceIndex(PLACES_INDEX_AREAS)
+
+# Favourite locations of the users, read through on lookup and written through on change: with several processes
+# the memory copy is short lived, so that a location changed through a process is soon used by the others
+user_cache = TieredCache(
+    LRUCache(USER_CACHE_ENTRIES, sizeof=lambda user: 1, max_ttl=USER_MEMORY_TTL if shared_store else None),
+    shared_tier("users", json_dumps, json.loads),
+)
+
+# Most requested cells of the spatial grid and quads of map tiles, refreshed before their data expires
+hot_cells = popularity.TopKeys(HOT_LOCATIONS)
+hot_maps = popularity.TopKeys(HOT_LOCATIONS)
+refresh_stats = {"refreshed": 0, "failures": 0}
+
+# Caches whose statistics are exposed by the stats resource
+caches = {
+    "tiles": tile_cache,
+    "canvases": canvas_cache,
+    "responses": response_cache,
+    "rendered_maps": rendered_maps,
+    "map_references": map_references,
+    "geocoding": geocoding_cache,
+    "icons": icon_store,
+    "current": current_cache,
+    "forecasts": forecast_cache,
+    "places": place_index,
+    "users": user_cache,
+    "hot_cells": hot_cells,
+    "hot_maps": hot_maps,
+}
+
+if shared_store is not None:
+    caches["shared"] = shared_store
+
+def precipitation_frame(ahead=0):
+    """Returns the index of the current precipitation refresh interval, or of the one in `ahead` seconds"""
+    return int((time.time() + ahead) // TILE_TTL["precipitations"])
+
+def expiry(period, ahead=0):
+    """Returns the seconds until the end of the interval of `period` seconds containing the time in `ahead` seconds"""
+    return period - (time.time() + ahead) % period + ahead
+
+def tile_ttl(layer):
+    """Returns the lifetime of a tile of the layer fetched now"""
+    if layer == "precipitations":
+        # the radar frames change on a schedule, all the tiles of a frame expire with it
+        return expiry(TILE_TTL[layer])
+
+    return TILE_TTL[layer] * (1 - random.uniform(0, TILE_TTL_JITTER))
+
+refreshing = set()
+refreshing_lock = threading.Lock()
+
+def revalidate(key, load):
+    """Runs `load` in background to refresh the cached value of the key, unless it is being refreshed already"""
+    with refreshing_lock:
+        if key in refreshing:
+            return
+        refreshing.add(key)
+
+    def run():
+        try:
+            load()
+        except quota.QuotaExceededError:
+            app.logger.info("Refresh of %s dropped, the quota of its provider is exhausted", key)
+        except Exception:
+            app.logger.exception("Could not refresh %s", key)
+        finally:
+            with refreshing_lock:
+                refreshing.discard(key)
+
+    fetch_pool.submit(metrics.in_context(quota.background(run)))
+
+def get_or_revalidate(cache, key, load, stale, timeout=FETCH_TIMEOUT):
+    """Returns the cached value, serving it up to `stale` seconds after its expiration while it is refreshed.
+
+    `load` fetches the value and caches it, on miss it is called right away.
+    """
+    value, expired = cache.lookup(key, stale)
+
+    if value is None:
+        return load(timeout=timeout)
+
+    if expired:
+        revalidate(key, load)
+
+    return value
+
+def get_tile(layer, zoom, x, y, timeout=FETCH_TIMEOUT):
+    """Returns the content of a map tile, downloading it only on cache miss"""
     parameters = {
-        'address': location
+        'x': x,
+        'y': y,
+        'zoom': zoom,
     }
 
-    res = r.get(f"{LAYER_ADAPTER_URL}/geocoding/search", params=parameters)
+    return tile_cache.get_or_load(
+        (layer, zoom, x, y),
+        lambda: get_content(f"{LAYER_ADAPTER_URL}/{TILE_PATH[layer]}", parameters, timeout=timeout),
+        tile_ttl(layer),
+    )
+
+def get_overlay_tile(layer, zoom, x, y, timeout=FETCH_TIMEOUT):
+    """Returns the content of an overlay tile, or None if it was dropped to save the quota of its provider"""
+    try:
+        return get_tile(layer, zoom, x, y, timeout=timeout)
+    except quota.QuotaExceededError:
+        return None
+
+def run_before(deadline, job):
+    """Runs the fetch job with the time left until the deadline (monotonic) as timeout, fails if there is none left"""
+    remaining = deadline - time.monotonic()
+    if remaining <= 0:
+        raise r.Timeout("The deadline of the request passed before the fetch started")
+
+    return job(timeout=remaining)
+
+def fetch_all(jobs, timeout=FETCH_TIMEOUT):
+    """Runs the given fetch jobs concurrently and returns their results by key.
+
+    Every job is a callable accepting a `timeout` keyword, the whole batch must
+    complete within `timeout` seconds, otherwise the request is aborted. The jobs
+    get the time left when they start: the queued ones are cancelled on abort, the
+    running ones cannot be and keep their thread of the pool until their timeout.
+    """
+    deadline = time.monotonic() + timeout
+    futures = {
+        key: fetch_pool.submit(metrics.in_context(partial(run_before, deadline, job))) for key, job in jobs.items()
+    }
+    _, not_done = wait(futures.values(), timeout=timeout)
+
+    if not_done:
+        for future in not_done:
+            future.cancel()
+        abort(504, "The data layer did not answer in time")
+
+    try:
+        return {key: future.result() for key, future in futures.items()}
+    except quota.QuotaExceededError as e:
+        abort(503, f"The quota of the data providers is exhausted, retry later: {e}")
+    except r.RequestException as e:
+        abort(502, f"The data layer returned an error: {e}")
+
+def normalize_query(query):
+    """Normalizes a free text query so that equivalent spellings share the same cache key"""
+    return " ".join(unicodedata.normalize("NFKC", query).casefold().split())
+
+def get_coordinates(location):
+    """Get coordinates from location using the geocoding service"""
+    key = normalize_query(location)
+    cached = geocoding_cache.get(key)
+
+    if cached is None:
+        parameters = {
+            'address': location
+        }
+
+        try:
+            res = data_layer.get(f"{LAYER_ADAPTER_URL}/geocoding/search", params=parameters)
+        except quota.QuotaExceededError as e:
+            abort(503, f"The quota of the geocoding service is exhausted, retry later: {e}")
+
+        # Only remember locations that were found or that do not exist, not upstream failures
+        if res.status_code == 200:
+            cached = {"status": 200, "body": res.json()}
+            geocoding_cache.set(key, cached, GEOCODING_TTL)
+        elif res.status_code == 404:
+            cached = {"status": 404, "body": res.json()}
+            geocoding_cache.set(key, cached, GEOCODING_NOT_FOUND_TTL)
+        elif res.status_code == 429:
+            abort(503, "The quota of the geocoding service is exhausted, retry later")
+        else:
+            cached = {"status": res.status_code, "body": res.json()}
 
     # If the geocoding service returns an error, return the error
-    if res.status_code != 200:
-        abort(404, res.json())
+    if cached["status"] != 200:
+        abort(404, cached["body"])
 
-    return res.json()
+    return cached["body"]
 
 def verify_location(args):
     """Verifies the location and returns the coordinates"""
@@ -62,10 +481,327 @@ def deg2num(lat_deg, lon_deg, zoom):
     ytile = (1.0 - math.asinh(math.tan(lat_rad)) / math.pi) / 2.0 * n
     return (xtile, ytile)
 
+def num2deg(xtile, ytile, zoom):
+    """Converts tile coordinates to coordinates"""
+    n = 2.0 ** zoom
+    lon_deg = xtile / n * 360.0 - 180.0
+    lat_deg = math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * ytile / n))))
+    return (lat_deg, lon_deg)
+
+def bucket(coordinates):
+    """Returns the cell of the spatial grid containing the coordinates and the coordinates of its center.
+
+    Nearby locations share the same cell, so the upstream data is requested for the
+    center of the cell and cached by cell.
+    """
+    x, y = deg2num(float(coordinates["lat"]), float(coordinates["lon"]), BUCKET_ZOOM)
+    cell = (BUCKET_ZOOM, math.floor(x), math.floor(y))
+
+    return cell, cell_center(cell)
+
+def cell_center(cell):
+    """Returns the coordinates of the center of a cell of the spatial grid"""
+    zoom, x, y = cell
+    lat, lon = num2deg(x + 0.5, y + 0.5, zoom)
+
+    return {"lat": round(lat, 6), "lon": round(lon, 6)}
+
+def get_image_format(requested, accept):
+    """Returns the output format of the maps requested by the `format` parameter or the Accept header"""
+    image_format = compositing.choose_format(requested, accept)
+
+    if image_format not in compositing.FORMATS:
+        abort(400, f"Format not supported, use one of: {', '.join(compositing.FORMATS)}")
+
+    return image_format
+
+def get_day(args):
+    """Returns the day requested with the `today` and `delta` parameters, the current day by default"""
+    if args.get('today') and args.get('delta') is not None:
+        return datetime.strptime(args.get('today'), "%Y-%m-%d").date() + timedelta(days=int(args.get('delta')))
+
+    return date.today()
+
+def load_current(kind, cell, ahead=0, timeout=FETCH_TIMEOUT):
+    """Fetches the current conditions of the cell and caches them until the end of their refresh interval"""
+    current = get_json(f"{LAYER_ADAPTER_URL}/{CURRENT_PATHS[kind]}", cell_center(cell), timeout=timeout)
+    current_cache.set((kind, cell), current, expiry(CURRENT_TTL, ahead))
+    return current
+
+def get_current(kind, coordinates, timeout=FETCH_TIMEOUT):
+    """Returns the current conditions of the cell of the coordinates, requesting them once every CURRENT_TTL"""
+    cell, _ = bucket(coordinates)
+
+    return get_or_revalidate(current_cache, (kind, cell), partial(load_current, kind, cell), CURRENT_STALE, timeout)
+
+def get_weather(coordinates, day, timeout=FETCH_TIMEOUT):
+    """Returns the current weather if the day is today, the forecast of the day otherwise"""
+    cell, _ = bucket(coordinates)
+    hot_cells.add(cell)
+
+    # the places are likely to be requested soon from the weather screen
+    prefetch_places(coordinates)
+
+    if day == date.today():
+        # the next days are likely to be requested soon by the day navigation
+        prefetch_forecasts(coordinates)
+
+        return get_current("weather", coordinates, timeout=timeout)['current']
+
+    _, parameters = bucket(coordinates)
+    parameters["day"] = day.strftime("%Y-%m-%d")
+
+    forecast = get_weather_forecast(coordinates, timeout=timeout)
+    if parameters["day"] in forecast:
+        return forecast[parameters["day"]]
+
+    return get_json(f"{LAYER_ADAPTER_URL}/weather/forecast", parameters, timeout=timeout)[parameters["day"]]
+
+def get_air_pollution(coordinates, day, timeout=FETCH_TIMEOUT):
+    """Returns the current air pollution if the day is today, the hourly forecasts of the day otherwise"""
+    if day == date.today():
+        return get_current("air_pollution", coordinates, timeout=timeout)
+
+    _, parameters = bucket(coordinates)
+    parameters["day"] = day.strftime("%Y-%m-%d")
+
+    forecast = get_air_pollution_forecast(coordinates, timeout=timeout)
+    if parameters["day"] in forecast:
+        return forecast[parameters["day"]]
+
+    return get_json(f"{LAYER_ADAPTER_URL}/air_pollution/forecast", parameters, timeout=timeout)
+
+def load_weather_forecast(cell, ahead=0, timeout=FETCH_TIMEOUT):
+    """Fetches the weather forecasts of the next days of the cell by date and caches them until the end of the hour"""
+    parameters = cell_center(cell)
+    parameters["days"] = FORECAST_DAYS
+
+    forecast = get_json(f"{LAYER_ADAPTER_URL}/weather/forecast", parameters, timeout=timeout)
+    forecast = {day: day_forecast for day, day_forecast in forecast.items() if day != "alerts"}
+
+    forecast_cache.set(("weather", cell), forecast, expiry(FORECAST_TTL, ahead))
+    return forecast
+
+def load_air_pollution_forecast(cell, ahead=0, timeout=FETCH_TIMEOUT):
+    """Fetches the hourly air pollution forecasts of the cell by date and caches them until the end of the hour"""
+    forecast = {}
+    for hour in get_json(f"{LAYER_ADAPTER_URL}/air_pollution/forecast", cell_center(cell), timeout=timeout):
+        forecast.setdefault(date.fromtimestamp(hour["dt"]).strftime("%Y-%m-%d"), []).append(hour)
+
+    forecast_cache.set(("air_pollution", cell), forecast, expiry(FORECAST_TTL, ahead))
+    return forecast
+
+FORECAST_LOADERS = {
+    "weather": load_weather_forecast,
+    "air_pollution": load_air_pollution_forecast,
+}
+
+def get_forecast(kind, coordinates, timeout=FETCH_TIMEOUT):
+    """Returns the forecasts of the next days of the cell of the coordinates, fetched in a single request every hour"""
+    cell, _ = bucket(coordinates)
+
+    load = partial(FORECAST_LOADERS[kind], cell)
+    return get_or_revalidate(forecast_cache, (kind, cell), load, FORECAST_STALE, timeout)
+
+def get_weather_forecast(coordinates, timeout=FETCH_TIMEOUT):
+    """Returns the weather forecasts of the next days by date"""
+    return get_forecast("weather", coordinates, timeout=timeout)
+
+def get_air_pollution_forecast(coordinates, timeout=FETCH_TIMEOUT):
+    """Returns the hourly air pollution forecasts grouped by date"""
+    return get_forecast("air_pollution", coordinates, timeout=timeout)
+
+def prefetch_forecasts(coordinates):
+    """Fetches the forecasts of the next days in background, if they are not cached or expired"""
+    cell, _ = bucket(coordinates)
+
+    for kind, load in FORECAST_LOADERS.items():
+        forecast, expired = forecast_cache.lookup((kind, cell), FORECAST_STALE)
+        if forecast is None or expired:
+            revalidate((kind, cell), partial(load, cell))
+
+def fetch_places(category, coordinates, timeout=FETCH_TIMEOUT):
+    """Fetches the places of the category around the coordinates, adding them to the spatial index"""
+    point = (float(coordinates["lat"]), float(coordinates["lon"]))
+    parameters = {
+        'lat': point[0],
+        'lon': point[1],
+        'categories': PLACE_CATEGORIES[category],
+        'radius': PLACES_FETCH_RADIUS,
+        'limit': PLACES_FETCH_LIMIT,
+    }
+
+    places = [{
+        "id": place["properties"].get("place_id") or f'{place["properties"]["lat"]},{place["properties"]["lon"]}',
+        "name": place["properties"].get("name") or place["properties"].get("address_line1"),
+        "lat": place["properties"]["lat"],
+        "lon": place["properties"]["lon"],
+    } for place in get_json(f"{LAYER_ADAPTER_URL}/places", parameters, timeout=timeout)]
+
+    # the places are sorted by distance, when truncated they are all the ones only up to the farthest
+    radius = PLACES_FETCH_RADIUS
+    if len(places) >= PLACES_FETCH_LIMIT:
+        radius = max(spatial.distance(point, (place["lat"], place["lon"])) for place in places)
+
+    place_index.add(category, point, radius, places, PLACES_TTL)
+    return places
+
+def find_places(category, coordinates):
+    """Returns the places of the category nearest to the coordinates, or None if they are not indexed"""
+    point = (float(coordinates["lat"]), float(coordinates["lon"]))
+    return place_index.nearest(category, point, PLACES_RADIUS, PLACES_LIMIT)
+
+def prefetch_places(coordinates):
+    """Fetches in background the places of the categories not indexed around the coordinates yet, unless they are
+    being fetched already for the same cell of the spatial grid"""
+    cell, _ = bucket(coordinates)
+
+    for category in PLACE_CATEGORIES:
+        if find_places(category, coordinates) is None:
+            revalidate(("places", category, cell), partial(fetch_places, category, coordinates))
+
+def load_canvas(quad, ahead=0, timeout=FETCH_TIMEOUT):
+    """Fetches the map tiles and the current precipitation overlays of the 2x2 tiles from the `quad` top left one,
+    and caches their canvas until the end of the precipitation frame"""
+    zoom, x, y = quad
+    tiles = {}
+    overlays = {}
+
+    for i in range(2):
+        for j in range(2):
+            tiles[(i, j)] = get_tile("map", zoom, x + i, y + j, timeout=timeout)
+
+            # the cached precipitation tiles may belong to the previous frame
+            parameters = {'x': x + i, 'y': y + j, 'zoom': zoom}
+            overlays[(i, j)] = get_content(f"{LAYER_ADAPTER_URL}/{TILE_PATH['precipitations']}", parameters, timeout)
+
+    canvas = compositing.compose(tiles, overlays)
+    canvas_cache.set((quad, precipitation_frame(ahead)), canvas, expiry(TILE_TTL["precipitations"], ahead))
+    return canvas
+
+def refresh_hot_locations():
+    """Refreshes the data of the most requested cells and maps REFRESH_AHEAD seconds before it expires, forever"""
+    # refresh interval and refresh jobs of every kind of data
+    refreshes = {
+        "current": (CURRENT_TTL, lambda: [
+            partial(load_current, kind, cell, REFRESH_AHEAD) for cell in hot_cells.keys() for kind in CURRENT_PATHS
+        ]),
+        "forecasts": (FORECAST_TTL, lambda: [
+            partial(load, cell, REFRESH_AHEAD) for cell in hot_cells.keys() for load in FORECAST_LOADERS.values()
+        ]),
+        "precipitations": (TILE_TTL["precipitations"], lambda: [
+            partial(load_canvas, quad, REFRESH_AHEAD) for quad in hot_maps.keys()
+        ]),
+    }
+
+    while True:
+        now = time.time()
+        due = {}
+        for kind, (period, _) in refreshes.items():
+            at = now - now % period + period - REFRESH_AHEAD
+            due[kind] = at if at > now else at + period
+        wake = min(due.values())
+
+        while time.time() < wake:
+            time.sleep(wake - time.time())
+
+        jobs = [job for kind, at in due.items() if at <= wake for job in refreshes[kind][1]()]
+        futures = [fetch_pool.submit(quota.background(job)) for job in jobs]
+        wait(futures)
+
+        for future in futures:
+            refresh_stats["failures" if future.exception() else "refreshed"] += 1
+
+if HOT_LOCATIONS > 0 and REFRESH_AHEAD > 0:
+    threading.Thread(target=refresh_hot_locations, name="refresh", daemon=True).start()
+
+# Counters kept by the caches, the pools and the background refresh, read on every scrape
+CACHE_COUNTERS = ("hits", "stale_hits", "misses", "evictions", "admissions", "resets")
+CACHE_GAUGES = ("entries", "bytes", "places")
+
+def collect_caches():
+    """Yields the counters of the caches by cache and tier, with their hit ratio"""
+    for name, cache in caches.items():
+        for tier, stats in cache.stats().items():
+            labels = {"cache": name, "tier": tier}
+
+            for key in CACHE_COUNTERS:
+                if key in stats:
+                    yield f"cache_{key}_total", "counter", f"Cache {key.replace('_', ' ')}", labels, stats[key]
+
+            for key in CACHE_GAUGES:
+                if key in stats:
+                    yield f"cache_{key}", "gauge", f"Cache {key}", labels, stats[key]
+
+            lookups = stats.get("hits", 0) + stats.get("stale_hits", 0) + stats.get("misses", 0)
+            if lookups:
+                ratio = (stats["hits"] + stats.get("stale_hits", 0)) / lookups
+                yield "cache_hit_ratio", "gauge", "Share of the cache lookups answered by the cache", labels, ratio
+
+def collect_pools():
+    """Yields the utilization of the fetch pool and the background refresh counters"""
+    # the executor does not expose its threads and queue otherwise
+    yield "fetch_pool_threads", "gauge", "Threads started by the fetch pool", {}, len(fetch_pool._threads)
+    yield "fetch_pool_max_threads", "gauge", "Maximum threads of the fetch pool", {}, FETCH_WORKERS
+    yield "fetch_pool_queued", "gauge", "Fetch jobs waiting for a thread", {}, fetch_pool._work_queue.qsize()
+    yield "refresh_in_progress", "gauge", "Background refreshes running", {}, len(refreshing)
+
+    for result, count in refresh_stats.items():
+        yield "refresh_total", "counter", "Hot location refreshes by result", {"result": result}, count
+
+registry.collect(collect_caches)
+registry.collect(collect_pools)
+
 # Flask configuration
 app = Flask(__name__)
 app.register_blueprint(get_swaggerui_blueprint(SWAGGER_URL, OPENAPI_FILE, SWAGGER_CONFIG))
 api = Api(app, prefix="/api/v1")
+
+def request_priority(headers):
+    """Returns the priority of the upstream requests of a request, lowered by callers in batch like the digest"""
+    return quota.BACKGROUND if headers.get(PRIORITY_HEADER, '').lower() == 'background' else quota.INTERACTIVE
+
+@app.before_request
+def start_trace():
+    """Adopts the trace id of the caller, or starts a new trace"""
+    g.started = time.perf_counter()
+    metrics.trace.set(request.headers.get(metrics.TRACE_HEADER) or metrics.new_trace_id())
+    quota.priority.set(request_priority(request.headers))
+
+@app.after_request
+def record_request(response):
+    """Records the latency and the size of the response and returns the trace id to the caller"""
+    handler = request.endpoint or "unknown"
+
+    if "started" in g:
+        request_latency.observe(time.perf_counter() - g.started, handler=handler, method=request.method,
+                                status=response.status_code)
+    if not response.is_streamed:
+        response_bytes.inc(response.calculate_content_length() or 0, handler=handler)
+
+    response.headers[metrics.TRACE_HEADER] = metrics.trace.get()
+    return response
+
+@app.route('/metrics')
+def serve_metrics():
+    """Returns the metrics in the Prometheus text format"""
+    return app.response_class(registry.render(), content_type=metrics.CONTENT_TYPE)
+
+@app.route('/debug/profile')
+def serve_profile():
+    """Samples the stacks of all the threads for the requested seconds and returns them folded"""
+    if not PROFILER_ENABLED:
+        abort(404)
+
+    folded = profiler.profile(
+        min(float(request.args.get('seconds', 10)), 300),
+        float(request.args.get('interval', 0.01)),
+    )
+
+    if folded is None:
+        abort(409, "A profile is running already")
+
+    return app.response_class(folded, mimetype='text/plain')
     
 class MapOverlay(Resource):
     """Returns a map overlay with the weather icon and precipitation overlay"""
@@ -74,7 +810,7 @@ class MapOverlay(Resource):
         super().__init__()
 
         self.map_size = 256
-        self.icon_size = 80
+        self.icon_size = ICON_SIZE
         self.zoom = 12
 
     def get(self):
@@ -82,12 +818,42 @@ class MapOverlay(Resource):
         args = request.args
         
         coordinates = verify_location(args)
+        calculated_day = get_day(args)
+        image_format = get_image_format(args.get("format"), request.headers.get("Accept"))
 
-        parameters = {
-            'lat': coordinates["lat"],
-            'lon': coordinates["lon"],
+        jobs = {
+            "weather": partial(get_weather, coordinates, calculated_day),
         }
 
+        image, _ = self.render(coordinates, calculated_day, jobs, image_format)
+
+        return serve_image(image, compositing.FORMATS[image_format][1], negotiated=not args.get("format"))
+
+    def render(self, coordinates, calculated_day, jobs, image_format="png"):
+        """Renders the map of the given day, running the given fetch jobs together with the map ones.
+
+        The `jobs` must include the "weather" of the day, the results of all the jobs
+        are returned along with the encoded image.
+        """
+        layout = self.layout(coordinates, calculated_day)
+
+        with map_stages.time(stage="fetch"):
+            contents = fetch_all({**jobs, **layout["jobs"]})
+
+        return self.finish(layout, self.icon_url(contents["weather"]), contents, image_format), contents
+
+    def render_icon(self, coordinates, calculated_day, icon_url, image_format="png"):
+        """Renders the map of the given day with the given weather icon, without fetching the weather"""
+        layout = self.layout(coordinates, calculated_day)
+
+        with map_stages.time(stage="fetch"):
+            contents = fetch_all(layout["jobs"])
+
+        return self.finish(layout, icon_url, contents, image_format)
+
+    def layout(self, coordinates, calculated_day):
+        """Places the location on the 2x2 tiles and lists the fetch jobs of the tiles not cached yet"""
+
         # get the coordinates of the location in the tile
         x, y = deg2num(float(coordinates["lat"]), float(coordinates["lon"]), self.zoom)
         x_tile = math.floor(x)
@@ -103,46 +869,40 @@ class MapOverlay(Resource):
         if y_location < 0.5:
             y_tile_offset -= 1
 
-        base_canvas = Image.new('RGBA', (self.map_size * 2, self.map_size * 2), (0, 0, 0, 0))
-
-        calculated_day = date.today()
-        if (args.get("today") and args.get("delta")):
-            calculated_day = datetime.strptime(args.get("today"), "%Y-%m-%d").date() + timedelta(int(args.get("delta")))
         is_today = calculated_day == date.today()
 
-        # get the map tiles
-        for i in range(2):
-            for j in range(2):
+        # the canvas only depends on the tiles and, for today, on the current precipitation frame
+        quad = (self.zoom, x_tile + x_tile_offset, y_tile + y_tile_offset)
+        canvas_key = (quad, precipitation_frame() if is_today else None)
+        base_canvas = canvas_cache.get(canvas_key)
+        stale = False
+
+        if is_today:
+            hot_maps.add(quad)
 
-                parameters_tiles = {
-                    'x': x_tile + i + x_tile_offset,
-                    'y': y_tile + j + y_tile_offset,
-                    'zoom': self.zoom
-                }
+            # the canvas of the previous frame is served while the one of the current frame is composed
+            if base_canvas is None:
+                previous = (quad, canvas_key[1] - 1)
+                base_canvas, _ = canvas_cache.lookup(previous, PRECIPITATION_STALE)
 
-                res = r.get(f"{LAYER_ADAPTER_URL}/map", params=parameters_tiles)
-                map_image = Image.open(BytesIO(res.content))
-                
-                if is_today:
-                    res = r.get(f"{LAYER_ADAPTER_URL}/map/precipitations", params=parameters_tiles)
-                    precipitation_overlay = Image.open(BytesIO(res.content))
+                if base_canvas is not None:
+                    canvas_key = previous
+                    stale = True
+                    revalidate((quad, canvas_key[1] + 1), partial(load_canvas, quad))
 
-                    # paste precipitation overlay on map
-                    map_image.paste(precipitation_overlay, (0, 0), precipitation_overlay)
+        # fetch the map tiles and precipitation overlays only if the canvas is missing
+        jobs = {}
 
-                base_canvas.paste(map_image, (i * self.map_size, j * self.map_size))
+        if base_canvas is None:
+            for i in range(2):
+                for j in range(2):
 
-        # get weather icon
-        if is_today:
-            res = r.get(f"{LAYER_ADAPTER_URL}/weather/current", params=parameters)
-            icon_url = "https://" + res.json()['current']['condition']['icon'][2:]
-        else:
-            parameters["day"] = calculated_day.strftime("%Y-%m-%d")
-            res = r.get(f"{LAYER_ADAPTER_URL}/weather/forecast", params=parameters)
-            icon_url = "https://" + res.json()[parameters["day"]]['condition']['icon'][2:]
+                    tile = (self.zoom, x_tile + i + x_tile_offset, y_tile + j + y_tile_offset)
+
+                    jobs[("map", i, j)] = partial(get_tile, "map", *tile)
 
-        weather_icon = Image.open(BytesIO(r.get(icon_url).content))
-        weather_icon = weather_icon.resize((self.icon_size, self.icon_size))
+                    if is_today:
+                        jobs[("precipitations", i, j)] = partial(get_overlay_tile, "precipitations", *tile)
 
         # calculate offset of weather icon
         offset = (
@@ -150,9 +910,131 @@ class MapOverlay(Resource):
             (abs(y_tile_offset) * self.map_size) + int(y_location * self.map_size) - self.icon_size // 2
         )
 
-        base_canvas.paste(weather_icon, offset, weather_icon)
+        return {
+            "is_today": is_today,
+            "canvas_key": canvas_key,
+            "base_canvas": base_canvas,
+            "stale": stale,
+            "offset": offset,
+            "jobs": jobs,
+        }
+
+    def icon_url(self, weather):
+        return "https://" + weather['condition']['icon'][2:]
+
+    def map_id(self, layout, icon_url):
+        """Returns the id of the map of the layout: the same id is the same canvas, weather icon and offset"""
+        return hashlib.sha1(repr((layout["canvas_key"], icon_url, layout["offset"])).encode()).hexdigest()
+
+    def finish(self, layout, icon_url, contents, image_format="png"):
+        """Composes the fetched tiles, if needed, and pastes the weather icon returning the encoded image"""
+        is_today = layout["is_today"]
+        base_canvas = layout["base_canvas"]
+
+        response_key = (layout["canvas_key"], icon_url, layout["offset"], image_format)
+        image = response_cache.get(response_key)
+        complete = True
+
+        if image is None:
+            if base_canvas is None:
+                with map_stages.time(stage="compose"):
+                    base_canvas = self.compose(contents, is_today)
+
+                # without the dropped precipitation overlays the map is not kept, the next one fetches them again
+                complete = all(contents[key] is not None for key in layout["jobs"] if key[0] == "precipitations")
+                if complete:
+                    canvas_cache.set(layout["canvas_key"], base_canvas, self.ttl(is_today))
+
+            with map_stages.time(stage="icon"):
+                weather_icon = fetch_all({"icon": partial(icon_store.get, icon_url)})["icon"]
+
+            # the cached canvas is shared, the icon is pasted on a copy
+            with map_stages.time(stage="paste"):
+                map_image = base_canvas.copy()
+                compositing.paste(map_image, weather_icon, layout["offset"])
+
+            with map_stages.time(stage="encode"):
+                image = compositing.encode(map_image, image_format, PNG_COMPRESS_LEVEL, IMAGE_QUALITY)
+
+            # the maps of a stale canvas would outlive its refresh
+            if not layout["stale"] and complete:
+                response_cache.set(response_key, image, self.ttl(is_today))
+
+        return image
+
+    def compose(self, contents, is_today):
+        """Decodes the map tiles, and the precipitation overlays if needed, into a new canvas"""
+        tiles = {(i, j): contents[("map", i, j)] for i in range(2) for j in range(2)}
+        overlays = None
+
+        if is_today:
+            overlays = {
+                (i, j): contents[("precipitations", i, j)]
+                for i in range(2) for j in range(2) if contents[("precipitations", i, j)] is not None
+            }
+
+        return compositing.compose(tiles, overlays, self.map_size)
+
+    def ttl(self, is_today):
+        """Returns the lifetime of the rendered maps, bound by the lifetime of their tiles"""
+        return tile_ttl("precipitations" if is_today else "map")
+
+class RenderedMap(Resource):
+    """Returns a map referenced by the report resource, joining its render if it is in flight"""
+
+    # renders in flight by map id, started by the report or by the first request of the map
+    renders = SingleFlight()
+
+    def __init__(self) -> None:
+        super().__init__()
+
+        self.map_overlay = MapOverlay()
+
+    def get(self, map_id):
+        try:
+            # a joined render waits as long as a render of its own would
+            image = self.render(map_id, timeout=FETCH_TIMEOUT * 2)
+        except r.Timeout:
+            abort(504, "The map was not rendered in time")
+
+        if image is None:
+            abort(404, "Map not found or expired")
+
+        return serve_image(image)
+
+    def render(self, map_id, timeout=None):
+        """Returns the map of the id, rendering it once from its reference, None if the reference expired"""
+
+        def load():
+            image = rendered_maps.get(map_id)
+
+            if image is None:
+                reference = map_references.get(map_id)
+
+                if reference is None:
+                    return None
+
+                coordinates = {"lat": reference["lat"], "lon": reference["lon"]}
+                day = date.fromisoformat(reference["day"])
+
+                # the icon the id was derived from, the weather may have changed since
+                image = self.map_overlay.render_icon(coordinates, day, reference["icon"])
+                rendered_maps.set(map_id, image, RENDERED_MAP_TTL)
+
+            return image
 
-        return serve_pil_image(base_canvas)
+        return self.renders.do(map_id, load, "rendered_maps", timeout)
+
+    def render_ahead(self, map_id):
+        """Renders the map of the id in background, for the request of the map that follows its report"""
+
+        def run():
+            try:
+                self.render(map_id)
+            except Exception:
+                app.logger.exception("Could not render the map %s", map_id)
+
+        rendered_map_pool.submit(metrics.in_context(run))
 
 class WeatherInfo(Resource):
     """Returns the weather information for the specified location"""
@@ -173,20 +1055,22 @@ class WeatherInfo(Resource):
         args = request.args
         
         coordinates = verify_location(args)
+        day = get_day(args)
 
-        parameters = {
-            'lat': coordinates["lat"],
-            'lon': coordinates["lon"],
-        }
+        contents = fetch_all({
+            "weather": partial(get_weather, coordinates, day),
+            "air_pollution": partial(get_air_pollution, coordinates, day),
+        })
+
+        return self.report(contents["weather"], contents["air_pollution"], day)
+
+    def report(self, weather, air_pollution, day):
+        """Formats the weather and air pollution data of the given day"""
 
         dates = dict()
         info = dict()
 
-        if args.get('today') != None and args.get('delta') != None:
-            dates["today"] = datetime.strptime(args.get('today'), "%Y-%m-%d").date() + timedelta(days=int(args.get('delta')))
-        else:
-            dates["today"] = date.today()
-        
+        dates["today"] = day
         dates["yesterday"] = dates["today"] - timedelta(days=1)
         dates["tomorrow"] = dates["today"] + timedelta(days=1)
 
@@ -199,28 +1083,19 @@ class WeatherInfo(Resource):
             dates["tomorrow"] = None
 
         if dates["today"] == date.today():
-            res = r.get(f"{LAYER_ADAPTER_URL}/weather/current", params=parameters)
-            cur_info = res.json()['current']
-
-            info["temperature"] = f"{cur_info['temp_c']}°C"
-            info["humidity"] = f"{cur_info['humidity']}%"
-            info["precipitation"] = f"{cur_info['precip_mm']}mm"
-            info["weather_condition"] = f"{cur_info['condition']['text']}"
+            info["temperature"] = f"{weather['temp_c']}°C"
+            info["humidity"] = f"{weather['humidity']}%"
+            info["precipitation"] = f"{weather['precip_mm']}mm"
+            info["weather_condition"] = f"{weather['condition']['text']}"
             
-            res = r.get(f"{LAYER_ADAPTER_URL}/air_pollution", params=parameters)
-            info["air_quality"] = self.air_quality[res.json()['main']['aqi']]
+            info["air_quality"] = self.air_quality[air_pollution['main']['aqi']]
         else:
-            parameters["day"] = dates["today"].strftime("%Y-%m-%d")
-            res = r.get(f"{LAYER_ADAPTER_URL}/weather/forecast", params=parameters)
-            day_info = res.json()[parameters['day']]
-
-            info["average_temperature"] = f"{day_info['avgtemp_c']}°C"
-            info["average_humidity"] = f"{day_info['avghumidity']}%"
-            info["chanche_of_precipitation"] = f"{day_info['daily_chance_of_rain']}%"
-            info["weather_condition"] = f"{day_info['condition']['text']}"
+            info["average_temperature"] = f"{weather['avgtemp_c']}°C"
+            info["average_humidity"] = f"{weather['avghumidity']}%"
+            info["chanche_of_precipitation"] = f"{weather['daily_chance_of_rain']}%"
+            info["weather_condition"] = f"{weather['condition']['text']}"
             
-            res = r.get(f"{LAYER_ADAPTER_URL}/air_pollution/forecast", params=parameters)
-            aqi_hour = list(map(lambda x: x['main']['aqi'], res.json()))
+            aqi_hour = list(map(lambda x: x['main']['aqi'], air_pollution))
             aqi_mean = sum(aqi_hour) / len(aqi_hour)
             info["air_quality"] = self.air_quality[round(aqi_mean)]
 
@@ -231,6 +1106,54 @@ class WeatherInfo(Resource):
                 dates[day] = dates[day].strftime("%Y-%m-%d")
 
         return {"info": info, "date": dates}
+
+class Report(Resource):
+    """Returns the weather information together with a reference to the rendered map"""
+
+    def __init__(self) -> None:
+        super().__init__()
+
+        self.map_overlay = MapOverlay()
+        self.rendered_map = RenderedMap()
+        self.weather_info = WeatherInfo()
+
+    def get(self):
+
+        args = request.args
+
+        coordinates = verify_location(args)
+        day = get_day(args)
+
+        contents = fetch_all({
+            "weather": partial(get_weather, coordinates, day),
+            "air_pollution": partial(get_air_pollution, coordinates, day),
+        })
+
+        return self.report(coordinates, day, contents)
+
+    def report(self, coordinates, day, contents):
+        """Formats the report, referencing its map by an id derived from the location, the day and the weather.
+
+        The map is rendered in background from now on, so that its request, which follows the report, joins the
+        render in flight or finds the map rendered already. A client that has the map of the id already, like the
+        bot that keeps the Telegram files of the maps, skips its download.
+        """
+        layout = self.map_overlay.layout(coordinates, day)
+        icon_url = self.map_overlay.icon_url(contents["weather"])
+        map_id = self.map_overlay.map_id(layout, icon_url)
+        reference = {
+            "lat": coordinates["lat"],
+            "lon": coordinates["lon"],
+            "day": day.strftime("%Y-%m-%d"),
+            "icon": icon_url,
+        }
+        map_references.set(map_id, reference, RENDERED_MAP_TTL)
+        self.rendered_map.render_ahead(map_id)
+
+        report = self.weather_info.report(contents["weather"], contents["air_pollution"], day)
+        report["map"] = f"{api.prefix}/map/{map_id}"
+
+        return report
     
 class RecommendedPlaces(Resource):
     """Returns a list of recommended places for the specified location"""
@@ -238,61 +1161,86 @@ class RecommendedPlaces(Resource):
     def __init__(self) -> None:
         super().__init__()
 
-        self.categories = {
-            "restaurants": "catering.restaurant",
-            "parks": "leisure.park",
-            "museums": "entertainment.museum",
-            "sights": "tourism.sights",
-        }
+        self.categories = PLACE_CATEGORIES
 
     def get(self):
+        return self.places(request.args)
 
-        args = request.args
+    def places(self, args):
+        """Returns the places of the requested category around the location"""
 
         if not args.get('category'):
             return abort(400, "Category not specified")
         
+        category = args.get('category')
+        if category not in self.categories:
+            return abort(400, f"Category not supported, use one of: {', '.join(self.categories)}")
+
         coordinates = verify_location(args)
-        
-        parameters = {
-            'lat': coordinates["lat"],
-            'lon': coordinates["lon"],
-            'categories': self.categories[args.get('category')],
-        }
+        places = find_places(category, coordinates)
 
-        res = r.get(f"{LAYER_ADAPTER_URL}/places", params=parameters)
+        if places is None:
+            fetched = fetch_all({category: partial(fetch_places, category, coordinates)})
+            point = (float(coordinates["lat"]), float(coordinates["lon"]))
+            places = spatial.nearest(fetched[category], point, PLACES_RADIUS, PLACES_LIMIT)
 
-        to_return = [{
-            "name": place["properties"].get("name") or place["properties"].get("address_line1"),
-            "lat": place["properties"]["lat"],
-            "lon": place["properties"]["lon"],
-        } for place in res.json()]
+            # the other categories are likely to be requested next
+            prefetch_places(coordinates)
 
-        return to_return
+        return [{
+            "name": place["name"],
+            "lat": place["lat"],
+            "lon": place["lon"],
+        } for place in places]
     
+def user_location(user):
+    """Returns the favourite location of a user of the database"""
+    return {
+        "lon": user["lon"],
+        "lat": user["lat"],
+    }
+
+def get_users(user_ids):
+    """Returns the favourite locations of the existing users by id, with a database request per batch of missing ones"""
+    users = {}
+    missing = []
+
+    for user_id in dict.fromkeys(str(user_id) for user_id in user_ids):
+        user = user_cache.get(user_id)
+        if user is None:
+            missing.append(user_id)
+        else:
+            users[user_id] = user
+
+    for i in range(0, len(missing), USER_BATCH_SIZE):
+        batch = missing[i:i + USER_BATCH_SIZE]
+
+        for user in get_json(f"{LAYER_DATABASE_URL}/user", {"ids": ",".join(batch)}):
+            users[str(user["id"])] = user_location(user)
+            user_cache.set(str(user["id"]), users[str(user["id"])], USER_TTL)
+
+    return users
+
 class User(Resource):
     """Manages the user favourite location"""
 
     def get(self, user_id):
-        """Returns the user favourite location"""
-
-        # Check if user exists
-        res = r.get(f"{LAYER_DATABASE_URL}/user/{user_id}")
+        """Returns the user favourite location, creating the user if it does not exist"""
 
-        # If user does not exist, create it
-        if res.status_code == 404:
-            res = r.post(f"{LAYER_DATABASE_URL}/user/{user_id}")
+        def load():
+            # a single request creates the user if needed and returns it
+            res = data_layer.post(f"{LAYER_DATABASE_URL}/user/{user_id}")
+            res.raise_for_status()
+            return user_location(res.json())
 
-        # Return user info
-        return {
-            "lon": res.json()["lon"],
-            "lat": res.json()["lat"],
-        }
+        return user_cache.get_or_load(user_id, load, USER_TTL)
     
     def patch(self, user_id):
         """Updates the user favourite location"""
-            
-        args = request.get_json()
+        return self.update(user_id, request.get_json())
+
+    def update(self, user_id, args):
+        """Geocodes the location if needed and stores it as the user favourite location"""
 
         coordinates = verify_location(args)
     
@@ -301,19 +1249,65 @@ class User(Resource):
             'lon': coordinates["lon"],
         }
 
-        res = r.patch(f"{LAYER_DATABASE_URL}/user/{user_id}", data=parameters)
+        res = data_layer.patch(f"{LAYER_DATABASE_URL}/user/{user_id}", data=parameters)
+        res.raise_for_status()
 
-        return {
-            "lon": res.json()["lon"],
-            "lat": res.json()["lat"],
-        }
+        user = user_location(res.json())
+        user_cache.set(user_id, user, USER_TTL)
+
+        return user
+
+def get_users_page(after, limit):
+    """Returns the users with a favourite location and an id greater than `after`, ordered by id"""
+    users = get_json(f"{LAYER_DATABASE_URL}/user", {"after": after, "limit": limit})
+
+    # the users are likely to be looked up next, like by the daily digest
+    for user in users:
+        user_cache.set(str(user["id"]), user_location(user), USER_TTL)
+
+    return [{"id": user["id"], **user_location(user)} for user in users]
+
+class Users(Resource):
+    """Returns the favourite locations of many users at once, by id or by pages"""
+
+    def get(self):
+        if 'ids' not in request.args and 'after' in request.args:
+            after = request.args.get('after')
+            limit = request.args.get('limit', str(USER_BATCH_SIZE))
+
+            if not after.isdigit() or not limit.isdigit() or not 1 <= int(limit) <= USER_BATCH_SIZE:
+                abort(400, f"The page is not valid, the limit must be between 1 and {USER_BATCH_SIZE}")
+
+            return get_users_page(int(after), int(limit))
+
+        ids = [user_id.strip() for user_id in request.args.get('ids', '').split(',') if user_id.strip()]
+
+        if not ids or not all(user_id.isdigit() for user_id in ids):
+            abort(400, "User ids not specified or not valid")
+
+        return [{"id": int(user_id), **user} for user_id, user in get_users(ids).items()]
+
+class CacheStats(Resource):
+    """Returns the counters of the caches, of the requests to the data layer by route and of the upstream quotas"""
+
+    def get(self):
+        stats = {name: cache.stats() for name, cache in caches.items()}
+        stats["data_layer"] = data_layer.stats()
+        stats["quotas"] = upstream_quotas.stats()
+        stats["refresh"] = {"background": dict(refresh_stats)}
+        stats["renders"] = RenderedMap.renders.stats()
+        return stats
 
 # Register resources
 api.add_resource(MapOverlay, '/map')
+api.add_resource(RenderedMap, '/map/<string:map_id>')
 api.add_resource(WeatherInfo, '/weather')
+api.add_resource(Report, '/report')
 api.add_resource(RecommendedPlaces, '/places')
 api.add_resource(User, '/user/<string:user_id>')
+api.add_resource(Users, '/users')
+api.add_resource(CacheStats, '/stats')
 
 
 if __name__ == '__main__':
-    app.run(debug=True, host='0.0.0.0', port=80)
\ No newline at end of file
+    app.run(debug=True, host='0.0.0.0', port=SERVER_PORT)
\ No newline at end of file
@@ -0,0 +1,98 @@
+import threading
+
+
+class FrequencySketch:
+    """Count-min sketch estimating how often keys were added, in a fixed amount of memory.
+
+    Every key increments a counter in each of `depth` rows, its estimate is the
+    smallest of them. All the counters are halved every `sample` additions, so the
+    estimates follow the recent popularity of the keys rather than the total one.
+    """
+
+    def __init__(self, width=4096, depth=4, sample=None) -> None:
+        self.width = width
+        self.depth = depth
+        self.sample = sample or 10 * width
+        self.rows = [[0] * width for _ in range(depth)]
+        self.additions = 0
+        self.resets = 0
+
+    def indexes(self, key) -> list:
+        return [hash((row, key)) % self.width for row in range(self.depth)]
+
+    def add(self, key) -> int:
+        """Counts the key and returns its estimated frequency"""
+        estimate = None
+
+        for row, index in zip(self.rows, self.indexes(key)):
+            row[index] += 1
+            estimate = row[index] if estimate is None else min(estimate, row[index])
+
+        self.additions += 1
+        if self.additions >= self.sample:
+            self.reset()
+
+        return estimate
+
+    def estimate(self, key) -> int:
+        return min(row[index] for row, index in zip(self.rows, self.indexes(key)))
+
+    def reset(self) -> None:
+        self.rows = [[count // 2 for count in row] for row in self.rows]
+        self.additions = 0
+        self.resets += 1
+
+
+class TopKeys:
+    """The `capacity` keys added most often recently, according to a frequency sketch.
+
+    A key enters the top when its estimated frequency exceeds the one of the least
+    frequent key of the top, which leaves it.
+    """
+
+    def __init__(self, capacity, width=4096, depth=4) -> None:
+        self.capacity = capacity
+        self.sketch = FrequencySketch(width, depth)
+        self.top = {}
+        self.lock = threading.Lock()
+
+        self.admissions = 0
+
+    def add(self, key) -> None:
+        if self.capacity <= 0:
+            return
+
+        with self.lock:
+            resets = self.sketch.resets
+            estimate = self.sketch.add(key)
+
+            if self.sketch.resets != resets:
+                self.top = {item: self.sketch.estimate(item) for item in self.top}
+
+            if key in self.top or len(self.top) < self.capacity:
+                self.top[key] = estimate
+                return
+
+            least = min(self.top, key=self.top.get)
+            if estimate > self.top[least]:
+                del self.top[least]
+                self.top[key] = estimate
+                self.admissions += 1
+
+    def keys(self, n=None) -> list:
+        """Returns the `n` most frequent keys of the top, all of them by default, most frequent first"""
+        with self.lock:
+            ranked = sorted(self.top, key=self.top.get, reverse=True)
+
+        return ranked[:n]
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                "sketch": {
+                    "entries": len(self.top),
+                    "max_entries": self.capacity,
+                    "admissions": self.admissions,
+                    "resets": self.sketch.resets,
+                },
+            }
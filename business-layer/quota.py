@@ -0,0 +1,225 @@
+import contextvars
+import heapq
+import itertools
+import threading
+import time
+from functools import wraps
+from urllib.parse import urlsplit
+
+import requests as r
+
+# Priority classes of the upstream requests, lower first: the ones of the users, the prefetches and refreshes in
+# background, and the ones whose answer the response can do without, like the precipitation overlays
+INTERACTIVE = 0
+BACKGROUND = 1
+DROPPABLE = 2
+PRIORITY_NAMES = {INTERACTIVE: "interactive", BACKGROUND: "background", DROPPABLE: "droppable"}
+
+# Priority of the upstream requests sent in the current context
+priority = contextvars.ContextVar("priority", default=INTERACTIVE)
+
+
+def background(function):
+    """Wraps the function so that its upstream requests have the background priority"""
+
+    @wraps(function)
+    def run(*args, **kwargs):
+        token = priority.set(BACKGROUND)
+        try:
+            return function(*args, **kwargs)
+        finally:
+            priority.reset(token)
+
+    return run
+
+
+class QuotaExceededError(r.ConnectionError):
+    """Raised when a request does not get its turn in the quota of its provider in time"""
+
+
+class TokenBucket:
+    """Grants `rate` requests per second on average and up to `burst` at once, in priority order.
+
+    The waiting requests are served by priority, then in order of arrival. A request
+    gives up after its timeout, the droppable ones do not wait at all: they are sent
+    only when there is a token left and no other request is waiting. When the
+    provider answers that the quota is exhausted the bucket pauses and is emptied.
+    """
+
+    def __init__(self, rate, burst) -> None:
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+
+        self.waiting = []
+        self.sequence = itertools.count()
+        self.condition = threading.Condition()
+
+        self.granted = {}
+        self.rejected = {}
+        self.throttled = 0
+
+    def refill(self, now) -> None:
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self, priority=INTERACTIVE, timeout=None) -> float:
+        """Waits for a token up to `timeout` seconds, forever if None, and returns the seconds waited.
+
+        Raises QuotaExceededError if no token was granted in time.
+        """
+        started = time.monotonic()
+        deadline = None if timeout is None else started + timeout
+
+        with self.condition:
+            self.refill(started)
+
+            if priority == DROPPABLE and (self.waiting or self.tokens < 1 or started < self.paused_until):
+                self.reject(priority)
+
+            entry = (priority, next(self.sequence))
+            heapq.heappush(self.waiting, entry)
+
+            while True:
+                now = time.monotonic()
+                self.refill(now)
+
+                if self.waiting[0] is entry and self.tokens >= 1 and now >= self.paused_until:
+                    heapq.heappop(self.waiting)
+                    self.tokens -= 1
+                    self.granted[priority] = self.granted.get(priority, 0) + 1
+                    # the next waiter may have a token too
+                    self.condition.notify_all()
+                    return now - started
+
+                if deadline is not None and now >= deadline:
+                    self.waiting.remove(entry)
+                    heapq.heapify(self.waiting)
+                    self.condition.notify_all()
+                    self.reject(priority)
+
+                # the first waiter sleeps until its token, the other ones until they are first
+                wake = None
+                if self.waiting[0] is entry:
+                    wake = max(self.paused_until - now, (1 - self.tokens) / self.rate, 0.001)
+                if deadline is not None:
+                    wake = deadline - now if wake is None else min(wake, deadline - now)
+
+                self.condition.wait(wake)
+
+    def reject(self, priority) -> None:
+        self.rejected[priority] = self.rejected.get(priority, 0) + 1
+        raise QuotaExceededError(f"No {PRIORITY_NAMES[priority]} request left in the quota")
+
+    def pause(self, seconds) -> None:
+        """Stops granting tokens for the given seconds, when the provider refuses the requests"""
+        with self.condition:
+            self.tokens = 0.0
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+            self.throttled += 1
+            self.condition.notify_all()
+
+    def stats(self) -> dict:
+        with self.condition:
+            self.refill(time.monotonic())
+            waiting = {}
+            for entry in self.waiting:
+                name = PRIORITY_NAMES[entry[0]]
+                waiting[name] = waiting.get(name, 0) + 1
+
+            return {
+                "rate": self.rate,
+                "burst": self.burst,
+                "tokens": round(self.tokens, 2),
+                "waiting": waiting,
+                "granted": {PRIORITY_NAMES[key]: value for key, value in self.granted.items()},
+                "rejected": {PRIORITY_NAMES[key]: value for key, value in self.rejected.items()},
+                "throttled": self.throttled,
+            }
+
+
+class QuotaScheduler:
+    """Schedules the upstream requests within the quota of their provider, a token bucket each.
+
+    `quotas` maps every provider to its (rate, burst) and `routes` maps the paths of
+    the data layer adapters, after the API version, to their provider: the longest
+    matching path wins, the requests of the other paths are not limited. The requests
+    of the `droppable` paths are dropped first when the quota is exhausted.
+    """
+
+    def __init__(self, quotas, routes, droppable=(), max_wait=5, registry=None) -> None:
+        self.buckets = {provider: TokenBucket(rate, burst) for provider, (rate, burst) in quotas.items()}
+        self.routes = sorted(routes.items(), key=lambda route: len(route[0]), reverse=True)
+        self.droppable = set(droppable)
+        self.max_wait = max_wait
+
+        self.wait_time = None
+        if registry is not None:
+            self.wait_time = registry.histogram("upstream_quota_wait_seconds", "Time waited for the upstream quota")
+            registry.collect(self.collect)
+
+    def route(self, url):
+        """Returns the path of the url after the API version, like "map/precipitations", and its limited provider"""
+        segments = [segment for segment in urlsplit(url).path.split("/") if segment]
+        path = "/".join(segments[segments.index("v1") + 1:]) if "v1" in segments else "/".join(segments)
+
+        for prefix, provider in self.routes:
+            if path == prefix or path.startswith(prefix + "/"):
+                # the providers without a quota are not limited
+                return prefix, provider if provider in self.buckets else None
+
+        return path, None
+
+    def request_priority(self, url) -> int:
+        """Returns the priority of a request to the url sent in the current context"""
+        path, _ = self.route(url)
+        return DROPPABLE if path in self.droppable else priority.get()
+
+    def acquire(self, url, timeout=None) -> None:
+        """Waits for the turn of the request in the quota of its provider, at most `max_wait` seconds"""
+        _, provider = self.route(url)
+        if provider is None:
+            return
+
+        request_priority = self.request_priority(url)
+        timeout = self.max_wait if timeout is None else min(timeout, self.max_wait)
+        waited = self.buckets[provider].acquire(request_priority, timeout)
+
+        if self.wait_time is not None:
+            self.wait_time.observe(waited, provider=provider, priority=PRIORITY_NAMES[request_priority])
+
+    def throttled(self, url, retry_after=None) -> None:
+        """Pauses the provider of the url after it refused a request, for `retry_after` seconds or a second"""
+        _, provider = self.route(url)
+        if provider is None:
+            return
+
+        try:
+            seconds = float(retry_after) if retry_after else 1.0
+        except ValueError:
+            seconds = 1.0
+
+        self.buckets[provider].pause(seconds)
+
+    def stats(self) -> dict:
+        return {provider: bucket.stats() for provider, bucket in self.buckets.items()}
+
+    def collect(self):
+        """Yields the queue depth and the counters of the buckets as metrics"""
+        for provider, stats in self.stats().items():
+            labels = {"provider": provider}
+
+            yield "upstream_quota_tokens", "gauge", "Requests available now in the quota", labels, stats["tokens"]
+            yield ("upstream_quota_throttled_total", "counter", "Times the provider refused the requests",
+                   labels, stats["throttled"])
+
+            for name in PRIORITY_NAMES.values():
+                labels = {"provider": provider, "priority": name}
+                yield ("upstream_quota_waiting", "gauge", "Requests waiting for the quota",
+                       labels, stats["waiting"].get(name, 0))
+                yield ("upstream_quota_granted_total", "counter", "Requests granted by the quota",
+                       labels, stats["granted"].get(name, 0))
+                yield ("upstream_quota_rejected_total", "counter", "Requests rejected by the quota",
+                       labels, stats["rejected"].get(name, 0))
@@ -0,0 +1,158 @@
+import math
+import threading
+import time
+from collections import OrderedDict
+
+# Mean radius of the Earth in meters
+EARTH_RADIUS = 6371008.8
+
+
+def distance(a, b) -> float:
+    """Returns the great circle distance in meters between two (lat, lon) points"""
+    lat_a, lon_a = map(math.radians, a)
+    lat_b, lon_b = map(math.radians, b)
+
+    h = math.sin((lat_b - lat_a) / 2) ** 2 + math.cos(lat_a) * math.cos(lat_b) * math.sin((lon_b - lon_a) / 2) ** 2
+    return 2 * EARTH_RADIUS * math.asin(math.sqrt(h))
+
+
+def nearest(places, point, radius, limit) -> list:
+    """Returns the `limit` places nearest to the point within `radius` meters, nearest first"""
+    found = [(distance(point, (place["lat"], place["lon"])), place) for place in places]
+    found = sorted((item for item in found if item[0] <= radius), key=lambda item: item[0])
+    return [place for _, place in found[:limit]]
+
+
+class PlaceIndex:
+    """In-memory grid index of the places fetched around some locations, by category.
+
+    Every fetch adds an area, a circle in which all the places of the category are
+    known, with its places. A query is answered only if the circle around the point
+    containing its result lies in an area of the category, so nearby locations share
+    the fetched places without ever missing a nearer one. Areas expire after their
+    time to live and the oldest ones are evicted beyond `max_areas`.
+
+    The places are indexed by the cell of the grid containing them and the areas by
+    the cells their circle overlaps, so a query only looks at the cells around it.
+    """
+
+    def __init__(self, max_areas=10000, cell_size=0.05) -> None:
+        self.max_areas = max_areas
+        self.cell_size = cell_size
+
+        self.areas = OrderedDict()
+        self.cells = {}
+        self.area_cells = {}
+        self.references = {}
+        self.next_area = 0
+        self.lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def cell(self, category, lat, lon) -> tuple:
+        return (category, math.floor(lat / self.cell_size), math.floor(lon / self.cell_size))
+
+    def cells_around(self, category, point, radius) -> list:
+        """Returns the cells overlapping the bounding box of the circle of `radius` meters around the point"""
+        lat_span = math.degrees(radius / EARTH_RADIUS)
+        # the circle is the widest in longitude on its side nearer to the pole
+        widest = min(abs(point[0]) + lat_span, 89.9)
+        lon_span = min(lat_span / math.cos(math.radians(widest)), 180)
+
+        _, top, left = self.cell(category, point[0] - lat_span, point[1] - lon_span)
+        _, bottom, right = self.cell(category, point[0] + lat_span, point[1] + lon_span)
+
+        return [(category, i, j) for i in range(top, bottom + 1) for j in range(left, right + 1)]
+
+    def add(self, category, center, radius, places, ttl) -> None:
+        """Adds the places of the category known to be all the ones within `radius` meters of the center.
+
+        Every place is a dict with at least "id", "lat" and "lon".
+        """
+        with self.lock:
+            keys = []
+            for place in places:
+                key = (category, place["id"])
+                cell = self.cell(category, place["lat"], place["lon"])
+
+                self.cells.setdefault(cell, {})[key] = place
+                self.references[(cell, key)] = self.references.get((cell, key), 0) + 1
+                keys.append((cell, key))
+
+            cells = self.cells_around(category, center, radius)
+            for cell in cells:
+                self.area_cells.setdefault(cell, set()).add(self.next_area)
+
+            self.areas[self.next_area] = (category, center, radius, time.time() + ttl, keys, cells)
+            self.next_area += 1
+
+            while len(self.areas) > self.max_areas:
+                self._remove(next(iter(self.areas)))
+                self.evictions += 1
+
+    def nearest(self, category, point, radius, limit):
+        """Returns the `limit` places nearest to the point within `radius` meters, or None if not indexed"""
+        with self.lock:
+            self._expire()
+
+            candidates = []
+            for cell in self.cells_around(category, point, radius):
+                candidates.extend(self.cells.get(cell, {}).values())
+
+            places = nearest(candidates, point, radius, limit)
+
+            # radius of the circle that must be fully known for the result to be exact
+            needed = radius
+            if len(places) == limit:
+                needed = distance(point, (places[-1]["lat"], places[-1]["lon"]))
+
+            # an area containing the point overlaps its cell
+            for area in self.area_cells.get(self.cell(category, *point), ()):
+                _, center, area_radius, _, _, _ = self.areas[area]
+                if distance(center, point) + needed <= area_radius:
+                    self.hits += 1
+                    return places
+
+            self.misses += 1
+            return None
+
+    def _expire(self) -> None:
+        # the areas share the same time to live, so they expire in insertion order
+        now = time.time()
+        while self.areas:
+            area = next(iter(self.areas))
+            if self.areas[area][3] > now:
+                break
+            self._remove(area)
+
+    def _remove(self, area) -> None:
+        _, _, _, _, keys, cells = self.areas.pop(area)
+
+        for cell in cells:
+            areas = self.area_cells[cell]
+            areas.discard(area)
+            if not areas:
+                del self.area_cells[cell]
+
+        for cell, key in keys:
+            self.references[(cell, key)] -= 1
+            if self.references[(cell, key)] == 0:
+                del self.references[(cell, key)]
+                places = self.cells[cell]
+                del places[key]
+                if not places:
+                    del self.cells[cell]
+
+    def stats(self) -> dict:
+        return {
+            "memory": {
+                "entries": len(self.areas),
+                "places": len(self.references),
+                "max_entries": self.max_areas,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            },
+        }
@@ -0,0 +1,8 @@
+import os
+import sys
+
+BUSINESS_LAYER = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BENCHMARKS = os.path.join(os.path.dirname(BUSINESS_LAYER), "benchmarks")
+
+sys.path.insert(0, BUSINESS_LAYER)
+sys.path.insert(1, BENCHMARKS)
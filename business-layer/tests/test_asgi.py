@@ -0,0 +1,85 @@
+"""Production serving mode of the business layer, against the fake data layer of the benchmarks"""
+import os
+import socket
+import subprocess
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+import requests as r
+
+from fake_data_layer import FakeDataLayer, serve
+
+BUSINESS_LAYER = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Serves the Starlette application on the given port in a single process
+SERVER = """
+import sys
+import uvicorn
+import asgi
+
+uvicorn.run(asgi.app, host="127.0.0.1", port=int(sys.argv[1]), log_level="warning")
+"""
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+@pytest.fixture
+def business_layer(tmp_path):
+    # every places request waits for a slow fetch job on a fetch pool smaller than the concurrent requests
+    fake = FakeDataLayer(0, {"places": 0.5}, 0)
+    data_layer = serve(fake, port=0)
+    port = free_port()
+    env = {
+        **os.environ,
+        "DATA_LAYER_URL": f"http://127.0.0.1:{data_layer.server_address[1]}/api",
+        "GEOCODING_CACHE_FILE": ":memory:",
+        "HOT_LOCATIONS": "0",
+        "FETCH_WORKERS": "2",
+        "FETCH_TIMEOUT": "3",
+    }
+    env.pop("SHARED_CACHE_DIR", None)
+    server = subprocess.Popen([sys.executable, "-c", SERVER, str(port)], cwd=BUSINESS_LAYER, env=env)
+
+    url = f"http://127.0.0.1:{port}/api/v1"
+    try:
+        for _ in range(100):
+            try:
+                r.get(f"{url}/stats", timeout=1)
+                break
+            except r.ConnectionError:
+                time.sleep(0.1)
+
+        yield url
+
+        # the background prefetches end before the servers they are waiting for
+        for _ in range(100):
+            if "refresh_in_progress 0" in r.get(f"http://127.0.0.1:{port}/metrics", timeout=1).text:
+                break
+            time.sleep(0.1)
+    finally:
+        server.kill()
+        server.wait()
+        data_layer.shutdown()
+
+
+def test_concurrent_places_requests_do_not_hold_the_fetch_pool(business_layer):
+    locations = [(45.07, 7.68), (45.46, 9.19), (41.9, 12.5), (44.49, 11.34)]
+
+    def places(location):
+        started = time.monotonic()
+        res = r.get(f"{business_layer}/places", params={"category": "parks", "lat": location[0], "lon": location[1]},
+                    timeout=10)
+        return res.status_code, time.monotonic() - started
+
+    with ThreadPoolExecutor(max_workers=len(locations)) as pool:
+        answers = list(pool.map(places, locations))
+
+    assert [status for status, _ in answers] == [200] * len(locations)
+    # the 4 fetches take 2 rounds of the 2 threads of the fetch pool, far from the time budget of 3 seconds
+    assert max(seconds for _, seconds in answers) < 2
@@ -0,0 +1,69 @@
+import time
+
+from cache import LRUCache, SharedCache, SharedStore, TieredCache
+
+
+def test_shared_store_evicts_the_oldest_values_when_the_ring_wraps_around(tmp_path):
+    store = SharedStore(str(tmp_path), 8 * 1024, slab_size=1024)
+
+    for i in range(8):
+        store.set(str(i), bytes([i]) * 1000)
+    assert store.stats()["mmap"]["evictions"] == 0
+
+    # the ring is full: the next values take the slabs of the oldest ones
+    store.set("8", b"8" * 1000)
+    store.set("9", b"9" * 2000)
+
+    assert store.lookup("0") == (None, None)
+    assert store.lookup("1") == (None, None)
+    assert store.lookup("2") == (None, None)
+    assert store.lookup("3")[0] == bytes([3]) * 1000
+    assert store.lookup("8")[0] == b"8" * 1000
+    assert store.lookup("9")[0] == b"9" * 2000
+    assert store.stats()["mmap"]["evictions"] == 3
+
+
+def test_shared_store_does_not_keep_values_larger_than_a_quarter_of_the_ring(tmp_path):
+    store = SharedStore(str(tmp_path), 8 * 1024, slab_size=1024)
+
+    store.set("large", b"x" * 3000)
+
+    assert store.lookup("large") == (None, None)
+
+
+def test_shared_store_rejects_a_value_overwritten_while_read(tmp_path):
+    store = SharedStore(str(tmp_path), 8 * 1024, slab_size=1024)
+    store.set("key", b"value" * 100)
+
+    # the slabs of the value rewritten by another process, before the index is updated
+    store.map[0:5] = b"torn!"
+
+    assert store.lookup("key") == (None, None)
+    assert store.stats()["mmap"]["overwritten"] == 1
+
+
+def test_shared_store_is_shared_by_the_stores_of_the_same_directory(tmp_path):
+    writer = SharedStore(str(tmp_path), 8 * 1024, slab_size=1024)
+    reader = SharedStore(str(tmp_path), 8 * 1024, slab_size=1024)
+
+    writer.set("key", b"value", ttl=60)
+
+    value, expires = reader.lookup("key")
+    assert value == b"value"
+    assert expires is not None
+
+
+def test_tiered_cache_reads_again_a_value_changed_by_another_process(tmp_path):
+    def users(max_ttl):
+        return TieredCache(LRUCache(100, sizeof=lambda user: 1, max_ttl=max_ttl),
+                           SharedCache(SharedStore(str(tmp_path), 8 * 1024, slab_size=1024), "users"))
+
+    reader, writer = users(0.05), users(0.05)
+    writer.set("7", b"Turin", ttl=600)
+    assert reader.get("7") == b"Turin"
+
+    writer.set("7", b"Milan", ttl=600)
+    assert reader.get("7") == b"Turin"
+
+    time.sleep(0.06)
+    assert reader.get("7") == b"Milan"
@@ -0,0 +1,75 @@
+import time
+
+import pytest
+import requests as r
+
+from client import CircuitBreaker, CircuitOpenError, Client
+
+
+def test_circuit_breaker_lets_a_single_trial_through_once_half_open():
+    breaker = CircuitBreaker(threshold=2, reset_timeout=0.05)
+
+    breaker.failure()
+    assert breaker.state == "closed"
+    breaker.failure()
+    assert breaker.state == "open"
+    assert not breaker.allow()
+
+    time.sleep(0.06)
+    assert breaker.state == "half-open"
+    assert breaker.allow()
+    # the trial is in flight
+    assert not breaker.allow()
+
+    breaker.success()
+    assert breaker.state == "closed"
+    assert breaker.allow()
+    assert breaker.allow()
+
+
+def test_circuit_breaker_opens_again_when_the_trial_fails():
+    breaker = CircuitBreaker(threshold=1, reset_timeout=0.05)
+    breaker.failure()
+
+    time.sleep(0.06)
+    assert breaker.allow()
+    breaker.failure()
+
+    assert breaker.state == "open"
+    assert not breaker.allow()
+
+
+def test_client_settles_the_trial_when_the_answer_cannot_be_read(monkeypatch):
+    client = Client(retries=0, breaker_threshold=1, breaker_reset=0, coalesce=False)
+    errors = iter([r.ConnectionError("Connection refused")])
+
+    def attempt(method, url, route, **kwargs):
+        raise next(errors, r.exceptions.ChunkedEncodingError("Connection broken"))
+
+    monkeypatch.setattr(client, "attempt", attempt)
+
+    with pytest.raises(r.ConnectionError):
+        client.get("http://upstream/api/v1/weather")
+
+    for _ in range(2):
+        # every request is a trial of the half-open circuit, none is refused
+        with pytest.raises(r.exceptions.ChunkedEncodingError):
+            client.get("http://upstream/api/v1/weather")
+
+
+def test_client_fails_fast_while_the_circuit_is_open(monkeypatch):
+    client = Client(retries=0, breaker_threshold=1, breaker_reset=60, coalesce=False)
+    calls = []
+
+    def attempt(method, url, route, **kwargs):
+        calls.append(url)
+        raise r.ConnectionError("Connection refused")
+
+    monkeypatch.setattr(client, "attempt", attempt)
+
+    with pytest.raises(r.ConnectionError):
+        client.get("http://upstream/api/v1/weather")
+    with pytest.raises(CircuitOpenError):
+        client.get("http://upstream/api/v1/weather")
+
+    assert len(calls) == 1
@@ -0,0 +1,59 @@
+import threading
+import time
+
+import pytest
+
+from quota import BACKGROUND, DROPPABLE, INTERACTIVE, QuotaExceededError, TokenBucket
+
+
+def test_token_bucket_grants_the_waiting_requests_by_priority():
+    bucket = TokenBucket(rate=5, burst=1)
+    bucket.acquire()
+    granted = []
+
+    def acquire(priority):
+        bucket.acquire(priority)
+        granted.append(priority)
+
+    background = threading.Thread(target=acquire, args=(BACKGROUND,))
+    background.start()
+    time.sleep(0.05)
+    # arrives later, but is served first
+    interactive = threading.Thread(target=acquire, args=(INTERACTIVE,))
+    interactive.start()
+
+    background.join(5)
+    interactive.join(5)
+
+    assert granted == [INTERACTIVE, BACKGROUND]
+
+
+def test_token_bucket_rejects_the_droppable_requests_without_a_token():
+    bucket = TokenBucket(rate=5, burst=1)
+    bucket.acquire()
+
+    started = time.monotonic()
+    with pytest.raises(QuotaExceededError):
+        bucket.acquire(DROPPABLE)
+
+    assert time.monotonic() - started < 0.1
+    assert bucket.stats()["rejected"] == {"droppable": 1}
+
+
+def test_token_bucket_rejects_the_droppable_requests_while_paused():
+    bucket = TokenBucket(rate=100, burst=10)
+    bucket.pause(60)
+
+    with pytest.raises(QuotaExceededError):
+        bucket.acquire(DROPPABLE)
+
+
+def test_token_bucket_rejects_a_request_not_granted_in_time():
+    bucket = TokenBucket(rate=1, burst=1)
+    bucket.acquire()
+
+    with pytest.raises(QuotaExceededError):
+        bucket.acquire(BACKGROUND, timeout=0.05)
+
+    assert bucket.stats()["waiting"] == {}
+    assert bucket.stats()["rejected"] == {"background": 1}
@@ -0,0 +1,62 @@
+import random
+
+import spatial
+
+
+def brute_force(areas, category, point, radius, limit):
+    """Answers the query of PlaceIndex.nearest by looking at every place and area"""
+    places = {place["id"]: place for area_category, _, _, area_places in areas if area_category == category
+              for place in area_places}
+    found = spatial.nearest(places.values(), point, radius, limit)
+
+    needed = radius
+    if len(found) == limit:
+        needed = spatial.distance(point, (found[-1]["lat"], found[-1]["lon"]))
+
+    for area_category, center, area_radius, _ in areas:
+        if area_category == category and spatial.distance(center, point) + needed <= area_radius:
+            return found
+
+    return None
+
+
+def test_nearest_matches_a_scan_of_all_the_areas():
+    rng = random.Random(0)
+    index = spatial.PlaceIndex()
+    areas = []
+    next_id = 0
+
+    for _ in range(200):
+        category = rng.choice(["parks", "museums"])
+        center = (45 + rng.uniform(-0.5, 0.5), 7 + rng.uniform(-0.5, 0.5))
+        radius = rng.uniform(2000, 15000)
+        places = []
+        for _ in range(rng.randrange(20)):
+            places.append({"id": next_id, "lat": center[0] + rng.uniform(-0.1, 0.1),
+                           "lon": center[1] + rng.uniform(-0.1, 0.1)})
+            next_id += 1
+
+        index.add(category, center, radius, places, 60)
+        areas.append((category, center, radius, places))
+
+    answered = 0
+    for _ in range(500):
+        category = rng.choice(["parks", "museums"])
+        point = (45 + rng.uniform(-0.6, 0.6), 7 + rng.uniform(-0.6, 0.6))
+
+        expected = brute_force(areas, category, point, 5000, 5)
+        assert index.nearest(category, point, 5000, 5) == expected
+        answered += expected is not None
+
+    assert answered > 0
+
+
+def test_evicted_areas_leave_the_grid():
+    index = spatial.PlaceIndex(max_areas=1)
+
+    index.add("parks", (45.0, 7.0), 10000, [{"id": 1, "lat": 45.0, "lon": 7.0}], 60)
+    index.add("parks", (46.0, 8.0), 10000, [{"id": 2, "lat": 46.0, "lon": 8.0}], 60)
+
+    assert index.nearest("parks", (45.0, 7.0), 1000, 5) is None
+    assert index.nearest("parks", (46.0, 8.0), 1000, 5) == [{"id": 2, "lat": 46.0, "lon": 8.0}]
+    assert all(0 not in areas for areas in index.area_cells.values())
@@ -0,0 +1,157 @@
+"""Server processes of the business layer sharing their caches, against the fake data layer of the benchmarks"""
+import json
+import os
+import sqlite3
+import subprocess
+import sys
+
+import pytest
+
+from fake_data_layer import FakeDataLayer, serve
+
+BUSINESS_LAYER = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Requests the given paths to the application of a new server process, printing status and image id of the answers:
+# a path may be preceded by its method and followed by a JSON body, separated by spaces, and may refer to the fields of
+# the previous answer, like {map}
+WORKER = """
+import json, sys
+import main
+
+client = main.app.test_client()
+previous = {}
+for argument in sys.argv[1:]:
+    method, path, body = argument.split(" ") if " " in argument else ("GET", argument, "null")
+    res = client.open(path.format_map(previous), method=method, json=json.loads(body))
+    previous = res.get_json(silent=True) or {}
+    print(json.dumps({"status": res.status_code, "id": main.image_etag(res.data), "body": res.get_json(silent=True)}))
+"""
+
+
+@pytest.fixture(scope="module")
+def data_layer(tmp_path_factory):
+    icons = tmp_path_factory.mktemp("icons")
+    fake = FakeDataLayer(0, {}, 0)
+    fake.write_icons(str(icons))
+    server = serve(fake, port=0)
+
+    yield f"http://127.0.0.1:{server.server_address[1]}/api", str(icons), fake
+
+    server.shutdown()
+
+
+def request(data_layer, shared_dir, *paths):
+    url, icons, _ = data_layer
+    env = {
+        **os.environ,
+        "DATA_LAYER_URL": url,
+        "ICON_WARM_DIR": icons,
+        "GEOCODING_CACHE_FILE": ":memory:",
+        "HOT_LOCATIONS": "0",
+    }
+    env.pop("SHARED_CACHE_DIR", None)
+    if shared_dir:
+        env["SHARED_CACHE_DIR"] = shared_dir
+
+    output = subprocess.run([sys.executable, "-c", WORKER, *paths], cwd=BUSINESS_LAYER, env=env, check=True,
+                            capture_output=True, text=True, timeout=60).stdout
+    return [json.loads(line) for line in output.splitlines()]
+
+
+def test_map_rendered_by_a_process_is_served_by_another_one(data_layer, tmp_path):
+    shared_dir = str(tmp_path / "shared")
+
+    report, = request(data_layer, shared_dir, "/api/v1/report?lat=45.07&lon=7.68")
+    assert report["status"] == 200
+
+    rendered, = request(data_layer, shared_dir, report["body"]["map"])
+    assert rendered["status"] == 200
+
+    served, = request(data_layer, shared_dir, report["body"]["map"])
+    assert served["status"] == 200
+    assert served["id"] == rendered["id"]
+
+
+def test_map_of_a_report_is_rendered_by_another_process(data_layer, tmp_path):
+    shared_dir = str(tmp_path / "shared")
+
+    report, = request(data_layer, shared_dir, "/api/v1/report?lat=45.07&lon=7.68")
+    # in the same process, the map rendered on request
+    _, rendered = request(data_layer, None, "/api/v1/report?lat=45.07&lon=7.68", report["body"]["map"])
+
+    served, = request(data_layer, shared_dir, report["body"]["map"])
+    assert served["status"] == 200
+    assert served["id"] == rendered["id"]
+
+
+def test_request_of_the_map_joins_the_render_started_by_the_report(tmp_path):
+    # the render of the map takes at least the latency of its tiles
+    fake = FakeDataLayer(0, {"map": 1.0}, 0)
+    fake.write_icons(str(tmp_path / "icons"))
+    server = serve(fake, port=0)
+
+    try:
+        data_layer = (f"http://127.0.0.1:{server.server_address[1]}/api", str(tmp_path / "icons"), fake)
+        report, _, stats = request(data_layer, None, "/api/v1/report?lat=45.07&lon=7.68", "{map}",
+                                   "/api/v1/stats")
+    finally:
+        server.shutdown()
+
+    assert stats["body"]["renders"]["rendered_maps"] == {"calls": 2, "deduplicated": 1}
+
+
+def test_map_of_a_report_is_not_found_without_the_shared_cache(data_layer):
+    report, = request(data_layer, None, "/api/v1/report?lat=45.07&lon=7.68")
+
+    rendered, = request(data_layer, None, report["body"]["map"])
+    assert rendered["status"] == 404
+
+
+def test_map_of_a_report_shows_the_icon_of_its_id(data_layer, tmp_path):
+    shared_dir = str(tmp_path / "shared")
+    fake = data_layer[2]
+    condition = fake.fixtures["weather"]["current"]["current"]["condition"]
+    icon = condition["icon"]
+
+    report, = request(data_layer, shared_dir, "/api/v1/report?lat=45.07&lon=7.68")
+    _, expected = request(data_layer, None, "/api/v1/report?lat=45.07&lon=7.68", report["body"]["map"])
+
+    # the weather changes before the map is requested, and the cached conditions expire
+    condition["icon"] = next(other for other in fake.icons() if other != icon)
+    try:
+        with sqlite3.connect(os.path.join(shared_dir, "index.sqlite3")) as index:
+            index.execute("DELETE FROM entries WHERE key LIKE 'current:%'")
+
+        changed, = request(data_layer, None, "/api/v1/map?lat=45.07&lon=7.68&format=png")
+        rendered, = request(data_layer, shared_dir, report["body"]["map"])
+    finally:
+        condition["icon"] = icon
+
+    assert changed["id"] != expected["id"]
+    assert rendered["status"] == 200
+    assert rendered["id"] == expected["id"]
+
+
+def test_location_changed_through_a_process_is_used_by_another_one(data_layer, tmp_path):
+    shared_dir = str(tmp_path / "shared")
+    fake = data_layer[2]
+
+    changed, = request(data_layer, shared_dir, 'PATCH /api/v1/user/7 {"lat":45.07,"lon":7.68}')
+    assert changed["status"] == 200
+
+    created = fake.stats()["calls"].get("user/POST", 0)
+    user, = request(data_layer, shared_dir, "/api/v1/user/7")
+
+    assert user["body"] == {"lat": 45.07, "lon": 7.68}
+    assert fake.stats()["calls"].get("user/POST", 0) == created
+
+
+def test_several_processes_require_the_shared_cache(tmp_path):
+    env = {**os.environ, "SERVER_WORKERS": "2", "GEOCODING_CACHE_FILE": ":memory:", "HOT_LOCATIONS": "0"}
+    env.pop("SHARED_CACHE_DIR", None)
+
+    result = subprocess.run([sys.executable, "asgi.py"], cwd=BUSINESS_LAYER, env=env, capture_output=True, text=True,
+                            timeout=60)
+
+    assert result.returncode != 0
+    assert "SHARED_CACHE_DIR" in result.stderr
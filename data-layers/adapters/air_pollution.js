@@ -2,6 +2,7 @@ const express = require('express')
 const router = express.Router()
 const axios = require('axios');
 const { OWM_API_KEY } = require('../secrets');
+const { upstreamError } = require('../middleware');
 
 const OWM_BASE_URL = "https://api.openweathermap.org/data/2.5/air_pollution";
 const CONFIG = {
@@ -75,7 +76,7 @@ router.get('/', function (req, res) {
         })
         .catch(err => {
             console.log(err.response)
-            res.status(500).json({ error: err });
+            upstreamError(res, err);
         });
 });
 
@@ -83,7 +84,7 @@ router.get('/', function (req, res) {
 * @openapi
 * /adapters/v1/air_pollution/forecast:
 *   get:
-*     description: Get the air pollution data for a given location and day
+*     description: Get the air pollution data for a given location and day, or all the hourly forecasts
 *     parameters:
 *       - in: query
 *         name: lat
@@ -101,8 +102,8 @@ router.get('/', function (req, res) {
 *         name: day
 *         schema:
 *           type: string
-*         required: true
-*         description: Day in the format YYYY-MM-DD
+*         required: false
+*         description: Day in the format YYYY-MM-DD. If not given, all the available hours are returned
 *     produces:
 *       - application/json
 *     responses:
@@ -134,12 +135,12 @@ router.get('/forecast', function (req, res) {
     const lon = req.lon;
     const dayQuery = req.query.day;
     const dtQuery = new Date(dayQuery);
-    if (!dayQuery || dtQuery.toString() === "Invalid Date") {
+    if (dayQuery && dtQuery.toString() === "Invalid Date") {
         res.status(400).json({ error: "Invalid day" });
         return;
     }
 
-    const day = dtQuery.getFullYear() + "-" + (dtQuery.getMonth() + 1) + "-" + dtQuery.getDate();
+    const day = dayQuery ? dtQuery.getFullYear() + "-" + (dtQuery.getMonth() + 1) + "-" + dtQuery.getDate() : null;
 
     let config = {
         ...CONFIG,
@@ -158,7 +159,7 @@ router.get('/forecast', function (req, res) {
             for (const hour of response.data.list) {
                 let dt = new Date(hour.dt * 1000);
                 let dtDay = dt.getFullYear() + "-" + (dt.getMonth() + 1) + "-" + dt.getDate();
-                if (dtDay === day) {
+                if (day === null || dtDay === day) {
                     ret.push(hour);
                 }
             }
@@ -167,7 +168,7 @@ router.get('/forecast', function (req, res) {
         })
         .catch(err => {
             console.log(err.response)
-            res.status(500).json({ error: err });
+            upstreamError(res, err);
         });
 });
 
@@ -1,7 +1,7 @@
 const express = require('express')
 const router = express.Router()
 const axios = require('axios');
-const { parseLonLat } = require('../middleware');
+const { parseLonLat, upstreamError } = require('../middleware');
 
 const NOMINATIM_BASE_URL = "https://nominatim.openstreetmap.org";
 const CONFIG = {
@@ -77,7 +77,7 @@ router.get('/search', function (req, res) {
         })
         .catch(err => {
             console.log(err)
-            res.status(500).json({ error: err });
+            upstreamError(res, err);
         });
 }
 );
@@ -146,7 +146,7 @@ router.get('/reverse', parseLonLat, function (req, res) {
         })
         .catch(err => {
             console.log(err)
-            res.status(500).json({ error: err });
+            upstreamError(res, err);
         });
 }
 );
@@ -3,6 +3,7 @@ const router = express.Router()
 const axios = require('axios');
 const { Blob } = require('node:buffer');
 const { OWM_API_KEY, GEOAPIFY_KEY } = require('../secrets');
+const { upstreamError } = require('../middleware');
 
 const OWM_BASE_URL = "https://tile.openweathermap.org/map";
 const GEOAPIFY_URL = "https://maps.geoapify.com/v1/tile";
@@ -89,7 +90,7 @@ router.get('/', function (req, res) {
         })
         .catch(err => {
             console.log(err)
-            res.status(500).json({ error: err });
+            upstreamError(res, err);
         });
 });
 
@@ -175,7 +176,7 @@ router.get('/precipitations', function (req, res) {
         })
         .catch(err => {
             console.log(err)
-            res.status(500).json({ error: err });
+            upstreamError(res, err);
         });
 });
 
@@ -2,6 +2,7 @@ const express = require('express')
 const router = express.Router()
 const axios = require('axios');
 const { GEOAPIFY_KEY } = require('../secrets');
+const { upstreamError } = require('../middleware');
 
 const GEOAPIFY_PLACES_URL = "https://api.geoapify.com/v2/places";
 
@@ -30,11 +31,23 @@ const GEOAPIFY_PLACES_URL = "https://api.geoapify.com/v2/places";
 *           type: string
 *         required: true
 *         description: Categories to include in the list of places
+*       - in: query
+*         name: radius
+*         schema:
+*           type: integer
+*         required: false
+*         description: Radius in meters of the area around the location, 5000 by default
+*       - in: query
+*         name: limit
+*         schema:
+*           type: integer
+*         required: false
+*         description: Maximum number of places, between 1 and 500, 5 by default
 *     produces:
 *       - application/json
 *     responses:
 *       200:
-*         description: Return the list of places of the given category near the given location
+*         description: Return the list of places of the given category near the given location, nearest first
 *       400:
 *         description: Invalid parameters
 *         content:
@@ -68,14 +81,21 @@ router.get('/', function (req, res) {
         return;
     }
 
+    const radius = req.query.radius === undefined ? 5000 : parseInt(req.query.radius);
+    const limit = req.query.limit === undefined ? 5 : parseInt(req.query.limit);
+    if (isNaN(radius) || radius < 1 || isNaN(limit) || limit < 1 || limit > 500) {
+        res.status(400).json({ error: "Invalid radius or limit" });
+        return;
+    }
+
     let config = {
         url: `${GEOAPIFY_PLACES_URL}`,
         params: {
             apiKey: GEOAPIFY_KEY,
             categories: categories,
-            filter: `circle:${lon},${lat},5000`,
-            // bias: `proximity:${lon},${lat}`,
-            limit: 5
+            filter: `circle:${lon},${lat},${radius}`,
+            bias: `proximity:${lon},${lat}`,
+            limit: limit
         },
     };
     axios(config)
@@ -85,7 +105,7 @@ router.get('/', function (req, res) {
         })
         .catch(err => {
             console.log(err)
-            res.status(500).json({ error: err });
+            upstreamError(res, err);
         });
 
 });
@@ -2,6 +2,7 @@ const express = require('express')
 const router = express.Router()
 const axios = require('axios');
 const { WEATHERAPI_KEY } = require('../secrets');
+const { upstreamError } = require('../middleware');
 
 const WEATHERAPI_BASE_URL = "https://api.weatherapi.com/v1/forecast.json";
 const CONFIG = {
@@ -80,7 +81,7 @@ router.get('/current', function (req, res) {
         })
         .catch(err => {
             console.log(err)
-            res.status(500).json({ error: err });
+            upstreamError(res, err);
         });
 });
 
@@ -88,7 +89,7 @@ router.get('/current', function (req, res) {
 * @openapi
 * /adapters/v1/weather/forecast:
 *   get:
-*     description: Get the weather info for a given location and day
+*     description: Get the weather info for a given location and day, or for the next days
 *     parameters:
 *       - in: query
 *         name: lat
@@ -106,13 +107,20 @@ router.get('/current', function (req, res) {
 *         name: day
 *         schema:
 *           type: string
-*         required: true
-*         description: Day to get forecast for in YYYY-MM-DD format
+*         required: false
+*         description: Day to get forecast for in YYYY-MM-DD format. Required if days is not given
+*       - in: query
+*         name: days
+*         schema:
+*           type: integer
+*         required: false
+*         description: Number of days, starting from today, to get the forecast for in a single request
+*         example: 4
 *     produces:
 *       - application/json
 *     responses:
 *       200:
-*         description: Return the weather info
+*         description: Return the weather info, by day
 *       400:
 *         description: Invalid parameters
 *         content:
@@ -137,6 +145,12 @@ router.get('/current', function (req, res) {
 router.get('/forecast', function (req, res) {
     const lat = req.lat;
     const lon = req.lon;
+
+    if (req.query.days) {
+        forecastDays(req, res);
+        return;
+    }
+
     const dayQuery = req.query.day;
     const dt = new Date(dayQuery);
     if (!dayQuery || dt.toString() === "Invalid Date") {
@@ -170,10 +184,47 @@ router.get('/forecast', function (req, res) {
         })
         .catch(err => {
             console.log(err)
-            res.status(500).json({ error: err });
+            upstreamError(res, err);
         });
 });
 
 
+/**
+ * Returns the forecast of the next `days` days, today included, by day
+ * @param {*} req express request fn
+ * @param {*} res express response fn
+ */
+function forecastDays(req, res) {
+    const days = parseInt(req.query.days);
+    if (isNaN(days) || days < 1 || days > 14) {
+        res.status(400).json({ error: "Days must be a number between 1 and 14" });
+        return;
+    }
+
+    let config = {
+        ...CONFIG,
+        params: {
+            ...CONFIG.params,
+            q: `${req.lat},${req.lon}`,
+            alerts: "yes",
+            days: days,
+        }
+    };
+    axios(config)
+        .then(response => {
+            let ret = {
+                alerts: response.data.alerts,
+            }
+            for (const forecastday of response.data.forecast.forecastday) {
+                ret[forecastday.date] = forecastday.day;
+            }
+            res.status(200).json(ret);
+        })
+        .catch(err => {
+            console.log(err)
+            upstreamError(res, err);
+        });
+}
+
 
 module.exports = router;
\ No newline at end of file
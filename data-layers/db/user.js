@@ -15,6 +15,114 @@ const db = new sqlite3.Database('./db/db.sqlite3', sqlite3.OPEN_READWRITE | sqli
 });
 const { parseTgUserId } = require('../middleware');
 
+// Maximum number of users returned by a single batch request
+const MAX_BATCH_USERS = 500;
+
+/**
+* @openapi
+* /db/v1/user:
+*   get:
+*     description: Get the favourite coordinates of many users by their Telegram user ids, in a single request,
+*       or page through the users with a favourite location, ordered by id
+*     parameters:
+*       - in: query
+*         name: ids
+*         schema:
+*           type: string
+*         required: false
+*         description: Comma separated Telegram ids of the users, at most 500. Required if after is not given
+*       - in: query
+*         name: after
+*         schema:
+*           type: integer
+*         required: false
+*         description: Return the users with a favourite location and an id greater than this one
+*       - in: query
+*         name: limit
+*         schema:
+*           type: integer
+*         required: false
+*         description: Number of the users of a page, at most 500
+*         example: 100
+*     produces:
+*       - application/json
+*     responses:
+*       200:
+*         description: Return the info of the users that exist, the missing ones are omitted. A page is ordered
+*           by id, the id of its last user is the `after` of the next page
+*       400:
+*         description: Invalid parameters
+*         content:
+*           application/json:
+*             schema:
+*               type: object
+*               properties:
+*                 error:
+*                   type: string
+*                   description: Error message
+*       500:
+*         description: Database not connected or internal server error
+*         content:
+*           application/json:
+*             schema:
+*               type: object
+*               properties:
+*                 error:
+*                   type: string
+*                   description: Error message
+*/
+router.get("/", function (req, res) {
+    if (!connected) {
+        res.status(500).json({ error: "DB not connected" });
+        return;
+    }
+
+    if (req.query.ids === undefined && req.query.after !== undefined) {
+        usersPage(req, res);
+        return;
+    }
+
+    const ids = (req.query.ids || "").split(",").filter(id => id.trim().length > 0).map(id => parseInt(id));
+    if (ids.length === 0 || ids.length > MAX_BATCH_USERS || ids.some(isNaN)) {
+        res.status(400).json({ error: `ids must be between 1 and ${MAX_BATCH_USERS} comma separated numbers` });
+        return;
+    }
+
+    const placeholders = ids.map(() => "?").join(",");
+    db.all(`SELECT * FROM users WHERE id IN (${placeholders})`, ids, function (err, rows) {
+        if (err) {
+            res.status(500).json({ error: err });
+        } else {
+            res.status(200).json(rows);
+        }
+    });
+});
+
+
+/**
+ * Returns a page of the users with a favourite location, with an id greater than `after`
+ * @param {*} req express request fn
+ * @param {*} res express response fn
+ */
+function usersPage(req, res) {
+    const after = parseInt(req.query.after);
+    const limit = req.query.limit === undefined ? 100 : parseInt(req.query.limit);
+    if (isNaN(after) || isNaN(limit) || limit < 1 || limit > MAX_BATCH_USERS) {
+        res.status(400).json({ error: `after must be a number and limit between 1 and ${MAX_BATCH_USERS}` });
+        return;
+    }
+
+    // the primary key index is walked from `after`, so every page costs the same
+    const page = "SELECT * FROM users WHERE id > ? AND lat IS NOT NULL AND lon IS NOT NULL ORDER BY id LIMIT ?";
+    db.all(page, [after, limit], function (err, rows) {
+        if (err) {
+            res.status(500).json({ error: err });
+        } else {
+            res.status(200).json(rows);
+        }
+    });
+}
+
 
 /**
 * @openapi
@@ -79,7 +187,7 @@ router.get("/:tgUserId", parseTgUserId, function (req, res) {
 * @openapi
 * /db/v1/user/{tgUserId}:
 *   post:
-*     description: Create a new user with id {tgUserId} and no favourite coordinates
+*     description: Create a new user with id {tgUserId} and no favourite coordinates, if it does not exist yet
 *     parameters:
 *       - in: path
 *         name: tgUserId
@@ -91,7 +199,7 @@ router.get("/:tgUserId", parseTgUserId, function (req, res) {
 *       - application/json
 *     responses:
 *       200:
-*         description: Return the created user
+*         description: Return the created user, or the existing one
 *       400:
 *         description: Invalid parameters
 *         content:
@@ -102,18 +210,8 @@ router.get("/:tgUserId", parseTgUserId, function (req, res) {
 *                 error:
 *                   type: string
 *                   description: Error message
-*       409:
-*         description: User already exists
-*         content:
-*           application/json:
-*             schema:
-*               type: object
-*               properties:
-*                 error:
-*                   type: string
-*                   description: Error message
 *       500:
-*         description: Database not connected
+*         description: Database not connected or internal server error
 *         content:
 *           application/json:
 *             schema:
@@ -129,16 +227,20 @@ router.post("/:tgUserId", parseTgUserId, function (req, res) {
         return;
     }
 
-    db.run("INSERT INTO users(id, lat, lon) VALUES (?, NULL, NULL)", [req.tgUserId], function (err) {
+    // a single statement creates the user only if missing, so concurrent requests cannot conflict
+    db.run("INSERT OR IGNORE INTO users(id, lat, lon) VALUES (?, NULL, NULL)", [req.tgUserId], function (err) {
         if (err) {
-            res.status(409).json({ error: err });
-        } else {
-            res.status(200).json({
-                id: req.tgUserId,
-                lat: null,
-                lon: null,
-            });
+            res.status(500).json({ error: err });
+            return;
         }
+
+        db.get("SELECT * FROM users WHERE id = ?", [req.tgUserId], function (err, row) {
+            if (err) {
+                res.status(500).json({ error: err });
+            } else {
+                res.status(200).json(row);
+            }
+        });
     });
 });
 
@@ -146,7 +248,7 @@ router.post("/:tgUserId", parseTgUserId, function (req, res) {
 * @openapi
 * /db/v1/user/{tgUserId}:
 *   patch:
-*     description: Change the favourite coordinates of the user with id {tgUserId}
+*     description: Change the favourite coordinates of the user with id {tgUserId}, creating the user if it does not exist
 *     parameters:
 *       - in: path
 *         name: tgUserId
@@ -174,7 +276,7 @@ router.post("/:tgUserId", parseTgUserId, function (req, res) {
 *       200:
 *         description: Return the new user info
 *       400:
-*         description: Invalid parameter or user not found
+*         description: Invalid parameters
 *         content:
 *           application/json:
 *             schema:
@@ -211,24 +313,17 @@ router.patch("/:tgUserId", parseTgUserId, function (req, res) {
         return;
     }
 
-    db.run("UPDATE users SET lat = ?, lon = ? WHERE id = ?", [lat, lon, req.tgUserId], function (err) {
+    const upsert = "INSERT INTO users(id, lat, lon) VALUES (?, ?, ?) " +
+        "ON CONFLICT(id) DO UPDATE SET lat = excluded.lat, lon = excluded.lon";
+    db.run(upsert, [req.tgUserId, lat, lon], function (err) {
         if (err) {
             res.status(500).json({ error: err });
         } else {
-            let ret = {};
-            let status;
-            if (this.changes > 0) {
-                ret = {
-                    id: req.tgUserId,
-                    lat: lat,
-                    lon: lon,
-                };
-                status = 200;
-            } else {
-                ret = { error: "User not found" };
-                status = 400;
-            }
-            res.status(status).json(ret);
+            res.status(200).json({
+                id: req.tgUserId,
+                lat: lat,
+                lon: lon,
+            });
         }
     });
 });
@@ -16,6 +16,9 @@ const app = express();
 app.use(express.json());
 app.use(express.urlencoded({ extended: true }));
 
+const { parseLonLat, parseXY, traceRequest } = require('./middleware');
+app.use(traceRequest);
+
 const options = {
     definition: {
         openapi: '3.0.0',
@@ -47,7 +50,6 @@ app.use('/api/docs', swaggerUi.serve, swaggerUi.setup(swaggerSpec));
  * ADAPTER LAYER
 */
 const routerAdapterLayer = express.Router();
-const { parseLonLat, parseXY } = require('./middleware');
 
 const geocodings = require('./adapters/geocoding');
 routerAdapterLayer.use('/v1/geocoding/', geocodings);
@@ -1,3 +1,4 @@
+const crypto = require('crypto');
 
 /**
  * Check if the request has the required parameters "lat" and "lon" and parse them to float
@@ -70,8 +71,49 @@ function parseXY(req, res, next) {
     next();
 }
 
+/**
+ * Adopt the trace id of the caller, or start a new trace, and log the request with its latency once answered
+ * @param {*} req express request fn
+ * @param {*} res express response fn
+ * @param {*} next express next fn
+ * @returns req.traceId, also sent back in the X-Request-ID header of the response
+ */
+function traceRequest(req, res, next) {
+    const started = process.hrtime.bigint();
+
+    req.traceId = req.get('X-Request-ID') || crypto.randomUUID().replace(/-/g, '').slice(0, 16);
+    res.set('X-Request-ID', req.traceId);
+
+    res.on('finish', () => {
+        const milliseconds = Number(process.hrtime.bigint() - started) / 1e6;
+        console.log(`[${req.traceId}] ${req.method} ${req.originalUrl} ${res.statusCode} ${milliseconds.toFixed(1)}ms`);
+    });
+
+    next();
+}
+
+/**
+ * Answer a failed request to a provider: a refused quota is forwarded as 429, with the Retry-After of the provider,
+ * so that the caller slows down instead of retrying, any other error as 500
+ * @param {*} res express response fn
+ * @param {*} err error of the request to the provider
+ */
+function upstreamError(res, err) {
+    if (err.response && err.response.status === 429) {
+        if (err.response.headers['retry-after']) {
+            res.set('Retry-After', err.response.headers['retry-after']);
+        }
+        res.status(429).json({ error: 'The quota of the provider is exhausted' });
+        return;
+    }
+
+    res.status(500).json({ error: err });
+}
+
 module.exports = {
     parseLonLat,
     parseTgUserId,
     parseXY,
+    traceRequest,
+    upstreamError,
 }
@@ -0,0 +1,90 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+class LRUCache:
+    """In-memory least recently used cache bounded by the total size of its values"""
+
+    def __init__(self, max_bytes, sizeof=len) -> None:
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof
+        self.size = 0
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        """Returns the cached value or None if missing or expired"""
+        return self.lookup(key)[0]
+
+    def lookup(self, key, stale=0):
+        """Returns the cached value and its expiration time, also if it expired less than `stale` seconds ago.
+
+        Returns (None, None) if the value is missing or expired for longer.
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+
+            if entry is None:
+                self.misses += 1
+                return None, None
+
+            value, size, expires = entry
+            if expires is not None and expires <= time.time():
+                if expires + stale <= time.time():
+                    self._remove(key)
+                    self.misses += 1
+                    return None, None
+
+                self.stale_hits += 1
+            else:
+                self.hits += 1
+
+            self.entries.move_to_end(key)
+            return value, expires
+
+    def set(self, key, value, ttl=None) -> None:
+        """Stores the value, evicting the least recently used entries if needed"""
+        size = self.sizeof(value)
+        if size > self.max_bytes:
+            return
+
+        expires = time.time() + ttl if ttl is not None else None
+
+        with self.lock:
+            if key in self.entries:
+                self._remove(key)
+
+            self.entries[key] = (value, size, expires)
+            self.size += size
+
+            while self.size > self.max_bytes:
+                oldest = next(iter(self.entries))
+                self._remove(oldest)
+                self.evictions += 1
+
+    def delete(self, key) -> None:
+        with self.lock:
+            if key in self.entries:
+                self._remove(key)
+
+    def _remove(self, key) -> None:
+        _, size, _ = self.entries.pop(key)
+        self.size -= size
+
+    def stats(self) -> dict:
+        return {
+            "entries": len(self.entries),
+            "bytes": self.size,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "stale_hits": self.stale_hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
@@ -0,0 +1,294 @@
+import random
+import threading
+import time
+from functools import partial
+from urllib.parse import urlsplit
+
+import requests as r
+from requests.adapters import HTTPAdapter
+
+import metrics
+
+
+class CircuitOpenError(r.ConnectionError):
+    """Raised when a request is refused because the circuit of its route is open"""
+
+
+class CircuitBreaker:
+    """Stops calling a route after consecutive failures, until a trial request succeeds.
+
+    After `threshold` consecutive failures the circuit opens and requests fail fast,
+    after `reset_timeout` seconds a single trial request is let through (half open):
+    its success closes the circuit, its failure opens it again.
+    """
+
+    def __init__(self, threshold, reset_timeout) -> None:
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.trial = False
+        self.lock = threading.Lock()
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at >= self.reset_timeout:
+            return "half-open"
+        return "open"
+
+    def allow(self) -> bool:
+        with self.lock:
+            state = self.state
+
+            if state == "closed":
+                return True
+
+            if state == "half-open" and not self.trial:
+                self.trial = True
+                return True
+
+            return False
+
+    def success(self) -> None:
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+            self.trial = False
+
+    def failure(self) -> None:
+        with self.lock:
+            self.failures += 1
+            self.trial = False
+
+            if self.failures >= self.threshold:
+                self.opened_at = time.monotonic()
+
+
+class SingleFlight:
+    """Runs concurrent calls with the same key once, sharing the result or the error with all the callers.
+
+    Calls are counted by group, the calls that joined one already in flight are counted
+    as deduplicated. A joined call waits for the flight at most its own `timeout`.
+    """
+
+    class Flight:
+        def __init__(self) -> None:
+            self.done = threading.Event()
+            self.result = None
+            self.error = None
+
+    def __init__(self) -> None:
+        self.flights = {}
+        self.calls = {}
+        self.deduplicated = {}
+        self.lock = threading.Lock()
+
+    def do(self, key, function, group=None, timeout=None):
+        """Returns the result of `function`, called only if no call with the same key is in flight.
+
+        Raises r.Timeout if the call joined a flight that did not end within `timeout` seconds.
+        """
+        with self.lock:
+            flight = self.flights.get(key)
+            leader = flight is None
+
+            if leader:
+                flight = self.flights[key] = self.Flight()
+            else:
+                self.deduplicated[group] = self.deduplicated.get(group, 0) + 1
+            self.calls[group] = self.calls.get(group, 0) + 1
+
+        if not leader:
+            if not flight.done.wait(timeout):
+                raise r.Timeout(f"The request in flight for {key} did not end in {timeout}s")
+            if flight.error is not None:
+                raise flight.error
+            return flight.result
+
+        try:
+            flight.result = function()
+            return flight.result
+        except BaseException as e:
+            flight.error = e
+            raise
+        finally:
+            with self.lock:
+                del self.flights[key]
+            flight.done.set()
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                group: {"calls": calls, "deduplicated": self.deduplicated.get(group, 0)}
+                for group, calls in self.calls.items()
+            }
+
+
+class Client:
+    """HTTP client sharing a pool of keep-alive connections between threads.
+
+    Failed idempotent requests (connection errors, timeouts and 5xx answers) are
+    retried with jittered exponential backoff, and every route of the called API
+    has its own circuit breaker. Concurrent identical GET requests are sent once
+    and share the response, unless `coalesce` is disabled.
+
+    Every request carries the trace id of the current context. With a metrics
+    registry, the latency and the received bytes of the requests are recorded by
+    route, together with the requests in flight on the pool.
+    """
+
+    IDEMPOTENT_METHODS = {"GET", "HEAD", "PUT", "PATCH", "DELETE"}
+    COALESCED_METHODS = {"GET", "HEAD"}
+
+    def __init__(self, pool_size=10, connect_timeout=3.05, read_timeout=10, retries=2, backoff=0.1,
+                 breaker_threshold=5, breaker_reset=30, coalesce=True, registry=None) -> None:
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.breaker_threshold = breaker_threshold
+        self.breaker_reset = breaker_reset
+        self.coalesce = coalesce
+
+        self.session = r.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=0)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+        self.breakers = {}
+        self.flights = SingleFlight()
+        self.lock = threading.Lock()
+
+        self.registry = registry
+        if registry is not None:
+            self.latency = registry.histogram("upstream_request_duration_seconds", "Latency of the upstream requests")
+            self.received = registry.counter("upstream_response_bytes_total", "Bytes received from the upstream routes")
+            self.in_flight = registry.gauge("upstream_requests_in_flight", "Upstream requests being sent")
+            registry.gauge("upstream_pool_size", "Connections kept alive to the upstream").set(pool_size)
+            registry.collect(self.collect)
+
+    def route(self, url) -> str:
+        """Returns the route of the url: the first path segment after the API version, or the host"""
+        url = urlsplit(url)
+        segments = [segment for segment in url.path.split("/") if segment]
+
+        for i, segment in enumerate(segments[:-1]):
+            if segment == "v1":
+                return segments[i + 1]
+
+        return url.netloc
+
+    def breaker(self, route) -> CircuitBreaker:
+        with self.lock:
+            if route not in self.breakers:
+                self.breakers[route] = CircuitBreaker(self.breaker_threshold, self.breaker_reset)
+            return self.breakers[route]
+
+    def request(self, method, url, timeout=None, **kwargs) -> r.Response:
+        """Sends the request, `timeout` bounds the read timeout of every attempt"""
+        route = self.route(url)
+
+        if self.coalesce and method.upper() in self.COALESCED_METHODS and set(kwargs) <= {"params"}:
+            # the prepared url includes the sorted parameters, so equivalent requests share the key
+            params = kwargs.get("params")
+            if isinstance(params, dict):
+                params = sorted(params.items())
+            key = (method.upper(), r.Request(method, url, params=params).prepare().url)
+            # a joined request waits as long as it would take to send it
+            read_timeout = min(self.read_timeout, timeout) if timeout is not None else self.read_timeout
+            wait = (self.connect_timeout + read_timeout) * (self.retries + 1)
+
+            return self.flights.do(key, partial(self.send, method, url, route, timeout, **kwargs), route, wait)
+
+        return self.send(method, url, route, timeout, **kwargs)
+
+    def send(self, method, url, route, timeout=None, **kwargs) -> r.Response:
+        """Sends the request through the circuit breaker of its route, retrying it if allowed"""
+        breaker = self.breaker(route)
+        retries = self.retries if method.upper() in self.IDEMPOTENT_METHODS else 0
+        read_timeout = min(self.read_timeout, timeout) if timeout is not None else self.read_timeout
+
+        if metrics.trace.get() is not None:
+            kwargs["headers"] = {**kwargs.get("headers", {}), metrics.TRACE_HEADER: metrics.trace.get()}
+
+        for attempt in range(retries + 1):
+            if not breaker.allow():
+                raise CircuitOpenError(f"Circuit open for route '{route}'")
+
+            try:
+                res = self.attempt(method, url, route, timeout=(self.connect_timeout, read_timeout), **kwargs)
+            except (r.ConnectionError, r.Timeout):
+                breaker.failure()
+                if attempt == retries:
+                    raise
+            except BaseException:
+                # any other error settles the breaker too, a half-open trial left pending would refuse the route forever
+                breaker.failure()
+                raise
+            else:
+                if res.status_code < 500:
+                    breaker.success()
+                    return res
+
+                breaker.failure()
+                if attempt == retries:
+                    return res
+
+            # full jitter: wait a random time up to the exponential backoff
+            time.sleep(random.uniform(0, self.backoff * 2 ** attempt))
+
+    def attempt(self, method, url, route, **kwargs) -> r.Response:
+        """Sends the request once, recording its metrics"""
+        if self.registry is None:
+            return self.session.request(method, url, **kwargs)
+
+        status = "error"
+        started = time.perf_counter()
+        self.in_flight.inc()
+
+        try:
+            res = self.session.request(method, url, **kwargs)
+            status = res.status_code
+            self.received.inc(len(res.content), route=route)
+            return res
+        finally:
+            self.in_flight.dec()
+            self.latency.observe(time.perf_counter() - started, route=route, method=method.upper(), status=status)
+
+    def get(self, url, **kwargs) -> r.Response:
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url, **kwargs) -> r.Response:
+        return self.request("POST", url, **kwargs)
+
+    def patch(self, url, **kwargs) -> r.Response:
+        return self.request("PATCH", url, **kwargs)
+
+    def stats(self) -> dict:
+        with self.lock:
+            breakers = dict(self.breakers)
+
+        stats = {
+            route: {"state": breaker.state, "failures": breaker.failures}
+            for route, breaker in breakers.items()
+        }
+
+        for route, flights in self.flights.stats().items():
+            stats.setdefault(route, {}).update(flights)
+
+        return stats
+
+    def collect(self):
+        """Yields the request and circuit breaker counters of the routes as metrics"""
+        for route, stats in self.stats().items():
+            labels = {"route": route}
+
+            if "calls" in stats:
+                yield "upstream_calls_total", "counter", "Upstream GET calls", labels, stats["calls"]
+                yield ("upstream_deduplicated_total", "counter",
+                       "Upstream GET calls that shared an identical request in flight", labels, stats["deduplicated"])
+            if "state" in stats:
+                yield ("upstream_circuit_open", "gauge", "Whether the circuit of the route refuses requests",
+                       labels, int(stats["state"] == "open"))
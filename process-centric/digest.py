@@ -0,0 +1,469 @@
+import logging
+import math
+import multiprocessing
+import sqlite3
+import threading
+import time
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor, as_completed, wait
+from datetime import date
+from io import BytesIO
+from typing import Any, Callable, Dict, Iterator, List, Optional, Set, Tuple
+
+from PIL import Image
+from telegram import Bot, Message
+from telegram.error import NetworkError, RetryAfter, TelegramError, TimedOut
+
+import metrics
+from client import Client
+
+logger = logging.getLogger(__name__)
+
+# Client of the business layer of every process of the render pool
+_client = None
+
+
+def render_location(business_layer_url: str, location: Dict[str, float], day: str) -> Tuple[Dict, bytes]:
+    """Fetches the weather and the map of a location and encodes the map as JPEG, in a process of the render pool
+
+    The PNG map is requested like the interactive replies do, so that it is shared with
+    them in the caches of the business layer, and it is converted here: Telegram stores
+    the photos as JPEG anyway, and the smaller upload is faster.
+
+    Args:
+        business_layer_url (str): url of the business layer API
+        location (Dict[str, float]): coordinates of the location
+        day (str): day of the weather, in YYYY-MM-DD format
+
+    Returns:
+        Tuple[Dict, bytes]: the weather info and the JPEG map
+    """
+    global _client
+    if _client is None:
+        _client = Client(pool_size=2, read_timeout=60)
+
+    parameters = {**location, "today": day, "delta": 0}
+    # the digest waits behind the interactive requests for the quotas of the providers
+    headers = {"X-Priority": "background"}
+
+    res_weather = _client.get(f"{business_layer_url}/weather", params=parameters, headers=headers)
+    res_weather.raise_for_status()
+
+    res_map = _client.get(f"{business_layer_url}/map", params={**parameters, "format": "png"}, headers=headers)
+    res_map.raise_for_status()
+
+    output = BytesIO()
+    Image.open(BytesIO(res_map.content)).convert("RGB").save(output, "JPEG", quality=85)
+
+    return res_weather.json(), output.getvalue()
+
+
+def bucket(location: Dict[str, float], zoom: int) -> Tuple[Tuple[int, int, int], Dict[str, float]]:
+    """Returns the cell of the tile grid containing the location and the coordinates of its center
+
+    Args:
+        location (Dict[str, float]): coordinates of the location
+        zoom (int): zoom of the tile grid, the cells of the business layer are the ones of zoom 15
+
+    Returns:
+        Tuple: the cell and the coordinates of its center
+    """
+    n = 2.0 ** zoom
+    lat = math.radians(float(location["lat"]))
+    x = math.floor((float(location["lon"]) + 180.0) / 360.0 * n)
+    y = math.floor((1.0 - math.asinh(math.tan(lat)) / math.pi) / 2.0 * n)
+
+    center_lon = (x + 0.5) / n * 360.0 - 180.0
+    center_lat = math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * (y + 0.5) / n))))
+
+    return (zoom, x, y), {"lat": round(center_lat, 6), "lon": round(center_lon, 6)}
+
+
+def caption(weather: Dict) -> str:
+    lines = [f"{key.replace('_', ' ').capitalize()}: {value}" for key, value in weather["info"].items()]
+    return "☀ Good morning! The weather of today in your favourite location:\n" + "\n".join(lines)
+
+
+class RateLimitedSender:
+    """Sends messages to Telegram within its limits, on a pool of threads.
+
+    At most `rate` messages per second are sent overall, and a chat receives a message
+    at most every `chat_interval` seconds. When Telegram asks to retry after some time
+    all the sends pause for that time and the message is retried, network errors are
+    retried up to `retries` times.
+    """
+
+    def __init__(self, rate: float = 25, chat_interval: float = 1.0, workers: int = 8, retries: int = 3) -> None:
+        self.interval = 1 / rate
+        self.chat_interval = chat_interval
+        self.retries = retries
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="digest-send")
+        self.lock = threading.Lock()
+
+        self.next_slot = 0.0
+        self.chats: Dict[int, float] = {}
+
+        self.sent = 0
+        self.retried = 0
+        self.throttled = 0
+        self.throttled_seconds = 0.0
+
+    def submit(self, chat_id: int, send: Callable[[], Any]) -> Future:
+        """Sends a message in background
+
+        Args:
+            chat_id (int): chat receiving the message
+            send (Callable): sends the message, returning the sent message
+
+        Returns:
+            Future: the result of `send`
+        """
+        return self.pool.submit(self._send, chat_id, send)
+
+    def acquire(self, chat_id: int) -> None:
+        """Waits for the next free slot of both the global and the chat limit"""
+        with self.lock:
+            now = time.monotonic()
+            at = max(now, self.next_slot, self.chats.get(chat_id, 0.0))
+            self.next_slot = at + self.interval
+            self.chats[chat_id] = at + self.chat_interval
+
+            # the chats whose interval has passed do not limit anymore
+            if len(self.chats) > 10000:
+                self.chats = {chat: free_at for chat, free_at in self.chats.items() if free_at > now}
+
+        if at > now:
+            time.sleep(at - now)
+
+    def pause(self, seconds: float) -> None:
+        """Delays all the sends, when Telegram asks to retry later"""
+        with self.lock:
+            self.next_slot = max(self.next_slot, time.monotonic() + seconds)
+            self.throttled += 1
+            self.throttled_seconds += seconds
+
+    def _send(self, chat_id: int, send: Callable[[], Any]) -> Any:
+        attempt = 0
+
+        while True:
+            self.acquire(chat_id)
+
+            try:
+                result = send()
+            except RetryAfter as e:
+                self.pause(e.retry_after)
+            except (TimedOut, NetworkError):
+                if attempt >= self.retries:
+                    raise
+                attempt += 1
+            else:
+                with self.lock:
+                    self.sent += 1
+                return result
+
+            with self.lock:
+                self.retried += 1
+
+    def stats(self) -> Dict[str, float]:
+        with self.lock:
+            return {
+                "sent": self.sent,
+                "retried": self.retried,
+                "throttled": self.throttled,
+                "throttled_seconds": round(self.throttled_seconds, 1),
+            }
+
+
+class DigestState:
+    """Progress of the digest runs, stored in SQLite so that an interrupted run resumes where it stopped.
+
+    A run is identified by its day. Its cursor is the id of the last user of the last
+    page handled completely, while the users of the next pages are recorded as soon as
+    they are handled: a resumed run restarts from the cursor, skipping them.
+    """
+
+    def __init__(self, path: str) -> None:
+        self.lock = threading.Lock()
+
+        self.connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS digest_runs ("
+            "day TEXT PRIMARY KEY, cursor INTEGER NOT NULL, started REAL NOT NULL, finished REAL, "
+            "sent INTEGER NOT NULL DEFAULT 0, failed INTEGER NOT NULL DEFAULT 0)"
+        )
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS digest_handled (day TEXT NOT NULL, user_id INTEGER NOT NULL, "
+            "PRIMARY KEY (day, user_id))"
+        )
+
+    def start(self, day: str) -> Optional[int]:
+        """Starts or resumes the run of the day, returns its cursor or None if the run finished already"""
+        with self.lock:
+            self.connection.execute(
+                "INSERT OR IGNORE INTO digest_runs (day, cursor, started) VALUES (?, 0, ?)", (day, time.time())
+            )
+            cursor, finished = self.connection.execute(
+                "SELECT cursor, finished FROM digest_runs WHERE day = ?", (day,)
+            ).fetchone()
+
+        return None if finished is not None else cursor
+
+    def unfinished(self) -> List[str]:
+        with self.lock:
+            rows = self.connection.execute("SELECT day FROM digest_runs WHERE finished IS NULL").fetchall()
+
+        return [day for day, in rows]
+
+    def handled_users(self, day: str, user_ids: List[int]) -> Set[int]:
+        """Returns the users of the list already handled by the run of the day"""
+        placeholders = ",".join("?" * len(user_ids))
+
+        with self.lock:
+            rows = self.connection.execute(
+                f"SELECT user_id FROM digest_handled WHERE day = ? AND user_id IN ({placeholders})",
+                (day, *user_ids),
+            ).fetchall()
+
+        return {user_id for user_id, in rows}
+
+    def handled(self, day: str, user_id: int, sent: bool) -> None:
+        with self.lock:
+            self.connection.execute("INSERT OR IGNORE INTO digest_handled (day, user_id) VALUES (?, ?)", (day, user_id))
+            column = "sent" if sent else "failed"
+            self.connection.execute(f"UPDATE digest_runs SET {column} = {column} + 1 WHERE day = ?", (day,))
+
+    def advance(self, day: str, cursor: int) -> None:
+        """Moves the cursor after a page handled completely, the users before it are not needed anymore"""
+        with self.lock:
+            self.connection.execute("BEGIN")
+            self.connection.execute("UPDATE digest_runs SET cursor = ? WHERE day = ?", (cursor, day))
+            self.connection.execute("DELETE FROM digest_handled WHERE day = ? AND user_id <= ?", (day, cursor))
+            self.connection.execute("COMMIT")
+
+    def finish(self, day: str) -> Dict[str, int]:
+        """Marks the run of the day as finished and returns its counters"""
+        with self.lock:
+            self.connection.execute("UPDATE digest_runs SET finished = ? WHERE day = ?", (time.time(), day))
+            self.connection.execute("DELETE FROM digest_handled WHERE day = ?", (day,))
+            sent, failed = self.connection.execute(
+                "SELECT sent, failed FROM digest_runs WHERE day = ?", (day,)
+            ).fetchone()
+
+        return {"sent": sent, "failed": failed}
+
+
+class DigestJob:
+    """Sends the weather of the day, with its map, to all the users with a favourite location.
+
+    The users are read in pages of `page_size` from the business layer and grouped by
+    cell of the tile grid of `bucket_zoom`: the weather and the map of a cell are fetched
+    and converted once, on a pool of `processes` processes, for all its users. The map
+    of a cell is uploaded to Telegram once, the other users receive its file_id. The
+    renders of a page run while the messages of the previous one are sent.
+    """
+
+    def __init__(self, bot: Bot, business_layer_url: str, state: DigestState, sender: RateLimitedSender,
+                 processes: int = 2, page_size: int = 500, bucket_zoom: int = 15,
+                 registry: Optional[metrics.Registry] = None) -> None:
+        self.bot = bot
+        self.business_layer_url = business_layer_url
+        self.state = state
+        self.sender = sender
+        self.processes = processes
+        self.page_size = page_size
+        self.bucket_zoom = bucket_zoom
+        self.client = Client(pool_size=2, read_timeout=60)
+        self.running = threading.Lock()
+
+        self.last_run: Dict[str, Any] = {}
+
+        if registry is not None:
+            self.users_served = registry.counter("bot_digest_users_total", "Users handled by the digest, by outcome")
+            self.render_latency = registry.histogram("bot_digest_render_seconds", "Time to fetch and convert a map")
+            registry.collect(self.collect)
+        else:
+            self.users_served = self.render_latency = None
+
+    def pages(self, cursor: int) -> Iterator[List[Dict]]:
+        """Yields the pages of the users with a favourite location after the cursor"""
+        while True:
+            res = self.client.get(f"{self.business_layer_url}/users", params={"after": cursor, "limit": self.page_size})
+            res.raise_for_status()
+            users = res.json()
+
+            if not users:
+                return
+
+            yield users
+            cursor = users[-1]["id"]
+
+            if len(users) < self.page_size:
+                return
+
+    def resume(self) -> None:
+        """Resumes the run of today if it was interrupted, the runs of the previous days are abandoned"""
+        today = date.today().strftime("%Y-%m-%d")
+
+        for day in self.state.unfinished():
+            if day == today:
+                self.run(day)
+            else:
+                self.state.finish(day)
+
+    def run(self, day: Optional[str] = None) -> Optional[Dict[str, Any]]:
+        """Runs or resumes the digest of the day, today by default
+
+        Args:
+            day (str): day of the run, in YYYY-MM-DD format
+
+        Returns:
+            Dict: counters of the run, None if the run finished already or another one is running
+        """
+        day = day or date.today().strftime("%Y-%m-%d")
+
+        if not self.running.acquire(blocking=False):
+            logger.warning("Digest of %s not started, another run is in progress", day)
+            return None
+
+        try:
+            cursor = self.state.start(day)
+            if cursor is None:
+                logger.info("Digest of %s sent already", day)
+                return None
+
+            return self._run(day, cursor)
+        finally:
+            self.running.release()
+
+    def _run(self, day: str, cursor: int) -> Dict[str, Any]:
+        started = time.monotonic()
+        counters = {"users": 0, "skipped": 0, "sent": 0, "failed": 0, "locations": 0}
+        logger.info("Digest of %s started after user %d", day, cursor)
+
+        # the workers are spawned rather than forked, since the bot runs many threads
+        context = multiprocessing.get_context("spawn")
+
+        with ProcessPoolExecutor(max_workers=self.processes, mp_context=context) as pool:
+            previous = None
+
+            for users in self.pages(cursor):
+                handled = self.state.handled_users(day, [user["id"] for user in users])
+                counters["users"] += len(users)
+                counters["skipped"] += len(handled)
+
+                groups: Dict[Tuple, Tuple[Dict, List[int]]] = {}
+                for user in users:
+                    if user["id"] not in handled:
+                        cell, center = bucket(user, self.bucket_zoom)
+                        groups.setdefault(cell, (center, []))[1].append(user["id"])
+
+                renders = {
+                    cell: pool.submit(render_location, self.business_layer_url, center, day)
+                    for cell, (center, _) in groups.items()
+                }
+                counters["locations"] += len(renders)
+
+                # the messages of the previous page are sent while this one renders
+                if previous is not None:
+                    self.deliver(day, *previous, counters)
+                previous = (users[-1]["id"], groups, renders)
+
+            if previous is not None:
+                self.deliver(day, *previous, counters)
+
+        self.state.finish(day)
+
+        elapsed = time.monotonic() - started
+        served = counters["sent"] + counters["failed"]
+        self.last_run = {
+            "day": day,
+            **counters,
+            "elapsed": round(elapsed, 1),
+            "users_per_minute": round(served / elapsed * 60, 1) if elapsed else 0,
+            "sender": self.sender.stats(),
+        }
+        logger.info("Digest of %s finished: %s", day, self.last_run)
+
+        return self.last_run
+
+    def deliver(self, day: str, cursor: int, groups: Dict, renders: Dict[Tuple, Future], counters: Dict) -> None:
+        """Sends the rendered maps of a page to their users, then moves the cursor after the page"""
+        sends = []
+        failed = []
+        submitted = time.monotonic()
+
+        cells = {future: cell for cell, future in renders.items()}
+
+        for future in as_completed(cells):
+            cell = cells[future]
+            _, user_ids = groups[cell]
+
+            try:
+                weather, image = future.result()
+            except Exception as e:
+                logger.warning("Digest map of cell %s not available: %r", cell, e)
+                failed.extend(user_ids)
+                continue
+
+            if self.render_latency is not None:
+                self.render_latency.observe(time.monotonic() - submitted)
+
+            text = caption(weather)
+
+            # the first user uploads the map, the other ones reuse its file_id
+            upload = self.sender.submit(user_ids[0], self.send_photo(user_ids[0], image, text))
+            sends.append((user_ids[0], upload))
+
+            for user_id in user_ids[1:]:
+                sends.append((user_id, self.sender.submit(user_id, self.send_photo(user_id, image, text, upload))))
+
+        wait([future for _, future in sends])
+
+        # without any map the business layer is down: the run stops before the page, to be resumed
+        if failed and not sends:
+            raise RuntimeError(f"Digest of {day} interrupted, the business layer returned no map of the page")
+
+        for user_id in failed:
+            self.handled(day, user_id, False, counters)
+
+        for user_id, future in sends:
+            error = future.exception()
+            if error is not None:
+                logger.info("Digest not sent to %d: %r", user_id, error)
+            self.handled(day, user_id, error is None, counters)
+
+        self.state.advance(day, cursor)
+
+    def send_photo(self, chat_id: int, image: bytes, text: str, upload: Optional[Future] = None) -> Callable[[], Message]:
+        """Returns the function sending the map, with the file_id of the upload of another user when given"""
+
+        def send():
+            photo = None
+
+            if upload is not None:
+                try:
+                    photo = upload.result().photo[-1].file_id
+                except (TelegramError, IndexError):
+                    # the upload failed, this user uploads the map again
+                    pass
+
+            return self.bot.send_photo(chat_id=chat_id, photo=photo or BytesIO(image), caption=text)
+
+        return send
+
+    def handled(self, day: str, user_id: int, sent: bool, counters: Dict) -> None:
+        self.state.handled(day, user_id, sent)
+        counters["sent" if sent else "failed"] += 1
+
+        if self.users_served is not None:
+            self.users_served.inc(outcome="sent" if sent else "failed")
+
+    def collect(self):
+        """Yields the counters of the sender and the throughput of the last run as metrics"""
+        for key, value in self.sender.stats().items():
+            yield f"bot_digest_sender_{key}", "gauge", f"Digest sender {key.replace('_', ' ')}", {}, value
+
+        if self.last_run:
+            yield ("bot_digest_users_per_minute", "gauge", "Users served per minute by the last digest run",
+                   {}, self.last_run["users_per_minute"])
@@ -1,21 +1,39 @@
+import hashlib
+import logging
 import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from functools import partial, wraps
+from queue import Queue
 from dotenv import load_dotenv
 from typing import List, Tuple, Dict, Any, Callable
 from time import sleep
-import requests as r
 from PIL import Image
 from io import BytesIO
 
+import metrics
+from cache import LRUCache
+from client import Client
+from digest import DigestJob, DigestState, RateLimitedSender
+from persistence import SQLitePersistence
+from scheduler import ChatDispatcher
+
 from telegram import (
     Bot,
     InlineKeyboardMarkup,
     InlineKeyboardButton,
+    InputMediaPhoto,
+    Message,
     Update,
     MessageAutoDeleteTimerChanged,
 )
+from telegram.error import BadRequest
+from telegram.utils.request import Request
 
 from telegram.ext import (
     Updater,
+    JobQueue,
     CommandHandler,
     MessageHandler,
     Filters,
@@ -24,13 +42,159 @@ from telegram.ext import (
     CallbackContext,
 )
 
-BUSINESS_LAYER_URL = "business-layer/api/v1"
-
 # Load environment variables
 load_dotenv()
 TELEGRAM_TOKEN = os.getenv("TELEGRAM_TOKEN")
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL", "https://api.telegram.org/bot")
+
+BUSINESS_LAYER_HOST = os.getenv("BUSINESS_LAYER_HOST", "business-layer")
+BUSINESS_LAYER_URL = f"{BUSINESS_LAYER_HOST}/api/v1"
+
+# How the updates are received: "polling" or "webhook". In webhook mode the bot listens on WEBHOOK_LISTEN:WEBHOOK_PORT
+# for the updates posted on WEBHOOK_PATH, and registers that path under WEBHOOK_URL, its public base url, on Telegram.
+# Anyone who knows the path can post updates, so it is derived from the token unless set to a random string of at
+# least WEBHOOK_PATH_MIN_LENGTH characters
+BOT_MODE = os.getenv("BOT_MODE", "polling")
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")
+WEBHOOK_LISTEN = os.getenv("WEBHOOK_LISTEN", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", 8443))
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH") or hashlib.sha256(f"webhook:{TELEGRAM_TOKEN}".encode()).hexdigest()
+WEBHOOK_PATH_MIN_LENGTH = 32
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv("WEBHOOK_MAX_CONNECTIONS", 40))
+
+# Updates handled concurrently (the ones of a chat are always handled in order), updates queued or
+# running before the bot stops reading new ones, and interval (seconds) of the statistics log, 0 to disable it
+BOT_WORKERS = int(os.getenv("BOT_WORKERS", 16))
+BOT_MAX_PENDING = int(os.getenv("BOT_MAX_PENDING", 256))
+BOT_STATS_INTERVAL = int(os.getenv("BOT_STATS_INTERVAL", 60))
+
+# Metrics: port serving them on /metrics (0 disables it) and sampling profiler served on /debug/profile?seconds=N
+METRICS_PORT = int(os.getenv("METRICS_PORT", 9090))
+PROFILER_ENABLED = os.getenv("PROFILER_ENABLED", "false").lower() == "true"
+
+logger = logging.getLogger(__name__)
+
+# Sessions of the users: SQLite database keeping them across restarts (empty to keep them in memory only),
+# interval (seconds) and number of changed sessions after which they are written in background
+PERSISTENCE_FILE = os.getenv("PERSISTENCE_FILE", "sessions.sqlite3")
+PERSISTENCE_FLUSH_INTERVAL = float(os.getenv("PERSISTENCE_FLUSH_INTERVAL", 1))
+PERSISTENCE_BATCH_SIZE = int(os.getenv("PERSISTENCE_BATCH_SIZE", 100))
+
+# Telegram file_id of the maps already sent, by map id: lifetime (seconds) and maps kept in memory
+MAP_FILE_ID_TTL = int(os.getenv("MAP_FILE_ID_TTL", 24 * 60 * 60))
+MAP_FILE_ID_ENTRIES = int(os.getenv("MAP_FILE_ID_ENTRIES", 10000))
+
+# Weather replies: the map is rendered while the weather is fetched, and attached to the reply within MAP_TIMEOUT
+# seconds. Until then the reply shows a placeholder image, which stays with a note if the map is not available.
+MAP_TIMEOUT = float(os.getenv("MAP_TIMEOUT", 30))
+MAP_PLACEHOLDER_COLOR = (235, 235, 235)
+MAP_PLACEHOLDER_ID = "placeholder"
+
+# Daily digest: time (HH:MM, local time of the bot) the users with a favourite location receive its weather and map,
+# empty to disable it. The users are read in pages of DIGEST_PAGE_SIZE and grouped by cell of the tile grid of
+# DIGEST_BUCKET_ZOOM, the maps of the cells are fetched and converted by DIGEST_PROCESSES processes, and the progress
+# is kept in DIGEST_STATE_FILE to resume an interrupted run at the next start.
+DIGEST_TIME = os.getenv("DIGEST_TIME", "")
+DIGEST_PAGE_SIZE = int(os.getenv("DIGEST_PAGE_SIZE", 500))
+DIGEST_BUCKET_ZOOM = int(os.getenv("DIGEST_BUCKET_ZOOM", 15))
+DIGEST_PROCESSES = int(os.getenv("DIGEST_PROCESSES", os.cpu_count() or 1))
+DIGEST_STATE_FILE = os.getenv("DIGEST_STATE_FILE", "digest.sqlite3")
+
+# Limits of the digest messages, below the ones of Telegram to leave room for the replies: messages per second overall,
+# seconds between the messages of a chat, and threads sending them
+DIGEST_RATE = float(os.getenv("DIGEST_RATE", 25))
+DIGEST_CHAT_INTERVAL = float(os.getenv("DIGEST_CHAT_INTERVAL", 1))
+DIGEST_SEND_WORKERS = int(os.getenv("DIGEST_SEND_WORKERS", 8))
+
+# The map id of the reports only depends on the location, the day, the weather and the precipitation frame, so the
+# same id is always the same map
+map_file_ids = LRUCache(MAP_FILE_ID_ENTRIES, sizeof=lambda file_id: 1)
+
+# Maps being fetched while the weather replies are sent, a fetch per handler at most
+map_pool = ThreadPoolExecutor(max_workers=BOT_WORKERS, thread_name_prefix="map")
+
+# Latency of the handlers and of the calls to Telegram, the calls to the business layer are recorded by its client
+registry = metrics.Registry()
+handler_latency = registry.histogram("bot_handler_duration_seconds", "Latency of the handlers of the updates")
+telegram_latency = registry.histogram("bot_telegram_request_duration_seconds", "Latency of the slow Telegram calls")
+uploaded_bytes = registry.counter("bot_uploaded_bytes_total", "Bytes of the maps uploaded to Telegram")
+weather_reply_latency = registry.histogram(
+    "bot_weather_reply_seconds", "Time from the weather update to its reply and to its map, by part"
+)
+
+# HTTP client of the business layer
+business_layer = Client(
+    pool_size=int(os.getenv("POOL_SIZE", BOT_WORKERS)),
+    connect_timeout=float(os.getenv("CONNECT_TIMEOUT", 3.05)),
+    read_timeout=float(os.getenv("READ_TIMEOUT", 30)),
+    retries=int(os.getenv("RETRIES", 2)),
+    backoff=float(os.getenv("RETRY_BACKOFF", 0.1)),
+    breaker_threshold=int(os.getenv("BREAKER_THRESHOLD", 5)),
+    breaker_reset=float(os.getenv("BREAKER_RESET", 30)),
+    registry=registry,
+)
 
 # Helper functions
+def timed(callback: Callable) -> Callable:
+    """Wraps a handler to start a new trace for each update and record its latency
+
+    Args:
+        callback (Callable): the handler to wrap
+
+    Returns:
+        Callable: the wrapped handler
+    """
+    @wraps(callback)
+    def handler(update: Update, context: CallbackContext) -> Any:
+        metrics.trace.set(metrics.new_trace_id())
+
+        with handler_latency.time(handler=callback.__name__):
+            return callback(update, context)
+
+    return handler
+
+def placeholder_image() -> bytes:
+    """Returns the PNG image shown in the weather replies until their map is attached
+
+    Returns:
+        bytes: the encoded image, as large as the maps
+    """
+    output = BytesIO()
+    Image.new("RGB", (512, 512), MAP_PLACEHOLDER_COLOR).save(output, "PNG")
+    return output.getvalue()
+
+def fetch_map(map_path: str) -> Tuple[str, bytes]:
+    """Fetches the map referenced by a weather report from the business layer, which renders it along with the report
+
+    Args:
+        map_path (str): path of the map in the report, like "/api/v1/map/<id>"
+
+    Returns:
+        Tuple[str, bytes]: the map id and the PNG image
+    """
+    res = business_layer.get(f"http://{BUSINESS_LAYER_HOST}{map_path}")
+    res.raise_for_status()
+
+    return map_path.rsplit("/", 1)[-1], res.content
+
+def collect_bot(dispatcher: ChatDispatcher):
+    """Yields the counters of the update scheduler, of the map file ids and of the persistence as metrics
+
+    Args:
+        dispatcher (ChatDispatcher): the dispatcher of the bot
+    """
+    sources = {
+        "scheduler": dispatcher.scheduler.stats(),
+        "map_file_ids": map_file_ids.stats(),
+    }
+
+    if dispatcher.persistence:
+        sources["persistence"] = dispatcher.persistence.stats()
+
+    for source, stats in sources.items():
+        for key, value in stats.items():
+            yield f"bot_{source}_{key}", "gauge", f"{source.replace('_', ' ').capitalize()} {key}", {}, value
+
 def CQH(callback: Callable, pattern: str) -> CallbackQueryHandler:
     """Shorthand function for CallbackQueryHandler
 
@@ -41,7 +205,7 @@ def CQH(callback: Callable, pattern: str) -> CallbackQueryHandler:
     Returns:
         CallbackQueryHandler: the actual handler
     """
-    return CallbackQueryHandler(callback, pattern="^" + pattern + "$")
+    return CallbackQueryHandler(timed(callback), pattern="^" + pattern + "$")
 
 # States and constants
 (
@@ -72,19 +236,40 @@ class TelegramBot:
         pass
 
     def run(self) -> None:
-        updater = Updater(TELEGRAM_TOKEN, use_context=True)
-        dispatcher = updater.dispatcher
+        # a connection to Telegram for every worker and digest sender, plus the ones of the updater
+        connections = BOT_WORKERS + 4 + (DIGEST_SEND_WORKERS if DIGEST_TIME else 0)
+        bot = Bot(TELEGRAM_TOKEN, base_url=TELEGRAM_API_URL, request=Request(con_pool_size=connections))
+        job_queue = JobQueue()
+        persistence = None
+
+        if PERSISTENCE_FILE:
+            persistence = SQLitePersistence(PERSISTENCE_FILE, PERSISTENCE_FLUSH_INTERVAL, PERSISTENCE_BATCH_SIZE)
+
+        dispatcher = ChatDispatcher(
+            bot,
+            Queue(),
+            job_queue=job_queue,
+            persistence=persistence,
+            chat_workers=BOT_WORKERS,
+            max_pending=BOT_MAX_PENDING,
+        )
+        job_queue.set_dispatcher(dispatcher)
+        updater = Updater(dispatcher=dispatcher, workers=None)
+
+        if METRICS_PORT:
+            registry.collect(lambda: collect_bot(dispatcher))
+            metrics.serve(registry, METRICS_PORT, profiler=metrics.SamplingProfiler() if PROFILER_ENABLED else None)
 
         main_handler = ConversationHandler(
-            entry_points=[CommandHandler("start", self.start)],
+            entry_points=[CommandHandler("start", timed(self.start))],
             states={
                 SELECT_INPUT: [
                     CQH(self.use_fav_location, FAV_LOCATION),
                     CQH(self.ask_for_location, SEARCH_LOCATION),
                 ],
                 SEARCH_LOCATION: [
-                    MessageHandler((Filters.text | Filters.location), self.verify_location),
-                    MessageHandler(~(Filters.text | Filters.location), self.wrong_location),
+                    MessageHandler((Filters.text | Filters.location), timed(self.verify_location)),
+                    MessageHandler(~(Filters.text | Filters.location), timed(self.wrong_location)),
                 ],
                 WEATHER: [
                     CQH(self.yesterday, YESTERDAY),
@@ -101,13 +286,64 @@ class TelegramBot:
                 ],
             },
             fallbacks=[
-                CommandHandler("end", self.cancel),
+                CommandHandler("end", timed(self.cancel)),
             ],
+            name="main",
+            persistent=persistence is not None,
         )
 
         dispatcher.add_handler(main_handler)
 
-        updater.start_polling()
+        if BOT_STATS_INTERVAL > 0:
+            job_queue.run_repeating(self.log_stats, BOT_STATS_INTERVAL)
+
+        if DIGEST_TIME:
+            digest = DigestJob(
+                bot,
+                f"http://{BUSINESS_LAYER_URL}",
+                DigestState(DIGEST_STATE_FILE),
+                RateLimitedSender(DIGEST_RATE, DIGEST_CHAT_INTERVAL, DIGEST_SEND_WORKERS),
+                processes=DIGEST_PROCESSES,
+                page_size=DIGEST_PAGE_SIZE,
+                bucket_zoom=DIGEST_BUCKET_ZOOM,
+                registry=registry if METRICS_PORT else None,
+            )
+            job_queue.run_daily(lambda context: digest.run(), datetime.strptime(DIGEST_TIME, "%H:%M").time())
+            # a run interrupted by a crash or a restart continues now
+            job_queue.run_once(lambda context: digest.resume(), 0)
+
+        if BOT_MODE == "webhook":
+            if not WEBHOOK_URL:
+                raise ValueError("WEBHOOK_URL must be set in webhook mode")
+            if len(WEBHOOK_PATH) < WEBHOOK_PATH_MIN_LENGTH:
+                raise ValueError(
+                    f"WEBHOOK_PATH must be a random string of at least {WEBHOOK_PATH_MIN_LENGTH} characters"
+                )
+
+            updater.start_webhook(
+                listen=WEBHOOK_LISTEN,
+                port=WEBHOOK_PORT,
+                url_path=WEBHOOK_PATH,
+                webhook_url=f"{WEBHOOK_URL.rstrip('/')}/{WEBHOOK_PATH}",
+                max_connections=WEBHOOK_MAX_CONNECTIONS,
+            )
+        else:
+            updater.start_polling()
+
+        # the worker pools only accept updates while the main thread is alive
+        updater.idle()
+
+    def log_stats(self, context: CallbackContext) -> None:
+        """Logs the counters of the update scheduler, to monitor the backpressure
+
+        Args:
+            context (CallbackContext): telegram context object
+        """
+        logger.info("Update scheduler: %s", context.dispatcher.scheduler.stats())
+        logger.info("Map file ids: %s", map_file_ids.stats())
+
+        if context.dispatcher.persistence:
+            logger.info("Persistence: %s", context.dispatcher.persistence.stats())
     
     def start(self, update: Update, context: CallbackContext) -> int:
         """Starts the bot conversation and asks the user to select input method.
@@ -120,7 +356,7 @@ class TelegramBot:
             int: New state of the conversation
         """
 
-        res = r.get(f"http://{BUSINESS_LAYER_URL}/user/{update.message.from_user.id}")
+        res = business_layer.get(f"http://{BUSINESS_LAYER_URL}/user/{update.message.from_user.id}")
         user_location = res.json()
 
         context.user_data["user_id"] = update.message.from_user.id
@@ -190,7 +426,7 @@ class TelegramBot:
             context.user_data["location"] = dict(location=update.message.text)
 
         #check if location is valid
-        res = r.get(f"http://{BUSINESS_LAYER_URL}/weather", params=context.user_data["location"])
+        res = business_layer.get(f"http://{BUSINESS_LAYER_URL}/weather", params=context.user_data["location"])
 
         if res.status_code != 200:
             search_message.edit_text("I couldn't find the weather in the provided location location. Try again.")
@@ -205,6 +441,7 @@ class TelegramBot:
 
     def weather(self, update: Update, context: CallbackContext) -> int:
 
+        started = time.perf_counter()
         parameters = context.user_data["location"]
 
         if context.user_data.get("tomorrow") != None:
@@ -216,14 +453,11 @@ class TelegramBot:
         if context.user_data.get("today"):
             parameters["today"] = context.user_data["today"]
             
-        # Get map image
-        res_map = r.get(f"http://{BUSINESS_LAYER_URL}/map", params=parameters)
-        map_image = BytesIO(res_map.content)
+        # The report has the weather and the reference of its map, which is fetched while the weather is sent
+        res_report = business_layer.get(f"http://{BUSINESS_LAYER_URL}/report", params=parameters)
 
-        # Get weather data
-        res_weather = r.get(f"http://{BUSINESS_LAYER_URL}/weather", params=parameters)
-        
-        weather_info = res_weather.json()
+        weather_info = res_report.json()
+        map_id = weather_info["map"].rsplit("/", 1)[-1]
 
         weather_condition = weather_info['info']["weather_condition"]
         weather_data = "\n".join([f"{k.replace('_', ' ').capitalize()}: {v}" for k,v in weather_info['info'].items()])
@@ -289,16 +523,123 @@ class TelegramBot:
 
         keyboard = InlineKeyboardMarkup(buttons)
 
-        update.message.reply_photo(
-            photo=map_image,
-            caption=weather_data,
-            reply_markup=keyboard,
-        )
+        # a map sent before is sent together with the weather, without rendering nor downloading it
+        if self.send_known_map(update, map_id, weather_data, keyboard):
+            context.user_data["_temp"].delete()
+            weather_reply_latency.observe(time.perf_counter() - started, part="text")
+            weather_reply_latency.observe(time.perf_counter() - started, part="map")
+            return WEATHER
 
+        map_future = map_pool.submit(metrics.in_context(partial(fetch_map, weather_info["map"])))
+        message = self.send_placeholder(update, weather_data, keyboard)
         context.user_data["_temp"].delete()
+        weather_reply_latency.observe(time.perf_counter() - started, part="text")
+
+        try:
+            map_id, map_image = map_future.result(timeout=MAP_TIMEOUT)
+        except Exception as e:
+            # the reply keeps the weather and the buttons, only the map is missing
+            logger.warning("Map not available: %r", e)
+            message.edit_caption(
+                caption=f"{weather_data}\n\nThe map is not available right now.",
+                reply_markup=keyboard,
+            )
+            return WEATHER
+
+        self.attach_map(message, map_id, map_image, weather_data, keyboard)
+        weather_reply_latency.observe(time.perf_counter() - started, part="map")
 
         return WEATHER
-    
+
+    def send_known_map(self, update: Update, map_id: str, caption: str, keyboard: InlineKeyboardMarkup) -> bool:
+        """Sends the map by its Telegram file_id, if it was uploaded before
+
+        Args:
+            update (Update): telegram update object
+            map_id (str): id of the map in the report
+            caption (str): caption of the photo
+            keyboard (InlineKeyboardMarkup): keyboard of the photo
+
+        Returns:
+            bool: whether the map was sent, False if its file_id is not known or not available anymore
+        """
+        file_id = map_file_ids.get(map_id)
+
+        if file_id is None:
+            return False
+
+        try:
+            with telegram_latency.time(call="send_file_id"):
+                update.message.reply_photo(photo=file_id, caption=caption, reply_markup=keyboard)
+            return True
+        except BadRequest:
+            # the file is not available anymore, the map is fetched and uploaded again
+            map_file_ids.delete(map_id)
+            return False
+
+    def send_placeholder(self, update: Update, caption: str, keyboard: InlineKeyboardMarkup) -> Message:
+        """Sends the weather with the placeholder image, which is replaced by the map once it is ready
+
+        Args:
+            update (Update): telegram update object
+            caption (str): caption of the photo
+            keyboard (InlineKeyboardMarkup): keyboard of the photo
+
+        Returns:
+            Message: the sent message
+        """
+        file_id = map_file_ids.get(MAP_PLACEHOLDER_ID)
+
+        if file_id is not None:
+            try:
+                with telegram_latency.time(call="send_placeholder"):
+                    return update.message.reply_photo(photo=file_id, caption=caption, reply_markup=keyboard)
+            except BadRequest:
+                map_file_ids.delete(MAP_PLACEHOLDER_ID)
+
+        with telegram_latency.time(call="upload_placeholder"):
+            message = update.message.reply_photo(
+                photo=BytesIO(placeholder_image()),
+                caption=caption,
+                reply_markup=keyboard,
+            )
+
+        map_file_ids.set(MAP_PLACEHOLDER_ID, message.photo[-1].file_id, MAP_FILE_ID_TTL)
+        return message
+
+    def attach_map(
+        self, message: Message, map_id: str, map_image: bytes, caption: str, keyboard: InlineKeyboardMarkup
+    ) -> None:
+        """Replaces the placeholder image of a weather reply with the map, uploading it only the first time
+
+        Args:
+            message (Message): the weather reply with the placeholder
+            map_id (str): id of the map in the report
+            map_image (bytes): the map image, uploaded if its file_id is not known
+            caption (str): caption of the photo
+            keyboard (InlineKeyboardMarkup): keyboard of the photo
+        """
+        file_id = map_file_ids.get(map_id)
+
+        if file_id is not None:
+            try:
+                with telegram_latency.time(call="edit_file_id"):
+                    message.edit_media(media=InputMediaPhoto(file_id, caption=caption), reply_markup=keyboard)
+                return
+            except BadRequest:
+                map_file_ids.delete(map_id)
+
+        uploaded_bytes.inc(len(map_image))
+
+        with telegram_latency.time(call="edit_upload"):
+            edited = message.edit_media(
+                media=InputMediaPhoto(BytesIO(map_image), caption=caption),
+                reply_markup=keyboard,
+            )
+
+        if isinstance(edited, Message) and edited.photo:
+            map_file_ids.set(map_id, edited.photo[-1].file_id, MAP_FILE_ID_TTL)
+
     def yesterday(self, update: Update, context: CallbackContext) -> int:
         context.user_data["delta"] = -1
         update.message = update.callback_query.message
@@ -313,7 +654,7 @@ class TelegramBot:
     
     def save_fav_location(self, update: Update, context: CallbackContext) -> int:
         
-        res = r.patch(f"http://{BUSINESS_LAYER_URL}/user/{context.user_data['user_id']}", json=context.user_data["location"])
+        res = business_layer.patch(f"http://{BUSINESS_LAYER_URL}/user/{context.user_data['user_id']}", json=context.user_data["location"])
         if res.status_code == 200:
             update.callback_query.answer("Location saved as favourite!")
             context.user_data["fav_location"] = res.json()
@@ -346,7 +687,7 @@ class TelegramBot:
         }
 
         # Get places data
-        res_places = r.get(f"http://{BUSINESS_LAYER_URL}/places", params=parameters)
+        res_places = business_layer.get(f"http://{BUSINESS_LAYER_URL}/places", params=parameters)
         res_places = res_places.json()
 
         # define buttons with places to visit
@@ -416,6 +757,10 @@ class TelegramBot:
         return ConversationHandler.END
 
 if __name__ == "__main__":
+    logging.basicConfig(format="%(asctime)s %(name)s %(levelname)s [%(trace)s] %(message)s", level=logging.INFO)
+    for log_handler in logging.root.handlers:
+        log_handler.addFilter(metrics.TraceFilter())
+
     bot = TelegramBot()
     bot.run()
     
\ No newline at end of file
@@ -0,0 +1,305 @@
+import contextvars
+import logging
+import os
+import sys
+import threading
+import time
+import uuid
+from collections import Counter as Tally
+from contextlib import contextmanager
+from functools import partial
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+# Upper bounds (seconds) of the buckets of the latency histograms
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+# Header carrying the trace id of a request from the bot to the business layer and the data layer
+TRACE_HEADER = "X-Request-ID"
+
+# Content type of the Prometheus text exposition format
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# Trace id of the request being handled by the current thread or task
+trace = contextvars.ContextVar("trace", default=None)
+
+
+def new_trace_id() -> str:
+    return uuid.uuid4().hex[:16]
+
+
+def in_context(function):
+    """Binds the function to a copy of the current context, so it keeps the trace id on another thread"""
+    return partial(contextvars.copy_context().run, function)
+
+
+class TraceFilter(logging.Filter):
+    """Adds the trace id of the current context to the log records as `trace`"""
+
+    def filter(self, record) -> bool:
+        record.trace = trace.get() or "-"
+        return True
+
+
+def format_labels(labels) -> str:
+    if not labels:
+        return ""
+
+    def escape(value):
+        return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+    return "{" + ",".join(f'{name}="{escape(value)}"' for name, value in labels) + "}"
+
+
+def format_value(value) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value))
+
+
+class Metric:
+    """Values of a metric by label set"""
+
+    kind = "untyped"
+
+    def __init__(self, name, help) -> None:
+        self.name = name
+        self.help = help
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def samples(self):
+        """Yields the name suffix, the labels and the value of every sample"""
+        with self.lock:
+            values = dict(self.values)
+
+        for labels, value in values.items():
+            yield "", labels, value
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels) -> None:
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def set(self, value, **labels) -> None:
+        with self.lock:
+            self.values[tuple(sorted(labels.items()))] = value
+
+    def inc(self, amount=1, **labels) -> None:
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels) -> None:
+        self.inc(-amount, **labels)
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help, buckets=LATENCY_BUCKETS) -> None:
+        super().__init__(name, help)
+        self.buckets = tuple(sorted(buckets)) + (float("inf"),)
+
+    def observe(self, value, **labels) -> None:
+        key = tuple(sorted(labels.items()))
+
+        with self.lock:
+            if key not in self.values:
+                self.values[key] = [[0] * len(self.buckets), 0.0, 0]
+
+            counts, _, _ = entry = self.values[key]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+                    break
+            entry[1] += value
+            entry[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        """Observes the seconds spent in the block"""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def samples(self):
+        with self.lock:
+            values = {key: (list(counts), total, count) for key, (counts, total, count) in self.values.items()}
+
+        for labels, (counts, total, count) in values.items():
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                yield "_bucket", labels + (("le", format_value(bound)),), cumulative
+            yield "_sum", labels, total
+            yield "_count", labels, count
+
+
+class Registry:
+    """Metrics of a service, rendered in the Prometheus text format.
+
+    Besides the metrics updated by the code, collectors are called on every render
+    to read the counters that other objects already keep, like the cache statistics:
+    they yield (name, kind, help, labels, value) tuples.
+    """
+
+    def __init__(self) -> None:
+        self.metrics = {}
+        self.collectors = []
+        self.lock = threading.Lock()
+
+    def register(self, metric):
+        with self.lock:
+            return self.metrics.setdefault(metric.name, metric)
+
+    def counter(self, name, help) -> Counter:
+        return self.register(Counter(name, help))
+
+    def gauge(self, name, help) -> Gauge:
+        return self.register(Gauge(name, help))
+
+    def histogram(self, name, help, buckets=LATENCY_BUCKETS) -> Histogram:
+        return self.register(Histogram(name, help, buckets))
+
+    def collect(self, collector) -> None:
+        with self.lock:
+            self.collectors.append(collector)
+
+    def render(self) -> str:
+        with self.lock:
+            metrics = list(self.metrics.values())
+            collectors = list(self.collectors)
+
+        lines = []
+
+        for metric in metrics:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            for suffix, labels, value in metric.samples():
+                lines.append(f"{metric.name}{suffix}{format_labels(labels)} {format_value(value)}")
+
+        collected = {}
+        for collector in collectors:
+            for name, kind, help, labels, value in collector():
+                collected.setdefault(name, (kind, help, []))[2].append((tuple(sorted(labels.items())), value))
+
+        for name, (kind, help, samples) in collected.items():
+            lines.append(f"# HELP {name} {help}")
+            lines.append(f"# TYPE {name} {kind}")
+            for labels, value in samples:
+                lines.append(f"{name}{format_labels(labels)} {format_value(value)}")
+
+        return "\n".join(lines) + "\n"
+
+
+class SamplingProfiler:
+    """Samples the stacks of all the threads every `interval` seconds while it runs.
+
+    The samples are counted by stack in the folded format of the flame graph tools:
+    the frames from the outermost one separated by semicolons, then the count.
+    Only one profile runs at a time.
+    """
+
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.stopping = threading.Event()
+        self.thread = None
+        self.stacks = Tally()
+
+    def start(self, interval=0.01) -> bool:
+        """Starts sampling, returns False if a profile is running already"""
+        with self.lock:
+            if self.thread is not None:
+                return False
+
+            self.stacks = Tally()
+            self.stopping.clear()
+            self.thread = threading.Thread(target=self._sample, args=(interval,), name="profiler", daemon=True)
+            self.thread.start()
+            return True
+
+    def stop(self) -> str:
+        """Stops sampling and returns the folded stacks, most sampled first"""
+        with self.lock:
+            thread, self.thread = self.thread, None
+
+        if thread is not None:
+            self.stopping.set()
+            thread.join()
+
+        return "".join(f"{stack} {count}\n" for stack, count in self.stacks.most_common())
+
+    def profile(self, seconds, interval=0.01):
+        """Samples for the given seconds and returns the folded stacks, None if a profile is running already"""
+        if not self.start(interval):
+            return None
+
+        time.sleep(seconds)
+        return self.stop()
+
+    def _sample(self, interval) -> None:
+        own = threading.get_ident()
+
+        while not self.stopping.wait(interval):
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                    frame = frame.f_back
+
+                self.stacks[";".join(reversed(stack))] += 1
+
+
+def serve(registry, port, host="0.0.0.0", profiler=None) -> ThreadingHTTPServer:
+    """Serves the metrics on /metrics, and the profiler on /debug/profile?seconds=N if given, in background"""
+
+    class Handler(BaseHTTPRequestHandler):
+
+        def do_GET(self):
+            url = urlsplit(self.path)
+
+            if url.path == "/metrics":
+                self.reply(200, registry.render(), CONTENT_TYPE)
+            elif url.path == "/debug/profile" and profiler is not None:
+                query = parse_qs(url.query)
+                folded = profiler.profile(
+                    min(float(query.get("seconds", ["10"])[0]), 300),
+                    float(query.get("interval", ["0.01"])[0]),
+                )
+                if folded is None:
+                    self.reply(409, "A profile is running already\n")
+                else:
+                    self.reply(200, folded)
+            else:
+                self.reply(404, "Not found\n")
+
+        def reply(self, status, text, content_type="text/plain; charset=utf-8"):
+            body = text.encode()
+            self.send_response(status)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    return server
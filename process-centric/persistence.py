@@ -0,0 +1,200 @@
+import fcntl
+import json
+import logging
+import sqlite3
+import threading
+import time
+from abc import abstractmethod
+from collections import defaultdict
+from datetime import datetime, timezone
+from typing import Any, DefaultDict, Dict, Optional, Tuple
+
+from telegram import Chat, InlineKeyboardMarkup, Message
+from telegram.ext import BasePersistence
+
+logger = logging.getLogger(__name__)
+
+EPOCH = datetime.fromtimestamp(0, tz=timezone.utc)
+
+
+class WriteBehindPersistence(BasePersistence):
+    """Persistence of the sessions of the bot, written in background in batches.
+
+    The sessions are serialized as compact JSON when the dispatcher updates them:
+    messages are stored as their chat and message ids and keyboards as their
+    dictionary, so the live objects kept in `user_data` are never pickled. The
+    serialized values are written by a background thread every `flush_interval`
+    seconds, or as soon as `batch_size` of them are pending, keeping only the last
+    value of every key, so handling an update never waits for the storage.
+
+    Subclasses implement the storage with the abstract `load` and `write`.
+    """
+
+    def __init__(self, flush_interval: float = 1.0, batch_size: int = 100) -> None:
+        super().__init__(store_user_data=True, store_chat_data=False, store_bot_data=False)
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+
+        self.pending: Dict[Tuple[str, str], str] = {}
+        self.condition = threading.Condition()
+        self.writes = 0
+        self.batches = 0
+
+        self.writer = threading.Thread(target=self._write_behind, name="persistence", daemon=True)
+        self.writer.start()
+
+    @abstractmethod
+    def load(self, kind: str) -> Dict[str, str]:
+        """Returns the stored values of the given kind, by key"""
+
+    @abstractmethod
+    def write(self, batch: Dict[Tuple[str, str], str]) -> None:
+        """Stores the values of the batch, by kind and key, in a single transaction"""
+
+    # Serialization
+
+    def encode(self, value: Any) -> str:
+        def default(item):
+            if isinstance(item, Message):
+                return {"__message__": [item.chat_id, item.message_id]}
+            if isinstance(item, InlineKeyboardMarkup):
+                return {"__keyboard__": item.to_dict()}
+            raise TypeError(f"Cannot persist {type(item).__name__}")
+
+        return json.dumps(value, default=default, separators=(",", ":"))
+
+    def decode(self, value: str) -> Any:
+        def object_hook(item):
+            if "__message__" in item:
+                chat_id, message_id = item["__message__"]
+                return Message(message_id, EPOCH, Chat(chat_id, Chat.PRIVATE), bot=self.bot)
+            if "__keyboard__" in item:
+                return InlineKeyboardMarkup.de_json(item["__keyboard__"], self.bot)
+            return item
+
+        return json.loads(value, object_hook=object_hook)
+
+    # Write behind
+
+    def queue(self, kind: str, key: str, value: Optional[str]) -> None:
+        with self.condition:
+            self.pending[(kind, key)] = value
+
+            if len(self.pending) >= self.batch_size:
+                self.condition.notify()
+
+    def flush(self) -> None:
+        """Writes the pending values right away"""
+        with self.condition:
+            batch, self.pending = self.pending, {}
+
+        if batch:
+            try:
+                self.write(batch)
+            except Exception:
+                logger.exception("Could not persist %d sessions", len(batch))
+                # keep the values for the next attempt, unless newer ones were queued meanwhile
+                with self.condition:
+                    self.pending = {**batch, **self.pending}
+                return
+
+            self.writes += len(batch)
+            self.batches += 1
+
+    def _write_behind(self) -> None:
+        while True:
+            with self.condition:
+                self.condition.wait(self.flush_interval)
+            self.flush()
+
+    def stats(self) -> Dict[str, int]:
+        with self.condition:
+            pending = len(self.pending)
+
+        return {"pending": pending, "writes": self.writes, "batches": self.batches}
+
+    # BasePersistence
+
+    def get_user_data(self) -> DefaultDict[int, Dict]:
+        return defaultdict(dict, {int(key): self.decode(value) for key, value in self.load("user").items()})
+
+    def get_chat_data(self) -> DefaultDict[int, Dict]:
+        return defaultdict(dict)
+
+    def get_bot_data(self) -> Dict:
+        return {}
+
+    def get_conversations(self, name: str) -> Dict:
+        return {
+            tuple(json.loads(key)): json.loads(state)
+            for key, state in self.load(f"conversation:{name}").items()
+        }
+
+    def update_conversation(self, name: str, key: Tuple[int, ...], new_state: Optional[object]) -> None:
+        self.queue(f"conversation:{name}", json.dumps(list(key)), None if new_state is None else json.dumps(new_state))
+
+    def update_user_data(self, user_id: int, data: Dict) -> None:
+        self.queue("user", str(user_id), self.encode(data))
+
+    def update_chat_data(self, chat_id: int, data: Dict) -> None:
+        pass
+
+    def update_bot_data(self, data: Dict) -> None:
+        pass
+
+
+class SQLitePersistence(WriteBehindPersistence):
+    """Sessions of the bot stored in a SQLite database, so that a restarted bot resumes them.
+
+    The sessions are read only when the bot starts, so the database belongs to a
+    single process: a second process opening it fails instead of overwriting the
+    sessions of the first one.
+    """
+
+    def __init__(self, path: str, flush_interval: float = 1.0, batch_size: int = 100) -> None:
+        self.path = path
+        self.lock = threading.Lock()
+
+        # released by the system when the process exits
+        self.owner = open(f"{path}.lock", "w")
+        try:
+            fcntl.flock(self.owner, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            self.owner.close()
+            raise RuntimeError(f"The sessions in {path} are used by another process of the bot") from None
+
+        self.connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS sessions ("
+            "kind TEXT NOT NULL, key TEXT NOT NULL, value TEXT NOT NULL, updated REAL NOT NULL, "
+            "PRIMARY KEY (kind, key))"
+        )
+
+        super().__init__(flush_interval, batch_size)
+
+    def load(self, kind: str) -> Dict[str, str]:
+        with self.lock:
+            rows = self.connection.execute("SELECT key, value FROM sessions WHERE kind = ?", (kind,)).fetchall()
+
+        return dict(rows)
+
+    def write(self, batch: Dict[Tuple[str, str], str]) -> None:
+        now = time.time()
+
+        with self.lock:
+            self.connection.execute("BEGIN")
+            try:
+                for (kind, key), value in batch.items():
+                    if value is None:
+                        self.connection.execute("DELETE FROM sessions WHERE kind = ? AND key = ?", (kind, key))
+                    else:
+                        self.connection.execute(
+                            "INSERT OR REPLACE INTO sessions (kind, key, value, updated) VALUES (?, ?, ?, ?)",
+                            (kind, key, value, now),
+                        )
+                self.connection.execute("COMMIT")
+            except Exception:
+                self.connection.execute("ROLLBACK")
+                raise
@@ -0,0 +1,141 @@
+import logging
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from typing import Any, Callable, Dict, Hashable
+
+from telegram import Update
+from telegram.ext import Dispatcher
+
+logger = logging.getLogger(__name__)
+
+
+class ChatScheduler:
+    """Runs tasks on a bounded pool of workers, in order for the tasks with the same key.
+
+    Tasks of different keys run concurrently on up to `workers` threads, while the
+    tasks of a key are queued and run one after another. At most `max_pending` tasks
+    can be queued or running: beyond that `submit` blocks, so that the producer slows
+    down instead of the queues growing without bound.
+    """
+
+    def __init__(self, workers: int, max_pending: int) -> None:
+        self.workers = workers
+        self.max_pending = max_pending
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="chat")
+        self.slots = threading.BoundedSemaphore(max_pending)
+        self.queues: Dict[Hashable, deque] = {}
+        self.lock = threading.Lock()
+
+        self.pending = 0
+        self.running = 0
+        self.processed = 0
+        self.failed = 0
+        self.blocked = 0
+        self.blocked_seconds = 0.0
+        self.wait_seconds = 0.0
+        self.max_wait_seconds = 0.0
+
+    def submit(self, key: Hashable, task: Callable[[], Any]) -> None:
+        """Queues the task after the other ones of the key, blocking while too many tasks are pending
+
+        Args:
+            key (Hashable): tasks with the same key run in submission order
+            task (Callable): the task to run
+        """
+        if not self.slots.acquire(blocking=False):
+            started = time.monotonic()
+            self.slots.acquire()
+
+            with self.lock:
+                self.blocked += 1
+                self.blocked_seconds += time.monotonic() - started
+
+        with self.lock:
+            self.pending += 1
+            queue = self.queues.get(key)
+
+            if queue is not None:
+                # a worker is already draining the tasks of the key
+                queue.append((time.monotonic(), task))
+                return
+
+            self.queues[key] = deque([(time.monotonic(), task)])
+
+        self.pool.submit(self._drain, key)
+
+    def _drain(self, key: Hashable) -> None:
+        while True:
+            with self.lock:
+                queue = self.queues[key]
+
+                if not queue:
+                    del self.queues[key]
+                    return
+
+                queued_at, task = queue.popleft()
+                waited = time.monotonic() - queued_at
+                self.wait_seconds += waited
+                self.max_wait_seconds = max(self.max_wait_seconds, waited)
+                self.running += 1
+
+            try:
+                task()
+            except Exception:
+                logger.exception("Task of %s failed", key)
+                with self.lock:
+                    self.failed += 1
+            finally:
+                with self.lock:
+                    self.running -= 1
+                    self.pending -= 1
+                    self.processed += 1
+                self.slots.release()
+
+    def shutdown(self) -> None:
+        self.pool.shutdown(wait=True)
+
+    def stats(self) -> Dict[str, Any]:
+        """Returns the counters of the scheduler, the blocked submissions measure the backpressure"""
+        with self.lock:
+            return {
+                "workers": self.workers,
+                "max_pending": self.max_pending,
+                "pending": self.pending,
+                "running": self.running,
+                "queued_keys": len(self.queues),
+                "processed": self.processed,
+                "failed": self.failed,
+                "blocked": self.blocked,
+                "blocked_seconds": round(self.blocked_seconds, 3),
+                "average_wait_seconds": round(self.wait_seconds / self.processed, 3) if self.processed else 0.0,
+                "max_wait_seconds": round(self.max_wait_seconds, 3),
+            }
+
+
+class ChatDispatcher(Dispatcher):
+    """Dispatcher handling the updates of different chats concurrently and the ones of a chat in order.
+
+    The updates are processed by a `ChatScheduler` keyed by chat, so a slow handler
+    only delays the following updates of its own chat, and the conversation states
+    are never updated by two updates of the same chat at the same time.
+    """
+
+    def __init__(self, *args, chat_workers: int = 16, max_pending: int = 256, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self.scheduler = ChatScheduler(chat_workers, max_pending)
+
+    def process_update(self, update: object) -> None:
+        # polling errors and custom updates are processed right away, like the default dispatcher does
+        if not isinstance(update, Update):
+            super().process_update(update)
+            return
+
+        key = update.effective_chat.id if update.effective_chat else ("update", update.update_id)
+        self.scheduler.submit(key, partial(super().process_update, update))
+
+    def stop(self) -> None:
+        super().stop()
+        self.scheduler.shutdown()